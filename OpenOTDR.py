@@ -3,150 +3,53 @@
 import sys
 import os
 import json
-from collections import deque
+import argparse
 from threading import Lock
+from collections import deque
 from PyQt6 import QtWidgets
 from PyQt6.QtWidgets import QFileDialog
-from PyQt6 import QtPrintSupport
 from PyQt6 import QtGui
 from PyQt6 import QtCore
 #from PyQt6 import Qt
 import PyQt6
 import PyQt6.QtCore
 import numpy as np
-from scipy.ndimage import zoom
-from scipy.signal import find_peaks
 #from pyotdr import sorparse
-import otdrparser
-from matplotlib.figure import Figure
-from matplotlib import cm
-from matplotlib import colors
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
-from matplotlib.widgets import Cursor
 
 import mainwindow
+from analysis import DEFAULT_PARAMS, LOSS_WINDOW, EventSet, filter_events, get_block, detect_edges
+from analysis import common_grid, resample_traces, loss_and_dispersion
+from cache import TraceCache
+from sorfile import LazySorFile
+from workers import LoadBatch, DirectoryScan
+from watch import DirectoryWatcher, DEFAULT_INTERVAL, DEFAULT_SETTLE
+from plotting import TracePlot, CursorReadout, wavelength_to_rgb
+from project import ProjectFile, is_binary, read_legacy, load_legacy_trace
+import instrument
+from instrument import span
+from tablemodels import ColumnarTableModel, EventsTableModel, MetaTableModel, natural_key
 
 
 '''An Open Source OTDR reporting tool'''
 
 
-def round_sig(value, significant_figures):
-    '''Rounds a value to a number of significant figures.
-    However the value is less than 1 then simply round it to 1 D.P.'''
-    if value < 1:
-        return round(value, 1)
-    return round(value, -int(np.floor(np.sign(value) * np.log10(abs(value)))) + significant_figures)
-
-
-def _low_pass_filter_trace(a_raw_trace, window_len):
-    '''A simple LowPass Hanning filter'''
-    samples = np.r_[a_raw_trace[0][window_len-1:0:-1],
-                    a_raw_trace[0],
-                    a_raw_trace[0][-2:-window_len-1:-1]]
-    window = np.hanning(window_len)
-    a_smoothed_levels = np.convolve(window/window.sum(), samples, mode='valid')
-    trim = min(len(a_smoothed_levels), len(a_raw_trace[1]))
-    a_trace = np.array([a_smoothed_levels[:trim], a_raw_trace[1][:trim]])
-    return a_trace
-
-
-def prepare_data(self, window_len):
-    '''Transforms the trace data to unify sample width and signal quality'''
-    #a_raw_trace = d_data["trace"]
-    # Smoothing
-    #a_smooth_trace = _low_pass_filter_trace(a_raw_trace, window_len)
-    # Scale to ensure resolution per distance unit is equal.
-    #a_trace = zoom(a_smooth_trace, zoom=(1.0, d_data["meta"]["FxdParams"]["resolution"]), order=1)
-    self.meta_model.clear()
-    self.meta_model.setHorizontalHeaderLabels(['Name', 'Value'])
-
-    raw_data = {}
-    raw_data[0] = []
-    raw_data[1] = []
-    for kind in self.d_meta:
-        if kind.get('name', None) == 'DataPts':
-            data_pts = kind.get('data_points', None)
-            for dp in data_pts:
-                raw_data[0].append(dp[0])
-                raw_data[1].append(dp[1])
-
-        if kind.get('name', None) in ('GenParams', 'SupParams', 'FxdParams'):
-#            print(kind)
-            for k in kind:
-#                print("k=", k)
-                if k == 'name':
-                    continue
-                current_row = self.meta_model.rowCount()
-                self.meta_model.insertRow(current_row)
-                value_text = QtGui.QStandardItem()
-                value_text.setText(str(k))
-                value_text.setEditable(False)
-                self.meta_model.setItem(current_row, 0, value_text)
-#
-                value_text = QtGui.QStandardItem()
-                value_text.setText(str(kind.get(k, None)))
-                value_text.setEditable(False)
-                self.meta_model.setItem(current_row, 1, value_text)
-
-    return raw_data
-
-
-def differentiate_data(d_data):
-    '''Calculates the 1st order differential of the data'''
-    a_raw_trace = d_data
-    a_diff_trace = np.diff(a_raw_trace[0])
-    a_clean_trace = []
-    for sample_index in range(len(a_raw_trace[0])):
-        if sample_index < len(a_diff_trace)-1:
-            a_clean_trace.append(a_diff_trace[sample_index])
-        else:
-            a_clean_trace.append(0)
-    return [a_clean_trace, a_raw_trace]
-
-
-def find_edges(a_differential_trace):
-    '''Finds windows that contain features'''
-    a_abs_trace = [abs(sample) for sample in a_differential_trace[0]]
-    a_peaks = find_peaks(a_abs_trace, 0.00125, width=5, distance=150)
-    return [a_peaks[0],
-            [a_differential_trace[1][0][peak] for peak in a_peaks[0]],
-            [a_differential_trace[1][1][peak] for peak in a_peaks[0]]]
-
-
-def wavelength_to_rgb(s_wavelength):
-    '''Convert the wavelength to a spectral 'false' colour'''
-    wavelength = int(s_wavelength[:-3])
-    norm = colors.Normalize(vmin=1250, vmax=1650, clip=True)
-    mapper = cm.ScalarMappable(norm=norm, cmap=cm.jet_r)
-    red, green, blue, _ = mapper.to_rgba(wavelength)
-    return "#{:02X}{:02X}{:02X}".format(int(red*255), int(green*255), int(blue*255))
-
-
-class CustomNavigationToolbar(NavigationToolbar):
-    '''Removing a couple of irrelavent tools from the toolbar'''
-    toolitems = (('Home', 'Reset original view', 'home', 'home'),
-                 ('Back', 'Back to previous view', 'back', 'back'),
-                 ('Forward', 'Forward to next view', 'forward', 'forward'),
-                 (None, None, None, None),
-                 ('Pan', 'Pan axes with left mouse, zoom with right', 'move', 'pan'),
-                 ('Zoom', 'Zoom to rectangle', 'zoom_to_rect', 'zoom'))
-
-
 class NaturalSortFilterProxyModel(QtCore.QSortFilterProxyModel):
     '''Filter as a human would, not alphanumeric'''
-    @staticmethod
-    def _numeric_key(key):
-        '''The numeric key'''
-        if key:
-            return float(key)
-        return float('-inf')
-
     def lessThan(self, left, right):
         '''The < operator for Qt5'''
-        left_data = self.sourceModel().data(left)
-        right_data = self.sourceModel().data(right)
-        return self._numeric_key(left_data) < self._numeric_key(right_data)
+        source = self.sourceModel()
+        return natural_key(source.data(left)) < natural_key(source.data(right))
+
+    def sort(self, column, order=QtCore.Qt.SortOrder.AscendingOrder):
+        '''Array backed models sort themselves on precomputed keys, the proxy
+        then keeps their order instead of calling lessThan per comparison'''
+        source = self.sourceModel()
+        if isinstance(source, ColumnarTableModel):
+            if self.sortColumn() >= 0:
+                super(NaturalSortFilterProxyModel, self).sort(-1)
+            source.sort(column, order)
+            return
+        super(NaturalSortFilterProxyModel, self).sort(column, order)
 
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -158,7 +61,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.project_model = QtGui.QStandardItemModel()
         self.user_interface.treeView.setModel(self.project_model)
         # trace event processing model
-        self.events_model = QtGui.QStandardItemModel()
+        self.events_model = EventsTableModel()
         #
         self.events_proxy_model = NaturalSortFilterProxyModel()
         self.events_proxy_model.setSourceModel(self.events_model)
@@ -167,7 +70,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.user_interface.eventTableView.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
 #
         # meta processing model
-        self.meta_model = QtGui.QStandardItemModel()
+        self.meta_model = MetaTableModel()
 #
         self.meta_proxy_model = NaturalSortFilterProxyModel()
         self.meta_proxy_model.setSourceModel(self.meta_model)
@@ -182,142 +85,241 @@ class MainWindow(QtWidgets.QMainWindow):
         self.user_interface.addTrace.clicked.connect(self.add_trace)
         self.user_interface.removeTrace.clicked.connect(self.remove_trace)
         self.user_interface.recalculateEvents.clicked.connect(self.recalculate_events)
-        self.window_len = 0
+        # Grid samples either side of an event that its loss is measured across
+        self.loss_window = LOSS_WINDOW
+        self.params = dict(DEFAULT_PARAMS)
+        self.cache = TraceCache()
         self.canvas = None
         self.d_meta = None
+        self.sor_file = None
         self.plt = None
         self.cursor = None
         self.toolbar = None
+        self.trace_plot = None
         self.raw_features = []
         self.raw_traces = []
         self.files = {}
+        self.traces = {}
+        self.removed = set()
+        self.project = None
+        self.events = EventSet()
+        self.stack = None
         self.meta = {}
         self.busy = Lock()
-        self._draw()
-
-    def __preprocess_data(self, d_meta, l_raw_trace):
-        '''Convert the raw data into a numpy array'''
-        sample_spacing = float(d_meta["FxdParams"]["sample spacing"][:-5])
-        self.window_len = int(0.5/sample_spacing)
-        q_trace = deque(l_raw_trace)
-        l_distance = list()
-        l_level = list()
-        raw_row = q_trace.popleft()
-        while q_trace:
-#            print("raw_row=", raw_row)
-            raw_distance, raw_level = raw_row.replace("\n", "").split("\t")
-            f_distance = float(raw_distance)
-            f_level = float(raw_level)
-            l_distance.append(f_distance)
-            l_level.append(f_level)
-            raw_row = q_trace.popleft()
-        a_trace = np.array([l_level, l_distance])
-        return a_trace
-
-    def _load_file(self, url, _project=False):
-        '''Load the raw SOR file from provided url into the internal data format'''
-        with open(url, 'rb') as fp:
-            d_meta = otdrparser.parse(fp)
-            self.d_meta = d_meta
-            data_pts = None
-            for row in d_meta:
-                if row.get('name', None) == "DataPts":
-                    data_pts = row
-            self.files[url] = {"meta": d_meta, "raw_trace": data_pts}
-#        print("d_meta=", json.dumps(d_meta, sort_keys=True, indent=4))
-#        print("l_raw_trace=", json.dumps(l_raw_trace, sort_keys=True, indent=4))
-#        a_trace = self.__preprocess_data(d_meta, l_raw_trace)
-        d_data= prepare_data(self, self.window_len)
+        self.loader = None
+        self.watcher = None
+        self.watch_timer = None
+        # Settled files waiting for room in the loader
+        self.watch_queue = deque()
+        self.progress_bar = QtWidgets.QProgressBar()
+        self.progress_bar.setMaximumWidth(240)
+        self.progress_bar.hide()
+        self.cancel_button = QtWidgets.QPushButton("Cancel")
+        self.cancel_button.hide()
+        self.cancel_button.clicked.connect(self.cancel_loading)
+        self.user_interface.statusbar.addPermanentWidget(self.progress_bar)
+        self.user_interface.statusbar.addPermanentWidget(self.cancel_button)
+        # Redraw at most a few times a second while traces stream in
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(300)
+        self.refresh_timer.timeout.connect(self._refresh)
+        # The plot, and matplotlib with it, is set up by _draw once the first trace is loaded
+
+    def _add_trace_item(self, url, sor_file, params, d_result):
+        '''Record an analysed trace and list it in the project tree'''
+        d_data = d_result["trace"]
+        self.traces[url] = {"sor_file": sor_file,
+                            "params": dict(params),
+                            "trace": d_data,
+                            "features": d_result["features"],
+                            "sha256": d_result.get("sha256"),
+                            "saved": d_result.get("saved", False),
+                            "dirty": False}
+        self.removed.discard(url)
+        self.events.add(url, d_result["features"])
         filename = os.path.basename(url)
         item = QtGui.QStandardItem(filename)
         item.data = d_data
+        item.url = url
         self.project_model.appendRow(item)
+        self.raw_traces.append(d_data)
 
-    def hover(event, graph_info):
-#        print("hover event:", dir(event))
-# hover graph_info: ['__class__', '__delattr__', '__dict__', '__dir__', '__doc__', '__eq__', '__format__', '__ge__', '__getattribute__', '__getstate__', '__gt__', '__hash__', '__init__', '__init_subclass__', '__le__', '__lt__', '__module__', '__ne__', '__new__', '__reduce__', '__reduce_ex__', '__repr__', '__setattr__', '__sizeof__', '__str__', '__subclasshook__', '__weakref__', '_guiEvent', '_guiEvent_deleted', '_last_axes_ref', '_lastevent', '_process', '_set_inaxes', 'button', 'canvas', 'dblclick', 'guiEvent', 'inaxes', 'key', 'lastevent', 'modifiers', 'name', 'step', 'x', 'xdata', 'y', 'ydata']
-
-        print("hover graph_info:", dir(graph_info))
-        print("graph_info.guiEvent:", graph_info.guiEvent)
-        print("graph_info.inaxes:", graph_info.inaxes)
-        print("graph_info.key:", graph_info.key)
-        print("graph_info.x:", graph_info.x)
-        print("graph_info.y:", graph_info.y)
-        print("graph_info.xdata(km):", graph_info.xdata)
-        print("grpah_info.xdata(feet):", graph_info.xdata * 3280.8399)
-        print("graph_info.ydata:", graph_info.ydata)
-        print("graph_info.name:", graph_info.name)
-
-        if graph_info.inaxes == graph_info.ax:
-            cont, ind = line.contains(event)
-            if cont:
-                update_annot(ind)
-                annot.set_visible(True)
-                fig.canvas.draw_idle()
-            else:
-                if vis:
-                    annot.set_visible(False)
-                    fig.canvas.draw_idle()
-
-
-    def on_draw(self, event):
-        print("on_draw:", event)
-#        self.cursor = Cursor(self.plt, horizOn=True, vertOn=True, useblit=True, color='red', linewidth=2)
-
-    def button_press(event, graph_info):
-#        print("button_press event:", dir(event))
-# button_press graph_info: ['__class__', '__delattr__', '__dict__', '__dir__', '__doc__', '__eq__', '__format__', '__ge__', '__getattribute__', '__getstate__', '__gt__', '__hash__', '__init__', '__init_subclass__', '__le__', '__lt__', '__module__', '__ne__', '__new__', '__reduce__', '__reduce_ex__', '__repr__', '__setattr__', '__sizeof__', '__str__', '__subclasshook__', '__weakref__', '_guiEvent', '_guiEvent_deleted', '_last_axes_ref', '_lastevent', '_process', '_set_inaxes', 'button', 'canvas', 'dblclick', 'guiEvent', 'inaxes', 'key', 'lastevent', 'modifiers', 'name', 'step', 'x', 'xdata', 'y', 'ydata']
-
-#        print("button_press graph_info:", dir(graph_info))
-        print("graph_info.guiEvent:", graph_info.guiEvent)
-        print("graph_info.inaxes:", graph_info.inaxes)
-        print("graph_info.key:", graph_info.key)
-        print("graph_info.button:", graph_info.button) # (1 left, 2 middle, 3 right)
-        print("graph_info.dblclick:", graph_info.dblclick) # doubleclick?
-#        print("graph_info.x:", graph_info.x)
-#        print("graph_info.y:", graph_info.y)
-        print("graph_info.xdata(km):", graph_info.xdata)
-        print("grpah_info.xdata(feet):", graph_info.xdata * 3280.8399)
-
-        print("graph_info.ydata:", graph_info.ydata)
-        print("graph_info.name:", graph_info.name)
-
+    def load_files(self, urls, load=None):
+        '''Load and analyse files in the background, they appear in the project as they finish.
+        load(url) replaces reading the SOR file, for traces stored in a project'''
+        urls = [url for url in urls if url not in self.traces]
+        if not urls:
+            return
+        if self.loader is None or not self.loader.is_running() or self.loader.is_cancelled():
+            if self.loader is not None and self.loader.is_running():
+                # The cancelled batch still delivers the files it had started, the new one owns the progress bar
+                self.loader.progress.disconnect(self._on_load_progress)
+                self.loader.finished.disconnect(self._on_load_finished)
+            self.loader = LoadBatch(self.params, self.cache, parent=self)
+            self.loader.loaded.connect(self._on_trace_loaded)
+            self.loader.failed.connect(self._on_trace_failed)
+            self.loader.progress.connect(self._on_load_progress)
+            self.loader.finished.connect(self._on_load_finished)
+            self.progress_bar.show()
+            self.cancel_button.show()
+            self.cancel_button.setEnabled(True)
+        self.loader.extend(urls, load)
+
+    def cancel_loading(self):
+        '''Stop loading the files that have not started yet'''
+        if self.loader is not None:
+            self.loader.cancel()
+            self.cancel_button.setEnabled(False)
+
+    def watch_directory(self, path, interval=DEFAULT_INTERVAL, settle=DEFAULT_SETTLE):
+        '''Keep loading the SOR files that appear or change under path'''
+        if self.watcher is not None:
+            # A scan of the previous tree may still be running, whatever it finds is dropped
+            self.watcher.scanned.disconnect(self._on_watch_scanned)
+        self.watcher = DirectoryScan(DirectoryWatcher([path], settle), parent=self)
+        self.watcher.scanned.connect(self._on_watch_scanned)
+        self.watch_queue.clear()
+        if self.watch_timer is None:
+            self.watch_timer = QtCore.QTimer(self)
+            self.watch_timer.timeout.connect(self._poll_watch)
+        self.watch_timer.setInterval(int(interval * 1000))
+        self.watch_timer.start()
+        self._poll_watch()
+
+    def _poll_watch(self):
+        '''Scan the watched tree in the background and feed the loader what is already queued'''
+        self.watcher.start()
+        self._feed_watch()
+
+    def _on_watch_scanned(self, urls):
+        self.watch_queue.extend(urls)
+        self._feed_watch()
+
+    def _feed_watch(self):
+        '''Hand the settled files to the loader, a couple per loading thread at a time'''
+        outstanding = self.loader.total - self.loader.done if self.loader is not None else 0
+        room = 2 * QtCore.QThreadPool.globalInstance().maxThreadCount() - outstanding
+        urls = [self.watch_queue.popleft() for _ in range(max(0, min(room, len(self.watch_queue))))]
+        changed = [url for url in urls if url in self.traces]
+        for url in changed:
+            # A new version of a file that is already loaded, analysed again on the next refresh
+            try:
+                sor_file = LazySorFile(url)
+                self.files[url] = {"meta": sor_file.metadata()}
+            except Exception as error: # pylint: disable=broad-except
+                self._on_trace_failed(url, "{}: {}".format(type(error).__name__, error))
+                continue
+            self.traces[url]["sor_file"] = sor_file
+            # Hashed again when the project is saved
+            self.traces[url]["sha256"] = None
+            self.traces[url]["dirty"] = True
+        if changed and not self.refresh_timer.isActive():
+            self.refresh_timer.start()
+        self.load_files([url for url in urls if url not in self.traces])
+
+    def _on_trace_loaded(self, url, d_loaded):
+        if url in self.traces:
+            return
+        self.d_meta = d_loaded["meta"]
+        self.sor_file = d_loaded["sor_file"]
+        self.files[url] = {"meta": self.d_meta}
+        self.meta_model.set_rows(d_loaded["meta_rows"])
+        self._add_trace_item(url, d_loaded["sor_file"], d_loaded["params"], d_loaded)
+        if not self.refresh_timer.isActive():
+            self.refresh_timer.start()
+
+    def _on_trace_failed(self, url, error):
+        self.user_interface.statusbar.showMessage("Could not load {}: {}".format(os.path.basename(url), error), 5000)
+
+    def _on_load_progress(self, done, total):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+
+    def _on_load_finished(self):
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+        self.refresh_timer.stop()
+        self._refresh()
+
+    def _refresh(self):
+        '''Bring the events table and plot up to date with the loaded traces'''
+        if self.busy.locked():
+            self.refresh_timer.start()
+            return
+        with self.busy:
+            self._analyse_dirty()
+            if self.traces:
+                self._update_events_table()
+            self._draw()
 
-    def _draw(self):
-        '''(re)draw the plot with the latest data'''
+    def set_trace_params(self, url, params):
+        '''Change the analysis parameters of one trace, it is re-analysed on the next recalculation'''
+        d_trace = self.traces[url]
+        d_trace["params"] = dict(DEFAULT_PARAMS, **params)
+        d_trace["dirty"] = True
+
+    def _analyse_dirty(self):
+        '''Analyse only the traces that were added or re-parameterised since the last pass'''
+        for url, d_trace in self.traces.items():
+            if not d_trace["dirty"]:
+                continue
+            if d_trace["sor_file"] is None:
+                # Read from a project whose SOR file may no longer be around, its trace was saved smoothed
+                d_result = {"trace": d_trace["trace"],
+                            "features": detect_edges(d_trace["trace"], d_trace["params"])}
+            else:
+                d_result = self.cache.analyse(url, d_trace["params"], d_trace["sor_file"])
+            d_trace["trace"] = d_result["trace"]
+            d_trace["features"] = d_result["features"]
+            self.events.add(url, d_result["features"])
+            d_trace["dirty"] = False
+            d_trace["saved"] = False
+
+    def button_press(self, event):
+        '''Keep the readout of a left click in the status bar, where it stays after the mouse moves on'''
+        if event.button != 1 or event.inaxes is not self.plt or self.canvas.widgetlock.locked():
+            return
+        samples = self.trace_plot.samples_at(event.xdata)
+        self.user_interface.statusbar.showMessage(
+            CursorReadout.format(event.xdata, samples).replace("\n", " | "))
+
+    def _setup_plot(self):
+        '''Create the figure, canvas and toolbar once, traces are then added to it as lines'''
+        # matplotlib is only imported once there is a trace to show, it is most of the start up time
+        # pylint: disable=import-outside-toplevel
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.backends.backend_qtagg import NavigationToolbar2QT as NavigationToolbar
+        # pylint: enable=import-outside-toplevel
         fig = Figure()
         self.plt = fig.add_subplot(1, 1, 1)
-        if self.raw_traces:
-#            print("self.raw_traces:", self.raw_traces)
-            for d_final_data in self.raw_traces:
-                wavelength = 1310
-                print("d_final_data", d_final_data)
-#                print("wavelength=", wavelength)
-                self.plt.plot(d_final_data[0],
-                         d_final_data[1],
-                         label=wavelength,
-                         color=wavelength_to_rgb(str(wavelength)))
-#            self.plt.set_xlim([0, None])
-
-        if self.canvas:
-            self.user_interface.graphLayout.removeWidget(self.canvas)
-            self.canvas.close()
-        if self.toolbar:
-            self.user_interface.graphLayout.removeWidget(self.toolbar)
-            self.toolbar.close()
-        fig.legend()
-# if i want to have my own hover function
-#        fig.canvas.mpl_connect("motion_notify_event", self.hover)
-        fig.canvas.mpl_connect("button_press_event", self.button_press)
 #        fig.canvas.mpl_connect("scroll_event", self.zoom)
-        fig.canvas.mpl_connect('draw_event', self.on_draw)
+        fig.canvas.mpl_connect("button_press_event", self.button_press)
 
         self.canvas = FigureCanvas(fig)
-#        self.toolbar = CustomNavigationToolbar(self.canvas, self, coordinates=True)
         self.toolbar = NavigationToolbar(self.canvas, self, coordinates=True)
-        self.cursor = Cursor(self.plt, horizOn=True, vertOn=True, useblit=True, color='red', linewidth=2)
+        self.trace_plot = TracePlot(self.plt)
+        # Blitted over the traces as the mouse moves, the traces are only drawn when they or the view change
+        self.cursor = CursorReadout(self.trace_plot)
         self.user_interface.graphLayout.addWidget(self.canvas)
         self.user_interface.graphLayout.addWidget(self.toolbar)
+
+    def _trace_line_options(self, url):
+        '''Label and colour a trace by its wavelength'''
+        fxd_params = get_block(self.files[url]["meta"], 'FxdParams') or {}
+        wavelength = int(fxd_params.get('wavelength') or 1310)
+        return {"label": "{} nm".format(wavelength),
+                "color": wavelength_to_rgb("{} nm".format(wavelength))}
+
+    def _draw(self):
+        '''(re)draw the plot with the latest data, only traces that changed are replotted'''
+        if self.canvas is None:
+            self._setup_plot()
+        with span("render", traces=len(self.traces)):
+            self.trace_plot.sync({url: (d_trace["trace"], self._trace_line_options(url))
+                                  for url, d_trace in self.traces.items()})
+            self.canvas.draw_idle()
         self.recalculate_events()
 
 
@@ -330,19 +332,21 @@ class MainWindow(QtWidgets.QMainWindow):
             dialog.setOption(QFileDialog.Option.DontUseNativeDialog, True)
             uri, _ = dialog.getOpenFileName(self, "Open project", "", "OpenOTDR Project Files(*.opro);;All Files (*)")
             if uri:
-                with open(uri, "r") as file:
-                    content = json.load(file)
-                self.meta = content["meta"]
-                for uri, data in content["files"].items():
-                    self._load_file(uri, _project=data)
-                    self._draw()
-                for index in range(self.project_model.rowCount()):
-                    raw_data = self.project_model.item(index).data
-                    self.raw_traces.append(raw_data)
-                    self._draw()
-                self._draw()
-        self.recalculate_events()
-        self._draw
+                if is_binary(uri):
+                    self.project = ProjectFile(uri)
+                    self.meta = self.project.meta
+                    # Only the index is read here, the arrays are mapped and paged in as they are used
+                    for url in self.project.traces:
+                        if url not in self.traces:
+                            self._on_trace_loaded(url, self.project.load_trace(url))
+                else:
+                    # Projects saved before the binary format, they hold the parsed blocks of every file
+                    self.project = None
+                    self.meta, d_files = read_legacy(uri)
+                    self.load_files([url for url in d_files if os.path.exists(url)])
+                    params = dict(self.params)
+                    self.load_files([url for url in d_files if not os.path.exists(url)],
+                                    lambda url: load_legacy_trace(d_files[url], params))
 
     def save_project(self):
         '''Save a project to a file'''
@@ -356,25 +360,49 @@ class MainWindow(QtWidgets.QMainWindow):
                 _, extension = os.path.splitext(uri)
                 if not extension:
                     uri += ".opro"
-                content = {"meta": self.meta, "files": self.files}
-                with open(uri, "w") as file:
-                    json.dump(content, file)
+                self._save_project(uri)
+
+    def _save_project(self, uri):
+        '''Write the project, re-saving into the open project only writes the traces that changed'''
+        fresh = self.project is None or os.path.abspath(uri) != os.path.abspath(self.project.url)
+        d_changed = {}
+        for url, d_trace in self.traces.items():
+            if d_trace["saved"] and not fresh:
+                continue
+            # Traces read from a legacy project may have no SOR file left to hash
+            if d_trace["sha256"] is None and os.path.exists(url):
+                d_trace["sha256"] = self.cache.file_hash(url)
+            d_changed[url] = {"meta": self.files[url]["meta"],
+                              "sha256": d_trace["sha256"],
+                              "params": d_trace["params"],
+                              "trace": d_trace["trace"],
+                              "features": d_trace["features"]}
+        if fresh:
+            # Written whole and moved over uri, the traces may be mapped from the file it replaces
+            self.project = ProjectFile.write(uri, self.meta, d_changed)
+        else:
+            self.project.save(self.meta, d_changed, self.removed)
+        for url in d_changed:
+            self.traces[url]["saved"] = True
+        self.removed.clear()
 
     def print_pdf(self):
         '''Print the report to pdf'''
-        if self.busy.locked():
+        if self.busy.locked() or not self.traces:
             return
         with self.busy:
-            printer = QtPrintSupport.QPrinter()
-            dialog = QtPrintSupport.QPrintDialog(printer, self)
-            dialog.setModal(True)
-            dialog.setWindowTitle("Print Document")
-            dialog.options = (QtPrintSupport.QAbstractPrintDialog.PrintToFile
-                              | QtPrintSupport.QAbstractPrintDialog.PrintShowPageSize
-                              | QtPrintSupport.QAbstractPrintDialog.PrintPageRange)
-            if dialog.exec_():
-                print("printing")
-                # TODO Printing
+            dialog = QtWidgets.QFileDialog(self)
+            dialog.setOption(QFileDialog.Option.DontUseNativeDialog, True)
+            uri, _ = dialog.getSaveFileName(self, "Print report", "", "PDF Files(*.pdf);;All Files (*)")
+            if uri:
+                from report import build_report, fibre_title, render_report, trace_wavelength # pylint: disable=import-outside-toplevel
+                _, extension = os.path.splitext(uri)
+                if not extension:
+                    uri += ".pdf"
+                d_meta = self.d_meta or self.files[next(iter(self.traces))]["meta"]
+                l_traces = [(d_trace["trace"], trace_wavelength(self.files[url]["meta"]))
+                            for url, d_trace in self.traces.items()]
+                render_report(build_report(fibre_title(d_meta), l_traces, d_meta, self.loss_window), uri)
 
     def add_trace(self):
         '''Load a new trace'''
@@ -384,26 +412,8 @@ class MainWindow(QtWidgets.QMainWindow):
             dialog = QtWidgets.QFileDialog(self)
             dialog.setOption(QFileDialog.Option.DontUseNativeDialog, True)
             files, _ = dialog.getOpenFileNames(self, "Add traces", "", "OTDR Trace Files(*.sor);;All Files (*)")
-            if not files:
-                return
-            for filename in files:
-                self._load_file(filename)
-            l_traces = []
-            l_feature_points = []
-            for index in range(self.project_model.rowCount()):
-                raw_data = self.project_model.item(index).data
-                self.raw_traces.append(raw_data)
-                d_data = prepare_data(self, self.window_len)
-                l_traces.append(d_data)
-                l_feature_points.append(find_edges(differentiate_data(d_data)))
-            raw_features = l_feature_points
-            raw_traces = l_traces
-#            print("add_trace: raw_features:", raw_features)
-#            if not raw_features:
-#                return
-            d_events = self._filter_events(raw_features)
-            self._update_events_table(d_events, raw_traces)
-            self._draw()
+        if files:
+            self.load_files(files)
 
     def remove_trace(self):
         '''Remove a trace'''
@@ -413,112 +423,54 @@ class MainWindow(QtWidgets.QMainWindow):
             if not self.user_interface.treeView.selectedIndexes():
                 return
             indexes = self.user_interface.treeView.selectedIndexes()
-            for index in indexes:
-                self.project_model.removeRow(index.row())
-                del self.raw_traces[index.row()]
+            for row in sorted({index.row() for index in indexes}, reverse=True):
+                url = self.project_model.item(row).url
+                self.project_model.removeRow(row)
+                del self.raw_traces[row]
+                del self.traces[url]
+                self.removed.add(url)
+                self.events.remove(url)
+            self._update_events_table()
             self._draw()
 
     @staticmethod
     def _filter_events(raw_features):
         '''Filter the detected features of each trace to make a single set with no duplicates or ghosts'''
-        d_events = {}
-        for trace_features in raw_features:
-            for index, feature in enumerate(trace_features[2]):
-                feature_position = round_sig(feature, 3)
-                if feature_position not in d_events and feature_position-0.1 not in d_events and feature_position+0.1 not in d_events:
-                    d_events[feature_position] = {
-                        "indexes": []
-                        }
-                if feature_position in d_events:
-                    d_events[feature_position]["indexes"].append(trace_features[0][index])
-                elif feature_position-0.1 in d_events:
-                    d_events[feature_position-0.1]["indexes"].append(trace_features[0][index])
-                elif feature_position+0.1 in d_events:
-                    d_events[feature_position+0.1]["indexes"].append(trace_features[0][index])
-        return d_events
-
-    def __calculate_loss_and_dispersion(self, raw_traces, meta_data):
-        '''Calculate the loss and dispersion of an event'''
-        start_values = []
-        end_values = []
-        for trace in raw_traces:
-            for i in meta_data["indexes"]:
-                start_index = max(0, i-self.window_len)
-                start_values.append(trace["trace"][0][start_index])
-                end_index = min(len(trace["trace"][0])-1, i+self.window_len)
-                end_values.append(trace["trace"][0][end_index])
-                self.canvas.figure.get_axes()[0].axvspan(trace["trace"][1][start_index], trace["trace"][1][end_index], color='yellow', alpha=0.5)
-        average_start = sum(start_values)/len(start_values)
-        average_end = sum(end_values)/len(end_values)
-        loss = average_start - average_end
-        difference_start = max(start_values) - min(start_values)
-        difference_end = max(end_values) - min(end_values)
-        #print("difference_end=", difference_end)
-        #print("difference_start=", difference_start)
-        if difference_start == 0 or difference_end == 0:
-            dispersion_factor = 0
-        else:
-            dispersion_factor = round(max(difference_end/difference_start, difference_start/difference_end))
-        return loss, dispersion_factor
-
-    def _update_events_table(self, d_events, raw_traces):
+        return filter_events(raw_features)
+
+    def _stacked_traces(self):
+        '''The loaded traces resampled onto one grid, rebuilt only when the traces change'''
+        l_traces = [d_trace["trace"] for d_trace in self.traces.values()]
+        if (self.stack is None or len(self.stack[0]) != len(l_traces)
+                or any(a_old is not a_new for a_old, a_new in zip(self.stack[0], l_traces))):
+            a_grid = common_grid(l_traces, extent='union')
+            self.stack = (l_traces,) + resample_traces(l_traces, a_grid)
+        return self.stack[1], self.stack[2]
+
+    def __calculate_loss_and_dispersion(self, a_positions):
+        '''Calculate the loss and dispersion at each event position across all traces,
+        highlighting the distances they were measured between'''
+        a_grid, a_levels = self._stacked_traces()
+        d_result = loss_and_dispersion(a_grid, a_levels, a_positions, self.loss_window)
+        if self.trace_plot is not None:
+            self.trace_plot.set_spans(d_result["start"], d_result["end"])
+            self.canvas.draw_idle()
+        return d_result["loss"], d_result["dispersion"]
+
+    def _update_events_table(self):
         '''Update the events table in the UI'''
-        print("_update_events_table")
-        self.events_model.clear()
-        key_events = None
-        for row in self.d_meta:
-            if row.get('name', None) == 'KeyEvents':
-                key_events = row
+        # The table lists the KeyEvents of the current file, the correlated events of
+        # self.events are only built by whoever asks for them
+        with span("table_update"):
+            self._fill_events_table()
+
+    def _fill_events_table(self):
+        key_events = get_block(self.d_meta or [], 'KeyEvents')
 #        print("update_events_table: key_events:", key_events)
-        num_events = 0
-        self.events_model.setHorizontalHeaderLabels(['comment', 'dist(km)', 'dist(ft)', 'peak', 'refl loss', 'slope', 'splice_loss', 'type'])
-        if key_events is not None:
-            number_of_events = int(key_events.get('number_of_events', 0))
-            print("number_of_events:", number_of_events)
-
-            for event in key_events.get('events', []):
-                current_row = self.events_model.rowCount()
-                self.events_model.insertRow(current_row)
-
-                event_comment = QtGui.QStandardItem()
-                event_comment.setText(str(event.get('comment')))
-                event_comment.setEditable(False)
-                self.events_model.setItem(current_row, 0, event_comment)
-
-                event_position_km = QtGui.QStandardItem()
-                event_position_km.setText(str(event.get('distance_of_travel', 0)))
-                event_position_km.setEditable(False)
-                self.events_model.setItem(current_row, 1, event_position_km)
-
-                event_position_ft = QtGui.QStandardItem()
-                event_position_ft.setEditable(False)
-                event_position_ft.setText(str(float(event.get('distance_of_travel', 0)) * 3280.8399))
-                self.events_model.setItem(current_row, 2, event_position_ft)
-
-                event_peak = QtGui.QStandardItem()
-                event_peak.setText(str(event.get('peak_point')))
-                event_peak.setEditable(False)
-                self.events_model.setItem(current_row, 3, event_peak)
-
-                event_loss = QtGui.QStandardItem()
-                event_loss.setText(str(event.get('reflection_loss')))
-                event_loss.setEditable(False)
-                self.events_model.setItem(current_row, 4, event_loss)
-
-                event_slope = QtGui.QStandardItem()
-                event_slope.setText(str(event.get('slope')))
-                event_slope.setEditable(False)
-                self.events_model.setItem(current_row, 5, event_slope)
-
-                event_splice_loss = QtGui.QStandardItem()
-                event_splice_loss.setText(str(event.get('splice_loss')))
-                event_splice_loss.setEditable(False)
-                self.events_model.setItem(current_row, 6, event_splice_loss)
-
-                event_type = QtGui.QStandardItem()
-                event_type.setText(str(event.get('event_type_details')['event']))
-                event_type.setEditable(False)
-                self.events_model.setItem(current_row, 7, event_type)
+        events = key_events.get('events', []) if key_events is not None else []
+        a_positions = [float(event.get('distance_of_travel') or 0) for event in events]
+        loss, dispersion_factor = self.__calculate_loss_and_dispersion(a_positions)
+        self.events_model.set_events(events, loss, dispersion_factor)
 
 ##        self.events_model.setHorizontalHeaderLabels(['Event',
 ##                                                     'Dist (km)',
@@ -540,7 +492,7 @@ class MainWindow(QtWidgets.QMainWindow):
 ##            event_position_ft.setText(str(position * 3280.8399))
 ##            self.events_model.setItem(current_row, 4, event_position_ft)
 ##
-##            loss, dispersion_factor = self.__calculate_loss_and_dispersion(raw_traces, meta_data)
+##            loss, dispersion_factor = self.__calculate_loss_and_dispersion([position])
 ##
 ##            event_loss = QtGui.QStandardItem()
 ##            event_loss.setText(str(loss))
@@ -557,37 +509,44 @@ class MainWindow(QtWidgets.QMainWindow):
 ##            event_type.setEditable(True)
 ##            self.events_model.setItem(current_row, 0, event_type)
 ##
-        self.events_model.sort(1)
+        self.events_proxy_model.sort(1)
         self.user_interface.eventTableView.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
 
 
     def recalculate_events(self):
         '''Recalculate the events'''
-        print("starting recalculate_events()")
         if self.busy.locked():
-            print("recalculate_events self.busy.locked()")
             return
         with self.busy:
-            l_traces = []
-            l_feature_points = []
-            for index in range(self.project_model.rowCount()):
-                raw_data = self.project_model.item(index).data
-                d_data = prepare_data(self, self.window_len)
-                l_traces.append(d_data)
-                l_feature_points.append(find_edges(differentiate_data(d_data)))
-            raw_features = l_feature_points
-            raw_traces = l_traces
-            print("recalculate_events: raw_features:", raw_features)
-            if not raw_features:
+            self._analyse_dirty()
+            if not self.traces:
                 return
-            d_events = self._filter_events(raw_features)
-            self._update_events_table(d_events, d_data)
-
-
-APP = QtWidgets.QApplication(sys.argv)
-
-MAIN_WINDOW = MainWindow()
-MAIN_WINDOW.setWindowTitle("OpenOTDR")
-MAIN_WINDOW.show()
-
-sys.exit(APP.exec())
+            self._update_events_table()
+
+
+def main():
+    '''Start the OpenOTDR window'''
+    parser = argparse.ArgumentParser(description='An Open Source OTDR reporting tool')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='time the pipeline stages, writing a Chrome trace to FILE on exit')
+    parser.add_argument('--watch', metavar='DIRECTORY',
+                        help='keep loading the SOR files that appear under DIRECTORY')
+    parser.add_argument('--loss-window', type=int, default=LOSS_WINDOW,
+                        help='grid samples either side of an event that its loss is measured across')
+    args, qt_args = parser.parse_known_args()
+    if args.trace:
+        instrument.enable()
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+    main_window = MainWindow()
+    main_window.setWindowTitle("OpenOTDR")
+    main_window.loss_window = args.loss_window
+    main_window.show()
+    if args.watch:
+        main_window.watch_directory(args.watch)
+    status = app.exec()
+    instrument.finish(args.trace)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
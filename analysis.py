@@ -0,0 +1,839 @@
+#!/usr/bin/env python3
+'''GUI-free trace analysis shared by the OpenOTDR window and the batch tools'''
+
+import struct
+import warnings
+import functools
+
+import numpy as np
+import otdrparser
+
+from instrument import span
+
+
+# A window_len of None is worked out per file from its sample spacing by resolve_params
+DEFAULT_PARAMS = {"window_len": None,
+                  "filter": "hanning",
+                  "height": 0.00125,
+                  "width": 5,
+                  "distance": 150}
+
+# Bump whenever the smoothing or detection would give different results, stored results are then recomputed
+ANALYSIS_VERSION = 2
+
+META_BLOCKS = ('GenParams', 'SupParams', 'FxdParams')
+
+# Features of different traces closer than this, in trace distance units, are the same event
+DEFAULT_TOLERANCE = 50.0
+
+# Grid samples either side of an event that its loss is measured across
+LOSS_WINDOW = 25
+
+# Trace distances are in metres, as otdrparser computes them, and are shown in km and ft
+METRES_PER_KM = 1000.0
+FEET_PER_METRE = 3.2808399
+
+# Samples per chunk of the streaming smoothing and detection, 256 KiB per working array
+STREAM_CHUNK = 1 << 15
+# Traces longer than this are searched for features a chunk at a time. That is slower than the
+# full length search and only pays off once its working arrays, ~30 bytes a sample, get large
+STREAM_THRESHOLD = 1 << 22
+
+# Smoothing filters, a window_len below 2 leaves the trace as it is
+FILTERS = ('hanning', 'savgol', 'median')
+# Smallest windows that smooth at all, the end taps of a Hanning window are zero and a
+# Savitzky-Golay polynomial goes through any SAVGOL_ORDER + 1 samples, shorter ones are rounded up
+MIN_WINDOWS = {'hanning': 5, 'savgol': 5, 'median': 3}
+# The default smoothing window in microseconds of sample time, converted to samples per file
+SMOOTHING_US = 0.5
+# Kernels with more taps than this are convolved by FFT, overlap-add, rather than directly
+FFT_TAPS = 128
+# Polynomial order of the Savitzky-Golay filter
+SAVGOL_ORDER = 2
+
+
+def round_sig(value, significant_figures):
+    '''Rounds a value to a number of significant figures.
+    However the value is less than 1 then simply round it to 1 D.P.'''
+    if value < 1:
+        return round(value, 1)
+    return round(value, -int(np.floor(np.sign(value) * np.log10(abs(value)))) + significant_figures)
+
+
+def decode_data_pts(buffer, sample_spacing, index_of_refraction):
+    '''Decode a raw DataPts block in bulk, the trace is kept as a 2xN [distances, levels] array'''
+    name_end = bytes(buffer[:64]).index(b"\0")
+    number_of_data_points, number_of_traces, number_of_data_points2, scaling_factor = \
+        struct.unpack_from("<IHIH", buffer, name_end + 1)
+    samples = np.frombuffer(buffer, dtype="<u2", count=number_of_data_points,
+                            offset=name_end + 1 + struct.calcsize("<IHIH"))
+    # Same operation order as otdrparser so the values are bit for bit identical
+    a_trace = np.empty((2, number_of_data_points))
+    np.multiply(np.arange(number_of_data_points, dtype=np.float64), sample_spacing, out=a_trace[0])
+    a_trace[0] /= 100000000
+    a_trace[0] *= otdrparser.C_M
+    a_trace[0] /= index_of_refraction
+    np.multiply(samples, float(-scaling_factor), out=a_trace[1])
+    a_trace[1] /= 1000000
+    return {"name": bytes(buffer[:name_end]).decode().strip(),
+            "number_of_data_points": number_of_data_points,
+            "number_of_traces": number_of_traces,
+            "number_of_data_points2": number_of_data_points2,
+            "scaling_factor": scaling_factor,
+            "trace": a_trace}
+
+
+def parse_blocks(fp):
+    '''otdrparser.parse, except that DataPts is decoded with numpy rather than per sample'''
+    blocks = [otdrparser.parse_map_block(fp)]
+    sample_spacing = None
+    index_of_refraction = None
+    for entry in blocks[0]["maps"]:
+        block_name = entry["name"]
+        block_numbytes = entry["numbytes"]
+        if block_name == "GenParams":
+            blocks.append(otdrparser.parse_genparams_block(fp, block_numbytes))
+        elif block_name == "SupParams":
+            blocks.append(otdrparser.parse_supparams_block(fp, block_numbytes))
+        elif block_name == "FxdParams":
+            blocks.append(otdrparser.parse_fxdparams_block(fp, block_numbytes))
+            sample_spacing = blocks[-1]["sample_spacing"]
+            index_of_refraction = blocks[-1]["index_of_refraction"]
+        elif block_name == "DataPts":
+            blocks.append(decode_data_pts(fp.read(block_numbytes), sample_spacing, index_of_refraction))
+        elif block_name == "KeyEvents":
+            blocks.append(otdrparser.parse_keyevents_block(fp, block_numbytes, index_of_refraction))
+        elif block_name == "Cksum":
+            blocks.append(otdrparser.parse_chksum_block(fp, block_numbytes))
+        else:
+            blocks.append(otdrparser.parse_unknown_block(fp, block_numbytes))
+    return blocks
+
+
+def load_blocks(url):
+    '''Parse a SOR file into its list of blocks'''
+    with span("parse", url=url), open(url, 'rb') as fp:
+        return parse_blocks(fp)
+
+
+def get_block(d_meta, name):
+    '''Return the last block called name, or None'''
+    found = None
+    for block in d_meta:
+        if block.get('name', None) == name:
+            found = block
+    return found
+
+
+def extract_meta(d_meta):
+    '''The (name, value) rows shown in the meta data table'''
+    rows = []
+    for block in d_meta:
+        if block.get('name', None) in META_BLOCKS:
+            for key, value in block.items():
+                if key == 'name':
+                    continue
+                rows.append((str(key), str(value)))
+    return rows
+
+
+def extract_trace(d_meta):
+    '''The DataPts block of the parsed blocks as a contiguous 2xN [distances, levels] array'''
+    data_pts = get_block(d_meta, 'DataPts')
+    if data_pts is None:
+        return np.empty((2, 0))
+    if "trace" in data_pts:
+        return np.ascontiguousarray(data_pts["trace"], dtype=np.float64)
+    # Blocks from otdrparser itself or from a JSON project hold a list of pairs
+    a_points = np.array(data_pts.get('data_points', []), dtype=np.float64).reshape(-1, 2)
+    return np.ascontiguousarray(a_points.T)
+
+
+def differentiate_levels(a_levels):
+    '''1st order differential along the last axis of one trace or a (traces x samples) batch'''
+    a_levels = np.asarray(a_levels, dtype=np.float64)
+    a_clean_trace = np.zeros(a_levels.shape)
+    # The last two samples have no usable differential
+    usable = max(a_levels.shape[-1] - 2, 0)
+    np.subtract(a_levels[..., 1:usable + 1], a_levels[..., :usable], out=a_clean_trace[..., :usable])
+    return a_clean_trace
+
+
+def differentiate_data(d_data):
+    '''Calculates the 1st order differential of the levels'''
+    with span("preprocess"):
+        a_raw_trace = np.asarray(d_data)
+        return [differentiate_levels(a_raw_trace[1]), a_raw_trace]
+
+
+def _find_peaks(a_abs_trace, params):
+    '''The indexes of the features in one absolute differential'''
+    # scipy.signal takes a second to import, only pay for it once something is detected
+    from scipy.signal import find_peaks # pylint: disable=import-outside-toplevel
+    return find_peaks(a_abs_trace, params["height"], width=params["width"], distance=params["distance"])[0]
+
+
+def find_edges(a_differential_trace, params=None):
+    '''Finds windows that contain features, as [indexes, distances, levels]'''
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    with span("detect"):
+        a_peaks = _find_peaks(np.abs(a_differential_trace[0]), params)
+    a_raw_trace = a_differential_trace[1]
+    return [a_peaks,
+            a_raw_trace[0][a_peaks],
+            a_raw_trace[1][a_peaks]]
+
+
+def find_edges_batch(a_distances, a_levels, params=None):
+    '''find_edges for a (traces x samples) batch of levels resampled to a common grid.
+
+    a_distances is either the shared grid or one row per trace. The smoothing,
+    the differential and its magnitude are computed for the whole batch at
+    once, only the peak search itself runs per trace. There is no sample
+    spacing to work a window_len of None out from, so it smooths nothing.'''
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    a_levels = smooth_levels(np.atleast_2d(a_levels), params["window_len"], params["filter"])
+    a_distances = np.broadcast_to(a_distances, a_levels.shape)
+    with span("preprocess", traces=len(a_levels)):
+        a_abs_traces = np.abs(differentiate_levels(a_levels))
+    l_features = []
+    with span("detect", traces=len(a_levels)):
+        for row, a_abs_trace in enumerate(a_abs_traces):
+            a_peaks = _find_peaks(a_abs_trace, params)
+            l_features.append([a_peaks, a_distances[row, a_peaks], a_levels[row, a_peaks]])
+    return l_features
+
+
+def iter_chunks(length, chunk=STREAM_CHUNK):
+    '''(start, stop) of consecutive chunks of at most chunk samples covering 0..length'''
+    for start in range(0, length, chunk):
+        yield start, min(start + chunk, length)
+
+
+def resolve_params(params, fxd_params):
+    '''params merged over DEFAULT_PARAMS, with a window_len of None replaced by
+    SMOOTHING_US worth of samples at the sample spacing of FxdParams'''
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    if params["window_len"] is None:
+        sample_spacing = (fxd_params or {}).get('sample_spacing')
+        # sample_spacing counts 1e-8 us, as otdrparser reads it
+        params["window_len"] = int(SMOOTHING_US * 100000000 / sample_spacing) if sample_spacing else 0
+    return params
+
+
+def smoothing_window(name, window_len):
+    '''The odd window a filter actually smooths over for window_len, an even one
+    counting as the next odd one and short ones rounded up to MIN_WINDOWS'''
+    return max(2 * (window_len // 2) + 1, MIN_WINDOWS.get(name, 3))
+
+
+@functools.lru_cache(maxsize=64)
+def smoothing_kernel(name, window_len):
+    '''The convolution kernel of a linear smoothing filter, worked out once per
+    filter and window length and then shared, so it is read only. None for
+    the median filter, which has none.'''
+    if name == 'hanning':
+        window = np.hanning(window_len)
+        a_kernel = window/window.sum()
+    elif name == 'savgol':
+        from scipy.signal import savgol_coeffs # pylint: disable=import-outside-toplevel
+        a_kernel = savgol_coeffs(window_len, min(SAVGOL_ORDER, window_len - 1))
+    elif name == 'median':
+        return None
+    else:
+        raise ValueError('unknown filter {!r}, expected one of {}'.format(name, ', '.join(FILTERS)))
+    a_kernel.setflags(write=False)
+    return a_kernel
+
+
+def smooth_chunks(a_levels, window_len, name='hanning', chunk=STREAM_CHUNK):
+    '''The smoothed levels of one trace or a (traces x samples) batch, yielded
+    chunk by chunk along the samples.
+
+    The filter is centred on each sample, over smoothing_window(name,
+    window_len) samples, and the trace is mirrored at both ends. Each chunk is
+    filtered together with half a window either side of it, so the chunks
+    join up seamlessly without a padded copy of the whole trace.'''
+    # pylint: disable=import-outside-toplevel
+    from scipy.ndimage import convolve1d, median_filter
+    from scipy.signal import oaconvolve
+    a_levels = np.asarray(a_levels, dtype=np.float64)
+    half = smoothing_window(name, window_len) // 2
+    a_kernel = smoothing_kernel(name, 2 * half + 1)
+    length = a_levels.shape[-1]
+    for start, stop in iter_chunks(length, chunk):
+        if start >= half and stop + half <= length:
+            a_window = a_levels[..., start - half:stop + half]
+        else:
+            a_indexes = length - 1 - np.abs(length - 1 - np.abs(np.arange(start - half, stop + half)))
+            # A window longer than the trace holds the first sample beyond one reflection
+            a_window = a_levels[..., np.maximum(a_indexes, 0)]
+        if a_kernel is None:
+            # Row by row, scipy only has its fast running median for one dimension
+            a_rows = a_window.reshape(-1, a_window.shape[-1])
+            a_medians = np.array([median_filter(a_row, size=2 * half + 1, mode='nearest') for a_row in a_rows])
+            yield a_medians.reshape(a_window.shape)[..., half:half + stop - start]
+        elif len(a_kernel) > FFT_TAPS:
+            yield oaconvolve(a_window, a_kernel.reshape((1,) * (a_window.ndim - 1) + (-1,)), mode='valid', axes=-1)
+        else:
+            yield convolve1d(a_window, a_kernel, axis=-1, mode='nearest')[..., half:half + stop - start]
+
+
+def smooth_levels(a_levels, window_len, name='hanning', chunk=STREAM_CHUNK):
+    '''The levels of one trace or a (traces x samples) batch smoothed by a filter
+    from FILTERS, all in one call. A window_len below 2, or None, leaves them as
+    they are.'''
+    a_levels = np.asarray(a_levels, dtype=np.float64)
+    if window_len is None or window_len < 2:
+        return a_levels
+    a_smoothed = np.empty(a_levels.shape)
+    with span("smooth", filter=name, window_len=window_len):
+        for (start, stop), a_block in zip(iter_chunks(a_levels.shape[-1], chunk),
+                                          smooth_chunks(a_levels, window_len, name, chunk)):
+            a_smoothed[..., start:stop] = a_block
+    return a_smoothed
+
+
+def smooth_trace(a_trace, params=None):
+    '''The [distances, levels] trace with its levels smoothed by the filter and
+    window_len of params, the trace itself when they ask for no smoothing. A
+    window_len of None needs the FxdParams of the file, see resolve_params, so
+    the trace is not smoothed.'''
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    a_trace = np.asarray(a_trace)
+    if params["window_len"] is None or params["window_len"] < 2:
+        return a_trace
+    return np.array([a_trace[0], smooth_levels(a_trace[1], params["window_len"], params["filter"])])
+
+
+def _first_hit(a_values, limit, above):
+    '''The first index with a value above limit, or at most limit when above is
+    False, looking at a stretch four times longer each time as the nearest is
+    usually close'''
+    start, step = 0, 64
+    while start < len(a_values):
+        a_part = a_values[start:start + step]
+        a_hits = np.flatnonzero(a_part > limit if above else a_part <= limit)
+        if len(a_hits):
+            return start + a_hits[0]
+        start += step
+        step *= 4
+    return None
+
+
+class _AbsDifferential():
+    '''|differentiate_levels(a_levels)|, worked out a chunk at a time from the
+    levels and never held whole.
+
+    scan() goes through the chunks once for the local maxima, keeping the
+    maximum and minimum of every chunk so that later searches for a higher or
+    lower sample skip the chunks that cannot hold one. The last few chunks
+    worked out are kept for the lookups around each peak.'''
+    CACHED_CHUNKS = 4
+
+    def __init__(self, a_levels, chunk=STREAM_CHUNK):
+        self.a_levels = np.asarray(a_levels, dtype=np.float64)
+        self.chunk = chunk
+        self.length = len(self.a_levels)
+        self.count = -(-self.length // chunk)
+        # The last two samples have no usable differential
+        self._usable = max(self.length - 2, 0)
+        self._cache = {}
+        self.a_max = np.empty(self.count)
+        self.a_min = np.empty(self.count)
+        self.a_min_first = np.empty(self.count, dtype=np.intp)
+        self.a_min_last = np.empty(self.count, dtype=np.intp)
+
+    def window(self, lo, hi):
+        '''The values of positions lo..hi-1'''
+        a_values = np.zeros(hi - lo)
+        end = min(hi, self._usable)
+        if end > lo:
+            np.subtract(self.a_levels[lo + 1:end + 1], self.a_levels[lo:end], out=a_values[:end - lo])
+        return np.abs(a_values, out=a_values)
+
+    def values(self, index):
+        '''The values of chunk index'''
+        a_values = self._cache.get(index)
+        if a_values is None:
+            a_values = self.window(index * self.chunk, min((index + 1) * self.chunk, self.length))
+            if len(self._cache) >= self.CACHED_CHUNKS:
+                del self._cache[next(iter(self._cache))]
+            self._cache[index] = a_values
+        return a_values
+
+    def at(self, position):
+        '''The value at one position'''
+        return self.values(position // self.chunk)[position % self.chunk]
+
+    def scan(self, height=None):
+        '''The local maxima as scipy.signal.find_peaks finds them, a plateau by
+        its middle sample, and their heights, those lower than height dropped'''
+        l_peaks = []
+        l_heights = []
+        # Position and sign of the last change of value seen, a peak is a rise then a fall
+        last_change, last_sign = -1, 0
+        for index, (start, stop) in enumerate(iter_chunks(self.length, self.chunk)):
+            a_values = self.values(index)
+            self.a_max[index] = a_values.max()
+            self.a_min[index] = a_values.min()
+            a_is_min = a_values == self.a_min[index]
+            self.a_min_first[index] = start + np.argmax(a_is_min)
+            self.a_min_last[index] = stop - 1 - np.argmax(a_is_min[::-1])
+            a_next = np.append(a_values[1:], self.at(stop)) if stop < self.length else a_values[1:]
+            a_current = a_values[:len(a_next)]
+            a_steps = (a_next > a_current).astype(np.int8) - (a_next < a_current)
+            a_changes = np.flatnonzero(a_steps)
+            a_positions = np.concatenate(([last_change], a_changes + start))
+            a_signs = np.concatenate(([last_sign], a_steps[a_changes]))
+            a_rises = (a_signs[:-1] > 0) & (a_signs[1:] < 0)
+            a_left = a_positions[:-1][a_rises] + 1
+            a_right = a_positions[1:][a_rises]
+            # A plateau has one value throughout, its right end is in this chunk
+            a_heights = a_values[a_right - start]
+            if height is not None:
+                a_keep = height <= a_heights
+                a_left, a_right, a_heights = a_left[a_keep], a_right[a_keep], a_heights[a_keep]
+            l_peaks.append((a_left + a_right) // 2)
+            l_heights.append(a_heights)
+            if len(a_changes):
+                last_change, last_sign = a_positions[-1], a_signs[-1]
+        if not l_peaks:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+        return np.concatenate(l_peaks).astype(np.intp), np.concatenate(l_heights)
+
+    def find(self, lo, hi, limit, above, last):
+        '''The last, or first, position in lo..hi-1 with a value above limit, or
+        at most limit when above is False, None when there is none'''
+        if lo >= hi:
+            return None
+        first_chunk = lo // self.chunk
+        a_possible = (self.a_max if above else self.a_min)[first_chunk:(hi - 1) // self.chunk + 1]
+        a_indexes = np.flatnonzero(a_possible > limit if above else a_possible <= limit) + first_chunk
+        for index in (a_indexes[::-1] if last else a_indexes):
+            start = index * self.chunk
+            offset = max(lo - start, 0)
+            a_values = self.values(index)[offset:hi - start]
+            hit = _first_hit(a_values[::-1] if last else a_values, limit, above)
+            if hit is not None:
+                return start + offset + (len(a_values) - 1 - hit if last else hit)
+        return None
+
+    def minimum(self, lo, hi, last):
+        '''The smallest value in lo..hi-1, and its last, or first, position'''
+        first_chunk, last_chunk = lo // self.chunk, (hi - 1) // self.chunk
+        l_candidates = []
+        for index in sorted({first_chunk, last_chunk}):
+            start = index * self.chunk
+            offset = max(lo - start, 0)
+            a_values = self.values(index)[offset:hi - start]
+            position = len(a_values) - 1 - np.argmin(a_values[::-1]) if last else np.argmin(a_values)
+            l_candidates.append((a_values[position], start + offset + position))
+        if last_chunk - first_chunk > 1:
+            a_mins = self.a_min[first_chunk + 1:last_chunk]
+            position = len(a_mins) - 1 - np.argmin(a_mins[::-1]) if last else np.argmin(a_mins)
+            a_positions = self.a_min_last if last else self.a_min_first
+            l_candidates.append((a_mins[position], a_positions[first_chunk + 1 + position]))
+        return min(l_candidates, key=lambda candidate: (candidate[0], -candidate[1] if last else candidate[1]))
+
+    def width(self, peak, rel_height=0.5):
+        '''The width of a peak at rel_height of its prominence, measured as
+        scipy.signal.peak_prominences and peak_widths do'''
+        value = self.at(peak)
+        # The lowest samples either side before a higher one are the bases, the nearest if several
+        higher = self.find(0, peak, value, True, True)
+        left_min, left_base = self.minimum(0 if higher is None else higher + 1, peak + 1, True)
+        higher = self.find(peak + 1, self.length, value, True, False)
+        right_min, right_base = self.minimum(peak, self.length if higher is None else higher, False)
+        height = value - (value - max(left_min, right_min)) * rel_height
+        position = self.find(left_base + 1, peak + 1, height, False, True)
+        position = left_base if position is None else position
+        left_ip = float(position)
+        if self.at(position) < height:
+            left_ip += (height - self.at(position)) / (self.at(position + 1) - self.at(position))
+        position = self.find(peak, right_base, height, False, False)
+        position = right_base if position is None else position
+        right_ip = float(position)
+        if self.at(position) < height:
+            right_ip -= (height - self.at(position)) / (self.at(position - 1) - self.at(position))
+        return right_ip - left_ip
+
+    def widths(self, a_peaks, rel_height=0.5):
+        '''width() of every peak in a_peaks, sorted.
+
+        The peaks of each chunk are measured by scipy in one go, over the chunk
+        and an eighth of a chunk either side. Only peaks with nothing higher
+        between them and the edge of that window, whose bases could lie beyond
+        it, are measured one by one with width().'''
+        # pylint: disable=import-outside-toplevel
+        from scipy.signal import peak_prominences, peak_widths
+        a_widths = np.empty(len(a_peaks))
+        margin = self.chunk // 8
+        a_firsts = np.searchsorted(a_peaks, np.arange(self.count + 1) * self.chunk)
+        for index, (start, stop) in enumerate(iter_chunks(self.length, self.chunk)):
+            first, last = a_firsts[index], a_firsts[index + 1]
+            if first == last:
+                continue
+            lo, hi = max(start - margin, 0), min(stop + margin, self.length)
+            a_window = self.window(lo, hi)
+            a_local = a_peaks[first:last] - lo
+            with warnings.catch_warnings():
+                # Peaks cut short by the window can look flat, they are measured again below
+                warnings.simplefilter('ignore')
+                a_prominences, a_left, a_right = peak_prominences(a_window, a_local)
+                _, a_heights, a_left_ip, a_right_ip = peak_widths(a_window, a_local, rel_height,
+                                                                   (a_prominences, a_left, a_right))
+            # The interpolated positions are relative to the window, redo the sums at the
+            # real positions so the widths round exactly as over the whole trace
+            a_low = np.floor(a_left_ip).astype(np.intp)
+            a_low -= (a_low > a_left) & (a_window[a_low] > a_heights)
+            a_high = np.ceil(a_right_ip).astype(np.intp)
+            a_high += (a_high < a_right) & (a_window[a_high] > a_heights)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                a_left_ip = (a_low + lo).astype(np.float64) + np.where(
+                    a_window[a_low] < a_heights,
+                    (a_heights - a_window[a_low]) / (a_window[np.minimum(a_low + 1, len(a_window) - 1)] - a_window[a_low]),
+                    0.0)
+                a_right_ip = (a_high + lo).astype(np.float64) - np.where(
+                    a_window[a_high] < a_heights,
+                    (a_heights - a_window[a_high]) / (a_window[np.maximum(a_high - 1, 0)] - a_window[a_high]),
+                    0.0)
+            a_widths[first:last] = a_right_ip - a_left_ip
+            # Highest sample before and after every position of the window
+            a_peak_values = a_window[a_local]
+            a_before = np.maximum.accumulate(a_window)[np.maximum(a_local - 1, 0)]
+            a_after = np.maximum.accumulate(a_window[::-1])[::-1][np.minimum(a_local + 1, len(a_window) - 1)]
+            a_clipped = (lo > 0) & ((a_local == 0) | (a_before <= a_peak_values))
+            a_clipped |= (hi < self.length) & ((a_local == len(a_window) - 1) | (a_after <= a_peak_values))
+            for position in np.flatnonzero(a_clipped):
+                a_widths[first + position] = self.width(a_peaks[first + position], rel_height)
+        return a_widths
+
+
+def _select_by_distance(a_peaks, a_heights, distance):
+    '''scipy.signal.find_peaks' distance condition: the highest peaks first,
+    each dropping the peaks closer than distance to it'''
+    distance = np.ceil(distance)
+    a_keep = np.ones(len(a_peaks), dtype=bool)
+    a_low = np.searchsorted(a_peaks, a_peaks - distance, side='right')
+    a_high = np.searchsorted(a_peaks, a_peaks + distance, side='left')
+    a_order = np.argsort(a_heights)[::-1]
+    # Peaks with no other peak that close are kept and drop nothing
+    a_order = a_order[(a_high - a_low)[a_order] > 1]
+    l_low, l_high = a_low.tolist(), a_high.tolist()
+    for position in a_order.tolist():
+        if a_keep[position]:
+            a_keep[l_low[position]:position] = False
+            a_keep[position + 1:l_high[position]] = False
+    return a_keep
+
+
+def detect_edges(a_trace, params=None, chunk=STREAM_CHUNK, threshold=STREAM_THRESHOLD):
+    '''find_edges(differentiate_data(a_trace), params), and for traces longer
+    than threshold samples without the full length differential and its
+    absolute copy, so the memory needed on top of the trace is a few chunks
+    whatever its length.
+
+    The chunked search follows scipy.signal.find_peaks step by step, height,
+    distance, prominence and width, and finds exactly the same features. The
+    height, width and distance parameters are single numbers or None. Traces
+    of no more than threshold samples, or one chunk, go through find_edges as
+    they are.'''
+    a_raw_trace = np.asarray(a_trace)
+    if a_raw_trace.shape[-1] <= max(chunk, threshold):
+        return find_edges(differentiate_data(a_raw_trace), params)
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    height, width, distance = params["height"], params["width"], params["distance"]
+    if distance is not None and distance < 1:
+        raise ValueError('`distance` must be greater or equal to 1')
+    with span("detect", samples=a_raw_trace.shape[-1]):
+        differential = _AbsDifferential(a_raw_trace[1], chunk)
+        a_peaks, a_heights = differential.scan(height)
+        if distance is not None:
+            a_peaks = a_peaks[_select_by_distance(a_peaks, a_heights, distance)]
+        if width is not None:
+            a_peaks = a_peaks[width <= differential.widths(a_peaks)]
+    return [a_peaks,
+            a_raw_trace[0][a_peaks],
+            a_raw_trace[1][a_peaks]]
+
+
+def common_grid(l_traces, spacing=None, extent='overlap'):
+    '''An evenly spaced distance grid for a set of [distances, levels] traces.
+
+    The spacing defaults to the finest one among the traces. extent is
+    'overlap' for the distances every trace covers, or 'union' for the
+    distances any trace covers.'''
+    l_distances = [np.asarray(a_trace[0], dtype=np.float64) for a_trace in l_traces if len(a_trace[0])]
+    if not l_distances:
+        return np.empty(0)
+    a_starts = np.array([a_distances[0] for a_distances in l_distances])
+    a_stops = np.array([a_distances[-1] for a_distances in l_distances])
+    if spacing is None:
+        spacing = min((a_stop - a_start) / max(len(a_distances) - 1, 1)
+                      for a_start, a_stop, a_distances in zip(a_starts, a_stops, l_distances))
+    if extent == 'union':
+        start, stop = a_starts.min(), a_stops.max()
+    elif extent == 'overlap':
+        start, stop = a_starts.max(), a_stops.min()
+    else:
+        raise ValueError("extent must be 'overlap' or 'union', not {!r}".format(extent))
+    if stop < start or spacing <= 0:
+        return np.empty(0)
+    # The small allowance keeps a stop that is a whole number of steps away on the grid
+    return start + np.arange(int(np.floor((stop - start) / spacing + 1e-9)) + 1) * spacing
+
+
+def resample_traces(l_traces, a_grid=None, fill=np.nan):
+    '''Linearly interpolate the levels of N traces onto one distance grid.
+
+    Returns (a_grid, a_levels) where a_levels is (traces x samples), ready for
+    find_edges_batch or for averaging and differencing along axis 0. Grid
+    points outside a trace are set to fill. a_grid defaults to common_grid().
+
+    The samples of all traces are placed on the grid with a single binary
+    search, the sample at or before every grid point is then gathered with
+    the slope to the next one for all traces at once.'''
+    l_traces = [np.asarray(a_trace, dtype=np.float64).reshape(2, -1) for a_trace in l_traces]
+    if a_grid is None:
+        a_grid = common_grid(l_traces)
+    a_grid = np.asarray(a_grid, dtype=np.float64)
+    a_lengths = np.array([a_trace.shape[1] for a_trace in l_traces], dtype=np.intp)
+    total = int(a_lengths.sum())
+    if not total or not len(a_grid):
+        return a_grid, np.full((len(l_traces), len(a_grid)), fill, dtype=np.float64)
+    with span("resample", traces=len(l_traces), samples=len(a_grid)):
+        a_distances = np.concatenate([a_trace[0] for a_trace in l_traces])
+        a_values = np.concatenate([a_trace[1] for a_trace in l_traces])
+        a_lasts = np.cumsum(a_lengths) - 1
+        a_slopes = np.zeros(total)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(np.diff(a_values), np.diff(a_distances), out=a_slopes[:-1])
+        # Nothing follows the last sample of a trace, a grid point on it takes its level
+        a_slopes[a_lasts[a_lengths > 0]] = 0
+        columns = len(a_grid) + 1
+        # How many samples of each trace lie at or before each grid point
+        a_bins = np.repeat(np.arange(len(l_traces)) * columns, a_lengths)
+        a_bins += np.searchsorted(a_grid, a_distances, side='left')
+        a_index = np.bincount(a_bins, minlength=len(l_traces) * columns).reshape(-1, columns)[:, :-1]
+        np.cumsum(a_index, axis=1, out=a_index)
+        a_outside = a_index == 0
+        # The last sample at or before each grid point, as np.interp picks them
+        a_index += (a_lasts - a_lengths)[:, None]
+        np.clip(a_index, 0, total - 1, out=a_index)
+        a_levels = a_grid - a_distances[a_index]
+        a_levels *= a_slopes[a_index]
+        a_levels += a_values[a_index]
+        a_outside |= a_grid > a_distances[np.clip(a_lasts, 0, total - 1)][:, None]
+        a_levels[a_outside] = fill
+    return a_grid, a_levels
+
+
+def loss_and_dispersion(a_grid, a_levels, a_positions, window=LOSS_WINDOW):
+    '''Loss and dispersion of every event over a (traces x samples) stack from resample_traces.
+
+    The levels window samples before and after each event are gathered for
+    all traces and events at once. The loss is the mean drop across the
+    event, the dispersion factor is how much more the traces disagree on one
+    side of it than on the other. Returns {"loss", "dispersion", "start",
+    "end"}, one value per event, start and end being the distances measured
+    between. Events off the grid get NaN.'''
+    a_positions = np.asarray(a_positions, dtype=np.float64)
+    a_grid = np.asarray(a_grid, dtype=np.float64)
+    a_levels = np.atleast_2d(a_levels)
+    d_result = {name: np.full(len(a_positions), np.nan) for name in ("loss", "dispersion", "start", "end")}
+    if not len(a_grid) or not a_levels.size or not len(a_positions):
+        return d_result
+    with span("loss", traces=len(a_levels), events=len(a_positions)):
+        a_inside = (a_positions >= a_grid[0]) & (a_positions <= a_grid[-1])
+        a_index = np.searchsorted(a_grid, a_positions[a_inside])
+        a_start = np.maximum(a_index - window, 0)
+        a_end = np.minimum(a_index + window, len(a_grid) - 1)
+        # traces x events
+        a_start_values = a_levels[:, a_start]
+        a_end_values = a_levels[:, a_end]
+        with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+            # Events no trace covers are all NaN, they stay NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            a_loss = np.nanmean(a_start_values, axis=0) - np.nanmean(a_end_values, axis=0)
+            a_difference_start = np.nanmax(a_start_values, axis=0) - np.nanmin(a_start_values, axis=0)
+            a_difference_end = np.nanmax(a_end_values, axis=0) - np.nanmin(a_end_values, axis=0)
+            a_dispersion = np.round(np.fmax(a_difference_end / a_difference_start,
+                                            a_difference_start / a_difference_end))
+        a_dispersion[(a_difference_start == 0) | (a_difference_end == 0)] = 0
+        d_result["loss"][a_inside] = a_loss
+        d_result["dispersion"][a_inside] = a_dispersion
+        d_result["start"][a_inside] = a_grid[a_start]
+        d_result["end"][a_inside] = a_grid[a_end]
+    return d_result
+
+
+def correlate_positions(a_positions, tolerance=None):
+    '''Cluster feature positions in one sorted sweep.
+
+    A new cluster starts wherever the gap to the next smaller position is
+    more than tolerance, so however the features of one event are spread,
+    it is only split where no trace has a feature for tolerance. Returns the
+    cluster of each position in input order, clusters are numbered by
+    increasing position.'''
+    tolerance = DEFAULT_TOLERANCE if tolerance is None else tolerance
+    a_positions = np.asarray(a_positions, dtype=np.float64)
+    a_order = np.argsort(a_positions, kind='stable')
+    a_labels = np.empty(len(a_positions), dtype=np.intp)
+    a_labels[a_order] = _sweep(a_positions[a_order], tolerance)
+    return a_labels
+
+
+def _sweep(a_sorted_positions, tolerance):
+    '''The cluster labels of already sorted positions'''
+    a_labels = np.zeros(len(a_sorted_positions), dtype=np.intp)
+    np.cumsum(np.diff(a_sorted_positions) > tolerance, out=a_labels[1:])
+    return a_labels
+
+
+class EventSet():
+    '''The correlated events of several traces, updated one trace at a time.
+
+    The features of every trace are kept as parallel arrays sorted by position.
+    Adding a trace only queues its features, they are merged in with a single
+    sort the next time the clusters are read, so adding traces one at a time
+    stays linear. Removing one masks its features out, clusters are then a
+    single sweep over the sorted positions.'''
+    def __init__(self, tolerance=None):
+        self.tolerance = DEFAULT_TOLERANCE if tolerance is None else tolerance
+        self.keys = {}
+        self._ids = {}
+        self._next_id = 0
+        self._positions = np.empty(0)
+        self._indexes = np.empty(0, dtype=np.intp)
+        self._traces = np.empty(0, dtype=np.intp)
+        # (positions, indexes, trace ids) of traces added since the last merge
+        self._pending = []
+        self._clusters = None
+        self._events = None
+
+    def _register(self, trace_key):
+        '''A fresh id for trace_key, dropping what it contributed before'''
+        self.remove(trace_key)
+        trace_id = self._next_id
+        self._next_id += 1
+        self._ids[trace_key] = trace_id
+        self.keys[trace_id] = trace_key
+        return trace_id
+
+    def add(self, trace_key, trace_features):
+        '''Queue the features of one trace, replacing any it contributed before'''
+        trace_id = self._register(trace_key)
+        a_positions = np.asarray(trace_features[1], dtype=np.float64)
+        self._pending.append((a_positions, np.asarray(trace_features[0], dtype=np.intp),
+                              np.full(len(a_positions), trace_id, dtype=np.intp)))
+        self._clusters = self._events = None
+
+    def add_many(self, d_features):
+        '''Merge the features of many traces, {trace_key: trace_features}, with a single sort'''
+        for trace_key, trace_features in d_features.items():
+            self.add(trace_key, trace_features)
+        self._merge()
+
+    def _merge(self):
+        '''Sort the queued features into the position ordered arrays'''
+        if not self._pending:
+            return
+        l_positions, l_indexes, l_traces = zip(*self._pending)
+        self._pending = []
+        a_positions = np.concatenate((self._positions,) + l_positions)
+        # Stable, equal positions keep the order they were added in
+        a_order = np.argsort(a_positions, kind='stable')
+        self._positions = a_positions[a_order]
+        self._indexes = np.concatenate((self._indexes,) + l_indexes)[a_order]
+        self._traces = np.concatenate((self._traces,) + l_traces)[a_order]
+
+    def remove(self, trace_key):
+        '''Take out everything one trace contributed'''
+        trace_id = self._ids.pop(trace_key, None)
+        if trace_id is None:
+            return
+        del self.keys[trace_id]
+        self._merge()
+        a_keep = self._traces != trace_id
+        self._positions = self._positions[a_keep]
+        self._indexes = self._indexes[a_keep]
+        self._traces = self._traces[a_keep]
+        self._clusters = self._events = None
+
+    def clusters(self):
+        '''Cluster membership as parallel arrays in position order: "cluster",
+        "position", "index" and "trace", the trace ids being keys of self.keys'''
+        if self._clusters is None:
+            self._merge()
+            self._clusters = {"cluster": _sweep(self._positions, self.tolerance),
+                              "position": self._positions,
+                              "index": self._indexes,
+                              "trace": self._traces}
+        return self._clusters
+
+    @property
+    def events(self):
+        '''The clusters as {mean position: {"indexes": [...], "traces": {key: [...]}}}'''
+        if self._events is None:
+            self._merge()
+            self._events = self._build_events()
+        return self._events
+
+    def _build_events(self):
+        with span("correlate", features=len(self._positions)):
+            d_clusters = self.clusters()
+            d_events = {}
+            if len(self._positions):
+                a_starts = np.flatnonzero(np.r_[True, np.diff(d_clusters["cluster"]) != 0])
+                a_means = np.add.reduceat(self._positions, a_starts) / np.diff(np.r_[a_starts, len(self._positions)])
+                for position, a_indexes, a_traces in zip(a_means,
+                                                         np.split(self._indexes, a_starts[1:]),
+                                                         np.split(self._traces, a_starts[1:])):
+                    d_traces = {}
+                    for trace_id, index in zip(a_traces.tolist(), a_indexes.tolist()):
+                        d_traces.setdefault(self.keys[trace_id], []).append(index)
+                    d_events[float(position)] = {"indexes": a_indexes.tolist(), "traces": d_traces}
+        return d_events
+
+
+def filter_events(raw_features, tolerance=None):
+    '''Filter the detected features of each trace to make a single set with no duplicates or ghosts'''
+    event_set = EventSet(tolerance)
+    event_set.add_many(dict(enumerate(raw_features)))
+    return event_set.events
+
+
+def analyse_blocks(d_meta, params=None):
+    '''Run the detection pipeline over already parsed blocks'''
+    params = resolve_params(params, get_block(d_meta, 'FxdParams'))
+    d_data = smooth_trace(extract_trace(d_meta), params)
+    features = detect_edges(d_data, params)
+    return {"trace": d_data, "features": features}
+
+
+def summarise(url, d_meta, features):
+    '''A small JSON friendly summary of one trace, features may be None for header only scans'''
+    gen_params = get_block(d_meta, 'GenParams') or {}
+    fxd_params = get_block(d_meta, 'FxdParams') or {}
+    key_events = get_block(d_meta, 'KeyEvents') or {}
+    summary = {"file": url,
+               "cable_id": gen_params.get('cable_id'),
+               "fiber_id": gen_params.get('fiber_id'),
+               "wavelength": fxd_params.get('wavelength'),
+               "date_time": fxd_params.get('date_time'),
+               "number_of_points": fxd_params.get('number_of_data_points'),
+               "key_events": key_events.get('number_of_events', 0)}
+    if features is not None:
+        summary["features"] = [{"index": int(index),
+                                "distance": float(distance),
+                                "level": float(level)}
+                               for index, distance, level in zip(*features)]
+    return summary
+
+
+def analyse_file(url, params=None):
+    '''Parse and analyse a single SOR file, returning its summary'''
+    d_meta = load_blocks(url)
+    d_result = analyse_blocks(d_meta, params)
+    return summarise(url, d_meta, d_result["features"])
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+'''Headless batch analysis of whole directories of .sor files, once or as they arrive'''
+
+import sys
+import os
+import csv
+import glob
+import json
+import time
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import analysis
+import instrument
+import sorfile
+
+
+CSV_FIELDS = ['file', 'cable_id', 'fiber_id', 'wavelength', 'date_time',
+              'number_of_points', 'key_events', 'features', 'feature_distances', 'error']
+
+
+def collect_files(paths):
+    '''Expand directories and globs into a sorted list of SOR files'''
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                for filename in filenames:
+                    if filename.lower().endswith('.sor'):
+                        found.add(os.path.join(root, filename))
+        elif glob.has_magic(path):
+            found.update(match for match in glob.glob(path, recursive=True) if os.path.isfile(match))
+        elif os.path.isfile(path):
+            found.add(path)
+    return sorted(found)
+
+
+def analyse_one(url, params=None):
+    '''Worker entry point, never raises so one bad file cannot stop a batch'''
+    try:
+        return analysis.analyse_file(url, params)
+    except Exception as error: # pylint: disable=broad-except
+        return {"file": url, "error": "{}: {}".format(type(error).__name__, error)}
+
+
+def scan_one(url, _params=None):
+    '''Worker entry point for header only scans'''
+    try:
+        return sorfile.scan_metadata(url)
+    except Exception as error: # pylint: disable=broad-except
+        return {"file": url, "error": "{}: {}".format(type(error).__name__, error)}
+
+
+def traced(worker, url, params=None):
+    '''worker(url, params) and the spans it recorded, for the pool workers of a
+    traced run. The spans go back with the result and merge_spans() adds them
+    to the trace of the main process'''
+    instrument.enable()
+    result = worker(url, params)
+    return result, instrument.take()
+
+
+def merge_spans(results):
+    '''The results of traced() workers, with their spans merged into this process'''
+    for result, l_events in results:
+        instrument.merge(l_events)
+        yield result
+
+
+def _csv_row(result):
+    '''Flatten a trace summary into a single CSV row'''
+    row = {key: result.get(key) for key in CSV_FIELDS}
+    features = result.get('features', [])
+    row['features'] = len(features) if 'features' in result else None
+    row['feature_distances'] = ';'.join('{:.6g}'.format(feature['distance']) for feature in features)
+    return row
+
+
+def run_batch(files, jobs=None, params=None, worker=analyse_one):
+    '''Analyse files in a process pool, yielding each result in input order'''
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        for url in files:
+            yield worker(url, params)
+        return
+    # Hand out several files per task so pickling stays cheap next to parsing
+    chunksize = max(1, min(32, len(files) // (jobs * 4)))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(worker, files, [params] * len(files), chunksize=chunksize)
+
+
+def main(argv=None):
+    '''Command line entry point'''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('paths', nargs='+', help='SOR files, directories or glob patterns')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('-f', '--format', choices=('json', 'csv'), default='json', help='output format')
+    parser.add_argument('-o', '--output', default='-', help='output file (default: stdout)')
+    parser.add_argument('-m', '--metadata-only', action='store_true',
+                        help='only read the header blocks, skipping the samples and detection')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='time the pipeline stages of every worker and write a Chrome trace to FILE')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='keep running, analysing new and changed files as they appear')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between directory scans in watch mode')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='seconds a file must stay unchanged before it is analysed in watch mode')
+    parser.add_argument('--new-only', action='store_true', help='in watch mode, ignore the files already there')
+    parser.add_argument('--window-len', type=int, default=analysis.DEFAULT_PARAMS["window_len"],
+                        help='samples to smooth the levels over before detection, 0 for none '
+                             '(default: {} us worth at each file\'s sample spacing)'.format(analysis.SMOOTHING_US))
+    parser.add_argument('--filter', choices=analysis.FILTERS, default=analysis.DEFAULT_PARAMS["filter"],
+                        help='smoothing filter')
+    args = parser.parse_args(argv)
+    params = {"window_len": args.window_len, "filter": args.filter}
+    if args.trace:
+        instrument.enable()
+
+    worker = scan_one if args.metadata_only else analyse_one
+    if args.trace:
+        worker = functools.partial(traced, worker)
+    if args.watch:
+        from watch import watch # pylint: disable=import-outside-toplevel,cyclic-import
+        results = watch(args.paths, worker, args.jobs, params, interval=args.interval, settle=args.settle,
+                        skip_existing=args.new_only)
+    else:
+        files = collect_files(args.paths)
+        if not files:
+            print("no .sor files found", file=sys.stderr)
+            return 1
+        results = run_batch(files, args.jobs, params, worker=worker)
+    if args.trace:
+        results = merge_spans(results)
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    writer = None
+    if args.format == 'csv':
+        writer = csv.DictWriter(output, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+    analysed = failures = 0
+    start = time.perf_counter()
+    try:
+        for result in results:
+            analysed += 1
+            failures += 'error' in result
+            if writer:
+                writer.writerow(_csv_row(result))
+            else:
+                output.write(json.dumps(result) + "\n")
+            output.flush()
+    except KeyboardInterrupt:
+        # The way out of watch mode
+        pass
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    print("analysed {} files ({} failed) in {:.2f}s: {:.1f} files/sec".format(
+        analysed, failures, elapsed, analysed / elapsed if elapsed else float('inf')), file=sys.stderr)
+    instrument.finish(args.trace)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+'''Per trace latency of the derivative and edge detection stage'''
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+from scipy.signal import find_peaks
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import analysis # pylint: disable=wrong-import-position
+
+
+SIZES = (16384, 65536, 262144)
+
+
+def synthetic_trace(samples, seed=0):
+    '''A [distances, levels] trace with a few splices on a sloping backscatter'''
+    rng = np.random.default_rng(seed)
+    a_distances = np.arange(samples) * 2.0
+    a_levels = -np.linspace(0, samples * 0.0002, samples)
+    for position, drop in ((0.2, 0.5), (0.45, 0.3), (0.7, 1.0)):
+        start = int(samples * position)
+        a_levels[start:] -= drop * np.clip(np.arange(samples - start) / 20.0, 0, 1)
+    a_levels += rng.normal(0, 0.0003, samples)
+    return np.array([a_distances, a_levels])
+
+
+def legacy_detect(a_trace):
+    '''The original per sample list implementation, kept as the baseline'''
+    a_diff_trace = np.diff(a_trace[1])
+    a_clean_trace = []
+    for sample_index in range(len(a_trace[1])):
+        if sample_index < len(a_diff_trace)-1:
+            a_clean_trace.append(a_diff_trace[sample_index])
+        else:
+            a_clean_trace.append(0)
+    a_abs_trace = [abs(sample) for sample in a_clean_trace]
+    a_peaks = find_peaks(a_abs_trace, 0.00125, width=5, distance=150)
+    return [a_peaks[0],
+            [a_trace[0][peak] for peak in a_peaks[0]],
+            [a_trace[1][peak] for peak in a_peaks[0]]]
+
+
+def best_of(function, repeat):
+    '''The fastest of several runs, in seconds'''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(sizes=SIZES, batch=32, repeat=5):
+    '''Time the legacy, vectorised and batched detection for each trace size'''
+    results = []
+    for samples in sizes:
+        a_trace = synthetic_trace(samples)
+        a_batch = np.array([synthetic_trace(samples, seed)[1] for seed in range(batch)])
+        expected = legacy_detect(a_trace)[0]
+        found = analysis.find_edges(analysis.differentiate_data(a_trace))[0]
+        assert np.array_equal(expected, found), "vectorised detection differs from the baseline"
+        legacy = best_of(lambda: legacy_detect(a_trace), repeat)
+        vectorised = best_of(lambda: analysis.find_edges(analysis.differentiate_data(a_trace)), repeat)
+        batched = best_of(lambda: analysis.find_edges_batch(a_trace[0], a_batch), repeat) / batch
+        results.append({"samples": samples,
+                        "legacy_ms": legacy * 1000,
+                        "vectorised_ms": vectorised * 1000,
+                        "batched_ms": batched * 1000})
+    return results
+
+
+def main(argv=None):
+    '''Command line entry point'''
+    parser = argparse.ArgumentParser(description='Per trace latency of the detection stage')
+    parser.add_argument('--batch', type=int, default=32, help='traces per batch')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the best is kept')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+    results = run(batch=args.batch, repeat=args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+    print("{:>8} {:>12} {:>14} {:>12}".format("samples", "legacy ms", "vectorised ms", "batched ms"))
+    for result in results:
+        print("{samples:>8} {legacy_ms:>12.2f} {vectorised_ms:>14.2f} {batched_ms:>12.2f}".format(**result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+'''Time every stage of the OpenOTDR pipeline on synthetic SOR files.
+
+Runs headless with the offscreen Qt platform and prints JSON, one record per
+trace size, so results can be compared between releases.'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+# Before Qt is imported, CI boxes have no display
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+import otdrparser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import analysis # pylint: disable=wrong-import-position
+import synthetic_sor # pylint: disable=wrong-import-position
+
+
+SIZES = (16384, 262144)
+EVENTS = 64
+
+
+def best_of(function, repeat, setup=None):
+    '''The fastest of several runs in milliseconds, setup() runs untimed before each one'''
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def _parse(url):
+    with open(url, 'rb') as fp:
+        return otdrparser.parse(fp)
+
+
+def run_size(window, directory, samples, events, wavelengths, repeat):
+    '''Time each stage for one fibre with a trace per wavelength'''
+    from workers import load_trace # pylint: disable=import-outside-toplevel
+    paths = synthetic_sor.write_set(directory, 1, samples, events, wavelengths)
+    url = paths[0]
+    a_trace = analysis.extract_trace(analysis.load_blocks(url))
+    a_differential = analysis.differentiate_data(a_trace)
+    timings = {}
+    timings["parse"] = best_of(lambda: _parse(url), repeat)
+    timings["parse_blocks"] = best_of(lambda: analysis.load_blocks(url), repeat)
+
+    # What each loading thread of the window runs per file, from the SOR file and from the cache
+    timings["load"] = best_of(lambda: load_trace(url, window.params, window.cache), repeat, window.cache.clear)
+    timings["load_cached"] = best_of(lambda: load_trace(url, window.params, window.cache), repeat)
+    timings["differentiate_data"] = best_of(lambda: analysis.differentiate_data(a_trace), repeat)
+    timings["find_edges"] = best_of(lambda: analysis.find_edges(a_differential, window.params), repeat)
+
+    window.traces.clear()
+    window.events = analysis.EventSet()
+    window.raw_traces = []
+    window.trace_plot.sync({})
+    for path in paths:
+        window._on_trace_loaded(path, load_trace(path, window.params, window.cache)) # pylint: disable=protected-access
+    raw_features = [d_trace["features"] for d_trace in window.traces.values()]
+    timings["filter_events"] = best_of(lambda: window._filter_events(raw_features), repeat) # pylint: disable=protected-access
+    window.d_meta = window.traces[url]["sor_file"].metadata()
+    meta_rows = analysis.extract_meta(window.d_meta)
+
+    def populate_tables():
+        window.meta_model.set_rows(meta_rows)
+        window._update_events_table() # pylint: disable=protected-access
+
+    timings["table_population"] = best_of(populate_tables, repeat)
+
+    def draw():
+        window._draw() # pylint: disable=protected-access
+        window.canvas.draw()
+
+    timings["draw"] = best_of(draw, repeat, lambda: window.trace_plot.sync({}))
+    return {"samples": samples,
+            "events": events,
+            "wavelengths": list(wavelengths),
+            "ms": timings}
+
+
+def environment():
+    '''What the numbers were measured on'''
+    import scipy # pylint: disable=import-outside-toplevel
+    import matplotlib # pylint: disable=import-outside-toplevel
+    from PyQt6 import QtCore # pylint: disable=import-outside-toplevel
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "matplotlib": matplotlib.__version__,
+            "qt": QtCore.QT_VERSION_STR}
+
+
+def run(sizes=SIZES, events=EVENTS, wavelengths=synthetic_sor.WAVELENGTHS, repeat=3):
+    '''Time every stage for each trace size, in a throwaway directory and cache'''
+    directory = tempfile.mkdtemp(prefix='openotdr-bench-')
+    os.environ["OPENOTDR_CACHE_DIR"] = os.path.join(directory, "cache")
+    try:
+        from PyQt6 import QtWidgets # pylint: disable=import-outside-toplevel
+        import OpenOTDR # pylint: disable=import-outside-toplevel
+        application = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+        window = OpenOTDR.MainWindow()
+        # The window only builds its plot when the first trace is drawn, build it up front so draws time alike
+        window._setup_plot() # pylint: disable=protected-access
+        results = [run_size(window, os.path.join(directory, str(samples)), samples, events, wavelengths, repeat)
+                   for samples in sizes]
+        window.close()
+        application.processEvents()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {"environment": environment(), "repeat": repeat, "results": results}
+
+
+def main(argv=None):
+    '''Command line entry point'''
+    parser = argparse.ArgumentParser(description='Time every stage of the pipeline on synthetic SOR files')
+    parser.add_argument('-s', '--samples', type=int, nargs='+', default=list(SIZES), help='samples per trace')
+    parser.add_argument('-e', '--events', type=int, default=EVENTS, help='KeyEvents per trace')
+    parser.add_argument('-w', '--wavelengths', type=int, nargs='+', default=list(synthetic_sor.WAVELENGTHS),
+                        help='wavelengths in nm, one trace per wavelength')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best is kept')
+    parser.add_argument('-o', '--output', help='write the JSON here instead of stdout')
+    args = parser.parse_args(argv)
+    report = run(args.samples, args.events, args.wavelengths, args.repeat)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+'''Latency of the cursor readout as the mouse moves over many long traces'''
+
+import os
+import sys
+import json
+import time
+import argparse
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np # pylint: disable=wrong-import-position
+from PyQt6 import QtWidgets # pylint: disable=wrong-import-position
+from matplotlib.figure import Figure # pylint: disable=wrong-import-position
+from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas # pylint: disable=wrong-import-position
+from matplotlib.backend_bases import MouseEvent # pylint: disable=wrong-import-position
+
+from bench_detection import synthetic_trace # pylint: disable=wrong-import-position
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from plotting import TracePlot, CursorReadout # pylint: disable=wrong-import-position
+
+
+def run(traces=40, samples=262144, moves=200):
+    '''Move the mouse across a plot of traces traces, timing each readout update'''
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([]) # pylint: disable=unused-variable
+    fig = Figure()
+    axes = fig.add_subplot(1, 1, 1)
+    canvas = FigureCanvas(fig)
+    canvas.resize(1200, 700)
+    trace_plot = TracePlot(axes)
+    # The canvas only holds its callbacks weakly, keep the readout alive for the run
+    readout = CursorReadout(trace_plot) # pylint: disable=unused-variable
+    trace_plot.sync({index: (synthetic_trace(samples, seed=index), {"label": "trace {}".format(index)})
+                     for index in range(traces)})
+    draws = []
+    canvas.mpl_connect('draw_event', lambda _event: draws.append(1))
+    canvas.draw()
+    x_min, x_max = axes.get_xlim()
+    y_mid = sum(axes.get_ylim()) / 2
+    times = []
+    for move in range(moves):
+        x, y = axes.transData.transform((x_min + (x_max - x_min) * (move + 0.5) / moves, y_mid))
+        start = time.perf_counter()
+        MouseEvent('motion_notify_event', canvas, x, y)._process() # pylint: disable=protected-access
+        times.append(time.perf_counter() - start)
+    a_ms = np.array(times) * 1000
+    return {"traces": traces, "samples": samples, "moves": moves,
+            "median_ms": float(np.median(a_ms)), "p99_ms": float(np.percentile(a_ms, 99)),
+            "max_ms": float(a_ms.max()), "full_draws": len(draws) - 1}
+
+
+def main(argv=None):
+    '''Command line entry point'''
+    parser = argparse.ArgumentParser(description='Latency of the cursor readout')
+    parser.add_argument('-t', '--traces', type=int, default=40, help='traces on the plot')
+    parser.add_argument('-s', '--samples', type=int, default=262144, help='samples per trace')
+    parser.add_argument('-m', '--moves', type=int, default=200, help='mouse moves to time')
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.traces, args.samples, args.moves), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+'''Time how long OpenOTDR and the headless tools take to start.
+
+Every measurement runs in a fresh interpreter so nothing is imported or cached
+already, and also lists which of the heavy modules a plain start pulled in.
+Prints JSON, and exits non-zero when the main window takes longer than
+--budget-ms to show, so an eager import creeping back in gets noticed.'''
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+from bench_pipeline import environment
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# (module, whether it has a MainWindow to show)
+MODULES = (('OpenOTDR', True), ('batch', False), ('report', False), ('traceindex', False),
+           ('service', False), ('analysis', False))
+# Only imported once a feature needs them
+HEAVY = ('scipy.signal', 'matplotlib.figure', 'matplotlib.backends.backend_qtagg', 'matplotlib.backends.backend_pdf')
+
+PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+shown = None
+if {window}:
+    from PyQt6 import QtWidgets
+    application = QtWidgets.QApplication(sys.argv[:1])
+    window = {module}.MainWindow()
+    window.show()
+    application.processEvents()
+    shown = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - start) * 1000,
+                  "window_ms": None if shown is None else (shown - start) * 1000,
+                  "heavy": sorted(name for name in {heavy!r} if name in sys.modules)}}))
+'''
+
+
+def probe(module, window):
+    '''Start a fresh interpreter, import module and show its window'''
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get("QT_QPA_PLATFORM", "offscreen"))
+    completed = subprocess.run([sys.executable, '-c', PROBE.format(module=module, window=window, heavy=HEAVY)],
+                               cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run(modules=MODULES, repeat=5):
+    '''The fastest start of each module over repeat fresh interpreters'''
+    results = {}
+    for module, window in modules:
+        runs = [probe(module, window) for _ in range(repeat)]
+        results[module] = {"import_ms": min(result["import_ms"] for result in runs),
+                           "window_ms": min(result["window_ms"] for result in runs) if window else None,
+                           "heavy": runs[-1]["heavy"]}
+    return {"environment": environment(), "repeat": repeat, "results": results}
+
+
+def main(argv=None):
+    '''Command line entry point'''
+    parser = argparse.ArgumentParser(description='Time the start up of OpenOTDR and the headless tools')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per module, the best is kept')
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='fail when the main window takes longer than this to show')
+    parser.add_argument('-o', '--output', help='write the JSON here instead of stdout')
+    args = parser.parse_args(argv)
+    report = run(repeat=args.repeat)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(text + "\n")
+    else:
+        print(text)
+    window_ms = report["results"]["OpenOTDR"]["window_ms"]
+    if args.budget_ms is not None and window_ms > args.budget_ms:
+        print("main window took {:.0f} ms to show, over the {:.0f} ms budget".format(window_ms, args.budget_ms),
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
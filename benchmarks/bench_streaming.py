@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+'''Latency and peak memory of the chunked detection against the full length one'''
+
+import os
+import sys
+import json
+import argparse
+import tracemalloc
+
+import numpy as np
+
+from bench_detection import synthetic_trace, best_of
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import analysis # pylint: disable=wrong-import-position
+
+
+SIZES = (262144, 1048576, 4194304)
+
+
+def peak_memory(function):
+    '''The most memory allocated at once while function runs, in bytes'''
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(sizes=SIZES, chunk=analysis.STREAM_CHUNK, repeat=3):
+    '''Time and measure both detections for each trace size'''
+    results = []
+    for samples in sizes:
+        a_trace = synthetic_trace(samples)
+        def full():
+            return analysis.find_edges(analysis.differentiate_data(a_trace))
+        def streamed():
+            return analysis.detect_edges(a_trace, chunk=chunk, threshold=0)
+        assert all(np.array_equal(expected, found) for expected, found in zip(full(), streamed())), \
+            "chunked detection differs from the full length one"
+        results.append({"samples": samples,
+                        "full_ms": best_of(full, repeat) * 1000,
+                        "streamed_ms": best_of(streamed, repeat) * 1000,
+                        "full_mb": peak_memory(full) / 1e6,
+                        "streamed_mb": peak_memory(streamed) / 1e6})
+    return results
+
+
+def main(argv=None):
+    '''Command line entry point'''
+    parser = argparse.ArgumentParser(description='Latency and peak memory of the chunked detection')
+    parser.add_argument('-s', '--samples', type=int, nargs='+', default=SIZES, help='trace lengths')
+    parser.add_argument('--chunk', type=int, default=analysis.STREAM_CHUNK, help='samples per chunk')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best is kept')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+    results = run(args.samples, args.chunk, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+    print("{:>8} {:>10} {:>12} {:>10} {:>12}".format("samples", "full ms", "streamed ms", "full MB", "streamed MB"))
+    for result in results:
+        print("{samples:>8} {full_ms:>10.1f} {streamed_ms:>12.1f} {full_mb:>10.1f} {streamed_mb:>12.1f}".format(
+            **result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
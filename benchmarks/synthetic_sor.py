@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+'''Synthetic Bellcore/Telcordia SOR files for the benchmarks.
+
+The traces are a sloping backscatter with a ramped drop at every KeyEvent and
+a little noise, written as the version 2 blocks otdrparser reads: Map,
+GenParams, SupParams, FxdParams, DataPts, KeyEvents and Cksum.'''
+
+import os
+import sys
+import struct
+import argparse
+
+import numpy as np
+
+
+WAVELENGTHS = (1310, 1550, 1625)
+# Samples over which an event drops, the detection needs a ramp not a step
+EVENT_RAMP = 20
+# DataPts scaling factor, a level is -sample * SCALING / 1e6 dB
+SCALING = 1000
+# Time of travel per sample for the FxdParams sample spacing below
+TIME_PER_SAMPLE = 100
+
+
+def _string(text):
+    return text.encode() + b"\0"
+
+
+def _gen_params(wavelength, cable_id, fiber_id):
+    return (_string("GenParams") + _string(cable_id) + _string(fiber_id)
+            + struct.pack("<HH", 652, wavelength) + _string("A") + _string("B") + _string("CODE")
+            + b"BC" + struct.pack("<II", 0, 0) + _string("operator") + _string("synthetic"))
+
+
+def _sup_params():
+    return _string("SupParams") + b"".join(_string(field) for field in
+                                           ("OpenOTDR", "Synthetic", "SN0", "Module", "MSN0", "1.0", ""))
+
+
+def _fxd_params(samples, wavelength, pulse_width, date_time):
+    return (_string("FxdParams") + struct.pack("<I", date_time) + b"mt"
+            + struct.pack("<Hii", wavelength * 10, 0, 0)
+            + struct.pack("<HHII", 1, pulse_width, 1000000, samples)
+            + struct.pack("<IHIHIiiHhHHHH", 146800, 800, 1000, 60, 100, 0, 0, 0, 0, 0, 0, 0, 0)
+            + b"ST" + struct.pack("<iiii", 0, 0, 0, 0))
+
+
+def _data_pts(a_raw):
+    return (_string("DataPts") + struct.pack("<IHIH", len(a_raw), 1, len(a_raw), SCALING)
+            + a_raw.astype("<u2").tobytes())
+
+
+def _key_events(l_events):
+    block = _string("KeyEvents") + struct.pack("<H", len(l_events))
+    for number, (index, loss) in enumerate(l_events, 1):
+        block += (struct.pack("<HIhhi", number, index * TIME_PER_SAMPLE, 0, int(loss * 1000), 0)
+                  + b"0F9999LS" + struct.pack("<IIIII", 0, 0, 0, 0, 0) + _string(""))
+    return block + struct.pack("<iiIHiI", 0, 0, 0, 0, 0, 0)
+
+
+def event_positions(samples, events):
+    '''Sample index and loss of each synthetic event, spread evenly along the fibre'''
+    if events <= 0:
+        return []
+    a_indexes = np.linspace(0, samples, events + 2)[1:-1].astype(int)
+    # Keep the total loss inside what the 16 bit samples can hold
+    loss = min(0.5, 20.0 / events)
+    return [(int(index), loss) for index in a_indexes]
+
+
+def synthetic_levels(samples, l_events, seed=0):
+    '''Attenuation in dB per sample, positive and growing along the fibre'''
+    rng = np.random.default_rng(seed)
+    a_levels = np.linspace(0, 10.0, samples)
+    for index, loss in l_events:
+        a_levels[index:] += loss * np.clip(np.arange(samples - index) / EVENT_RAMP, 0, 1)
+    return a_levels + rng.normal(0, 0.0003, samples)
+
+
+def build_sor(samples=16384, events=8, wavelength=1550, seed=0, pulse_width=100, date_time=1700000000,
+              cable_id=None, fiber_id=None):
+    '''The bytes of one SOR file, the cable and fibre ids default to ones made from the seed'''
+    l_events = event_positions(samples, events)
+    a_raw = np.clip(np.rint(synthetic_levels(samples, l_events, seed) * 1e6 / SCALING), 0, 65535)
+    cable_id = "C{}".format(seed) if cable_id is None else cable_id
+    fiber_id = "F{}".format(seed) if fiber_id is None else fiber_id
+    named_blocks = [("GenParams", _gen_params(wavelength, cable_id, fiber_id)),
+                    ("SupParams", _sup_params()),
+                    ("FxdParams", _fxd_params(samples, wavelength, pulse_width, date_time)),
+                    ("DataPts", _data_pts(a_raw)),
+                    ("KeyEvents", _key_events(l_events)),
+                    ("Cksum", _string("Cksum") + b"\0\0")]
+    entries = b"".join(_string(name) + struct.pack("<HI", 200, len(block)) for name, block in named_blocks)
+    map_length = len(_string("Map")) + struct.calcsize("<HIH") + len(entries)
+    map_block = _string("Map") + struct.pack("<HIH", 200, map_length, len(named_blocks) + 1) + entries
+    return map_block + b"".join(block for _, block in named_blocks)
+
+
+def write_set(directory, count=1, samples=16384, events=8, wavelengths=WAVELENGTHS):
+    '''Write count fibres, one file per wavelength each, and return their paths'''
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for fibre in range(count):
+        for wavelength in wavelengths:
+            path = os.path.join(directory, "fibre{:04d}_{}.sor".format(fibre, wavelength))
+            with open(path, 'wb') as fp:
+                fp.write(build_sor(samples, events, wavelength, seed=fibre * 10000 + wavelength,
+                                   cable_id="C0", fiber_id="F{:04d}".format(fibre)))
+            paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    '''Command line entry point'''
+    parser = argparse.ArgumentParser(description='Write synthetic SOR files')
+    parser.add_argument('directory', help='where to write the files')
+    parser.add_argument('-n', '--count', type=int, default=1, help='number of fibres')
+    parser.add_argument('-s', '--samples', type=int, default=16384, help='samples per trace')
+    parser.add_argument('-e', '--events', type=int, default=8, help='KeyEvents per trace')
+    parser.add_argument('-w', '--wavelengths', type=int, nargs='+', default=list(WAVELENGTHS),
+                        help='wavelengths in nm, one file per wavelength')
+    args = parser.parse_args(argv)
+    paths = write_set(args.directory, args.count, args.samples, args.events, args.wavelengths)
+    print("wrote {} files to {}".format(len(paths), args.directory))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
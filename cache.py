@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+'''Content addressed on-disk cache of analysed traces'''
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+import analysis
+from sorfile import LazySorFile
+
+
+DEFAULT_MAX_BYTES = int(os.environ.get("OPENOTDR_CACHE_MB", "512")) * 1024 * 1024
+
+
+def default_directory():
+    '''$OPENOTDR_CACHE_DIR, or openotdr under the XDG cache directory'''
+    if os.environ.get("OPENOTDR_CACHE_DIR"):
+        return os.environ["OPENOTDR_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "openotdr")
+
+
+def content_hash(url):
+    '''SHA-256 of the file contents'''
+    digest = hashlib.sha256()
+    with open(url, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def params_hash(params):
+    '''A short stable hash of the analysis parameters and the version of the analysis code'''
+    merged = dict(analysis.DEFAULT_PARAMS, **(params or {}))
+    merged["version"] = analysis.ANALYSIS_VERSION
+    return hashlib.sha256(json.dumps(merged, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class TraceCache():
+    '''Decoded traces and their detected features, stored as .npz files named
+    after the SOR content hash and the analysis parameters.
+
+    Entries are touched on every hit and the least recently used ones are
+    removed once the cache grows past max_bytes. Changing the parameters, or
+    analysis.ANALYSIS_VERSION, changes the key, so stale results are never
+    returned and simply age out.'''
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or default_directory()
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self._hashes = {}
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        '''(last use, size, path) of every cache entry'''
+        entries = []
+        with os.scandir(self.directory) as iterator:
+            for entry in iterator:
+                if entry.name.endswith('.npz'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def file_hash(self, url):
+        '''content_hash, only recomputed when the file has changed on disk'''
+        stat = os.stat(url)
+        stamp = (os.path.realpath(url), stat.st_size, stat.st_mtime_ns)
+        if stamp not in self._hashes:
+            self._hashes[stamp] = content_hash(url)
+        return self._hashes[stamp]
+
+    def key(self, url, params=None):
+        '''The cache key of a file analysed with params'''
+        return "{}-{}".format(self.file_hash(url), params_hash(params))
+
+    def get(self, key):
+        '''The cached {"trace", "features"} result, or None'''
+        path = self._path(key)
+        try:
+            with np.load(path) as archive:
+                d_result = {"trace": archive["trace"],
+                            "features": [archive["indexes"], archive["distances"], archive["levels"]]}
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return d_result
+
+    def put(self, key, d_result):
+        '''Store a result, then evict down to the size cap'''
+        path = self._path(key)
+        # Unique per writer, several threads may store the same key at once
+        handle, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(handle, 'wb') as fp:
+            indexes, distances, levels = d_result["features"]
+            np.savez(fp, trace=d_result["trace"], indexes=np.asarray(indexes),
+                     distances=np.asarray(distances), levels=np.asarray(levels))
+        os.replace(temporary, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache fits'''
+        entries = sorted(self._entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+    def clear(self):
+        '''Remove every entry'''
+        for _, _, path in self._entries():
+            os.remove(path)
+        self.size = 0
+
+    def analyse(self, url, params=None, sor_file=None):
+        '''The {"trace", "features"} of a SOR file, from the cache when possible'''
+        sor_file = sor_file or LazySorFile(url)
+        # Keyed on the window actually used, a default one depends on the file
+        params = analysis.resolve_params(params, sor_file.block('FxdParams'))
+        key = self.key(url, params)
+        d_result = self.get(key)
+        if d_result is None:
+            a_trace = analysis.smooth_trace(sor_file.trace, params)
+            # The result holds all that is plotted or analysed, the decoded DataPts need not outlive it
+            sor_file.release_trace()
+            d_result = {"trace": a_trace,
+                        "features": analysis.detect_edges(a_trace, params)}
+            self.put(key, d_result)
+        return d_result
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+'''Named timing spans around the pipeline stages.
+
+Recording is off unless $OPENOTDR_TRACE names an output file or enable() is
+called, for example by the --trace command line option. While it is off,
+span() hands back one shared do-nothing context manager, so the spans can
+stay in the code for good. Recorded spans export to the Chrome trace-event
+format, which chrome://tracing and ui.perfetto.dev open, and to a summary
+table.'''
+
+import os
+import sys
+import json
+import time
+import threading
+
+
+class _NoSpan():
+    '''What span() returns while recording is off'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+_events = []
+_enabled = bool(os.environ.get("OPENOTDR_TRACE"))
+_origin = time.perf_counter_ns()
+
+
+class _Span():
+    '''A recorded span, appended as a complete ("X") trace event when it ends'''
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *_exc_info):
+        end = time.perf_counter_ns()
+        # list.append is atomic, spans may end on worker threads
+        _events.append({"name": self.name,
+                        "ph": "X",
+                        "ts": (self.start - _origin) / 1000,
+                        "dur": (end - self.start) / 1000,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                        "args": self.args})
+        return False
+
+
+def enable(flag=True):
+    '''Start or stop recording spans'''
+    global _enabled # pylint: disable=global-statement
+    _enabled = flag
+
+
+def is_enabled():
+    '''Whether spans are being recorded'''
+    return _enabled
+
+
+def span(name, **args):
+    '''A context manager timing the code inside it as the named span'''
+    if not _enabled:
+        return _NO_SPAN
+    return _Span(name, args)
+
+
+def events():
+    '''The spans recorded so far, as trace events'''
+    return list(_events)
+
+
+def clear():
+    '''Forget the recorded spans'''
+    del _events[:]
+
+
+def take():
+    '''The spans recorded so far, forgetting them. They are timed from the
+    monotonic clock's own origin, so another process can merge() them'''
+    l_events = [dict(event, ts=event["ts"] + _origin / 1000) for event in _events]
+    clear()
+    return l_events
+
+
+def merge(l_events):
+    '''Add the spans another process handed over from take()'''
+    _events.extend(dict(event, ts=event["ts"] - _origin / 1000) for event in l_events)
+
+
+def export_chrome(url):
+    '''Write the recorded spans as Chrome trace-event JSON'''
+    with open(url, 'w') as fp:
+        json.dump({"traceEvents": events(), "displayTimeUnit": "ms"}, fp)
+
+
+def summary():
+    '''(name, count, total ms, mean ms, max ms) per span name, slowest total first'''
+    d_totals = {}
+    for event in events():
+        count, total, longest = d_totals.get(event["name"], (0, 0.0, 0.0))
+        d_totals[event["name"]] = (count + 1, total + event["dur"], max(longest, event["dur"]))
+    rows = [(name, count, total / 1000, total / count / 1000, longest / 1000)
+            for name, (count, total, longest) in d_totals.items()]
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+def format_summary():
+    '''The summary as a text table'''
+    lines = ["{:<16} {:>7} {:>11} {:>10} {:>10}".format("span", "count", "total ms", "mean ms", "max ms")]
+    for row in summary():
+        lines.append("{:<16} {:>7} {:>11.2f} {:>10.2f} {:>10.2f}".format(*row))
+    return "\n".join(lines)
+
+
+def finish(url=None):
+    '''Export the trace to url, or $OPENOTDR_TRACE, and print the summary to stderr'''
+    url = url or os.environ.get("OPENOTDR_TRACE")
+    if not _enabled or not url:
+        return
+    export_chrome(url)
+    print(format_summary(), file=sys.stderr)
+    print("trace written to {}".format(url), file=sys.stderr)
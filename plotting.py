@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+'''A long lived trace plot that decimates each line to the screen resolution'''
+
+import numpy as np
+
+from analysis import METRES_PER_KM, FEET_PER_METRE
+
+
+# Blocks of the min/max pyramid grow by this factor per level
+PYRAMID_FACTOR = 4
+# Wavelengths in nm spread over the false colours, others get the colour of the nearest end
+COLOUR_RANGE = (1250, 1650)
+# Traces listed in the cursor readout, the ones nearest to the mouse first, the rest are counted
+READOUT_ROWS = 6
+
+_wavelength_colours = None
+
+
+def _colour_table():
+    '''"#RRGGBB" of every whole nm in COLOUR_RANGE, built on first use'''
+    global _wavelength_colours # pylint: disable=global-statement
+    if _wavelength_colours is None:
+        from matplotlib import cm, colors # pylint: disable=import-outside-toplevel
+        low, high = COLOUR_RANGE
+        a_rgba = cm.jet_r(colors.Normalize(vmin=low, vmax=high, clip=True)(np.arange(low, high + 1)))
+        _wavelength_colours = ["#{:02X}{:02X}{:02X}".format(int(red*255), int(green*255), int(blue*255))
+                               for red, green, blue, _ in a_rgba]
+    return _wavelength_colours
+
+
+def wavelength_to_rgb(s_wavelength):
+    '''Convert the wavelength to a spectral 'false' colour'''
+    wavelength = int(s_wavelength[:-3])
+    low, high = COLOUR_RANGE
+    return _colour_table()[min(max(wavelength, low), high) - low]
+
+
+class MinMaxEnvelope():
+    '''Min/max pyramid of one trace.
+
+    Level k holds the minimum and maximum level of every block of
+    PYRAMID_FACTOR**(k+1) samples, so any view can be reduced to about two
+    points per pixel without touching more than a few thousand values.'''
+    def __init__(self, a_x, a_y):
+        self.a_x = np.asarray(a_x)
+        self.a_y = np.asarray(a_y)
+        self.levels = []
+        a_low = a_high = self.a_y.astype(np.float32)
+        block = 1
+        while len(a_low) > PYRAMID_FACTOR:
+            block *= PYRAMID_FACTOR
+            usable = len(a_low) - len(a_low) % PYRAMID_FACTOR
+            a_next_low = a_low[:usable].reshape(-1, PYRAMID_FACTOR).min(axis=1)
+            a_next_high = a_high[:usable].reshape(-1, PYRAMID_FACTOR).max(axis=1)
+            if usable < len(a_low):
+                a_next_low = np.append(a_next_low, a_low[usable:].min())
+                a_next_high = np.append(a_next_high, a_high[usable:].max())
+            a_low, a_high = a_next_low, a_next_high
+            self.levels.append((block, a_low, a_high))
+
+    def view(self, x_min, x_max, pixels):
+        '''The (x, y) to draw for the x_min..x_max range on a plot pixels wide'''
+        pixels = max(int(pixels), PYRAMID_FACTOR)
+        start, stop = np.searchsorted(self.a_x, (x_min, x_max))
+        # One sample either side keeps the line running off the edges of the axes
+        start = max(start - 1, 0)
+        stop = min(stop + 1, len(self.a_x))
+        if stop - start <= 2 * pixels:
+            return self.a_x[start:stop], self.a_y[start:stop]
+        for block, a_low, a_high in self.levels:
+            if (stop - start) / block <= 2 * pixels:
+                break
+        first = start // block
+        last = -(-stop // block)
+        a_x = np.repeat(self.a_x[first * block:last * block:block], 2)
+        a_y = np.empty(len(a_x), dtype=a_low.dtype)
+        a_y[0::2] = a_low[first:last]
+        a_y[1::2] = a_high[first:last]
+        return np.append(a_x, self.a_x[stop - 1]), np.append(a_y, self.a_y[stop - 1])
+
+
+class TracePlot():
+    '''Keeps one Line2D per trace on an existing Axes.
+
+    Adding or removing a trace only touches that trace's artist, and every
+    line is re-decimated to the axes' pixel width whenever the view changes.'''
+    def __init__(self, axes):
+        self.axes = axes
+        self.lines = {}
+        self.envelopes = {}
+        self._sources = {}
+        self.spans = None
+        axes.callbacks.connect('xlim_changed', self._on_view_changed)
+        axes.figure.canvas.mpl_connect('resize_event', self._on_view_changed)
+
+    def _pixels(self):
+        return self.axes.get_window_extent().width
+
+    def add(self, key, a_trace, **line_options):
+        '''Plot a [distances, levels] trace as one line'''
+        self._add(key, a_trace, line_options)
+        self._rescale()
+
+    def remove(self, key):
+        '''Take a trace off the plot'''
+        if self._remove(key):
+            self._rescale()
+
+    def sync(self, d_traces):
+        '''Match the plot to {key: (trace, line options)}, adding, replacing and removing only what changed'''
+        changed = False
+        for key in [key for key in self.lines if key not in d_traces]:
+            changed |= self._remove(key)
+        for key, (a_trace, line_options) in d_traces.items():
+            if self._sources.get(key) is not a_trace:
+                self._add(key, a_trace, line_options)
+                changed = True
+        if changed:
+            self._rescale()
+
+    def samples_at(self, x):
+        '''(line, distance, level) of the sample nearest to x on every visible
+        trace that x falls on, a binary search of each trace's distances'''
+        samples = []
+        for key, line in self.lines.items():
+            a_x = self.envelopes[key].a_x
+            if not line.get_visible() or not len(a_x) or not a_x[0] <= x <= a_x[-1]:
+                continue
+            index = min(int(np.searchsorted(a_x, x)), len(a_x) - 1)
+            if index and x - a_x[index - 1] < a_x[index] - x:
+                index -= 1
+            samples.append((line, float(a_x[index]), float(self.envelopes[key].a_y[index])))
+        return samples
+
+    def _add(self, key, a_trace, line_options):
+        self._remove(key)
+        envelope = MinMaxEnvelope(a_trace[0], a_trace[1])
+        x_min, x_max = (a_trace[0][0], a_trace[0][-1]) if len(a_trace[0]) else (0, 0)
+        line, = self.axes.plot(*envelope.view(x_min, x_max, self._pixels()), **line_options)
+        self.lines[key] = line
+        self.envelopes[key] = envelope
+        self._sources[key] = a_trace
+
+    def _remove(self, key):
+        line = self.lines.pop(key, None)
+        if line is None:
+            return False
+        line.remove()
+        del self.envelopes[key]
+        del self._sources[key]
+        return True
+
+    def set_spans(self, a_starts, a_ends, **options):
+        '''Highlight the start..end distance ranges across the full height of the axes.
+
+        All ranges are one PolyCollection, updated in place, rather than an
+        axvspan artist each.'''
+        a_starts = np.asarray(a_starts, dtype=np.float64)
+        a_ends = np.asarray(a_ends, dtype=np.float64)
+        a_keep = ~(np.isnan(a_starts) | np.isnan(a_ends))
+        a_starts, a_ends = a_starts[a_keep], a_ends[a_keep]
+        # x in data, y in axes coordinates, as axvspan does
+        a_verts = np.empty((len(a_starts), 4, 2))
+        a_verts[:, :, 0] = np.column_stack((a_starts, a_starts, a_ends, a_ends))
+        a_verts[:, :, 1] = (0, 1, 1, 0)
+        if self.spans is None:
+            from matplotlib.collections import PolyCollection # pylint: disable=import-outside-toplevel
+            options = dict({"facecolor": 'yellow', "edgecolor": 'none', "alpha": 0.5}, **options)
+            self.spans = PolyCollection(a_verts, transform=self.axes.get_xaxis_transform(), **options)
+            self.axes.add_collection(self.spans, autolim=False)
+        else:
+            self.spans.set_verts(a_verts)
+
+    def _rescale(self):
+        '''Fit the view to the traces and refresh the legend'''
+        self.axes.relim()
+        self.axes.autoscale_view()
+        if self.lines:
+            # One entry per label, a legend row per trace gets slow to draw with many traces
+            d_handles = {}
+            for line in self.lines.values():
+                d_handles.setdefault(line.get_label(), line)
+            self.axes.legend(handles=list(d_handles.values()), loc='upper right')
+        elif self.axes.get_legend():
+            self.axes.get_legend().remove()
+
+    def _on_view_changed(self, _event=None):
+        x_min, x_max = sorted(self.axes.get_xlim())
+        pixels = self._pixels()
+        for key, line in self.lines.items():
+            line.set_data(*self.envelopes[key].view(x_min, x_max, pixels))
+
+
+class CursorReadout():
+    '''Crosshair with the distance and the level of every trace under the mouse.
+
+    The overlay is not part of the axes, it is blitted over a copy of the last
+    full draw, so moving the mouse never redraws the traces.'''
+    def __init__(self, trace_plot):
+        # pylint: disable=import-outside-toplevel
+        from matplotlib.lines import Line2D
+        from matplotlib.text import Annotation
+        # pylint: enable=import-outside-toplevel
+        self.trace_plot = trace_plot
+        axes = trace_plot.axes
+        self.axes = axes
+        self.canvas = axes.figure.canvas
+        self.background = None
+        self.samples = []
+        self.crosshair = Line2D([0, 0], [0, 1], transform=axes.get_xaxis_transform(),
+                                color='red', linewidth=1, visible=False)
+        self.markers = Line2D([], [], transform=axes.transData, linestyle='none', marker='o',
+                              markersize=6, markerfacecolor='none', markeredgecolor='black', visible=False)
+        self.annotation = Annotation("", (0, 0), xycoords=axes.transData, xytext=(12, 12),
+                                     textcoords='offset points', fontsize='small', family='monospace',
+                                     bbox={"boxstyle": 'round', "facecolor": 'white', "alpha": 0.85},
+                                     visible=False)
+        self.artists = (self.crosshair, self.markers, self.annotation)
+        for artist in self.artists:
+            artist.set_figure(axes.figure)
+            artist.set_clip_box(axes.bbox)
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self.canvas.mpl_connect('motion_notify_event', self._on_move)
+        self.canvas.mpl_connect('axes_leave_event', self._on_leave)
+        self.canvas.mpl_connect('figure_leave_event', self._on_leave)
+
+    @staticmethod
+    def format(distance, samples):
+        '''Readout text for the distance in metres, shown in km and ft, and the samples of samples_at'''
+        rows = ["{:.4f} km  {:.1f} ft".format(distance / METRES_PER_KM, distance * FEET_PER_METRE)]
+        rows += ["{}  {:.3f} dB".format(line.get_label(), level) for line, _, level in samples[:READOUT_ROWS]]
+        if len(samples) > READOUT_ROWS:
+            rows.append("and {} more".format(len(samples) - READOUT_ROWS))
+        return "\n".join(rows)
+
+    def update(self, x, y):
+        '''Move the readout to the data position (x, y)'''
+        # Drawing the text is most of the cost of a move, so only the traces nearest to the mouse are listed
+        self.samples = sorted(self.trace_plot.samples_at(x), key=lambda sample: abs(sample[2] - y))
+        self.crosshair.set_xdata([x, x])
+        self.markers.set_data([sample[1] for sample in self.samples], [sample[2] for sample in self.samples])
+        self.annotation.set_text(self.format(x, self.samples))
+        self.annotation.xy = (x, y)
+        # Keep the box inside the axes by putting it on the side with more room
+        x_fraction, y_fraction = self.axes.transAxes.inverted().transform(self.axes.transData.transform((x, y)))
+        self.annotation.set_position((-12 if x_fraction > 0.5 else 12, -12 if y_fraction > 0.5 else 12))
+        self.annotation.set_horizontalalignment('right' if x_fraction > 0.5 else 'left')
+        self.annotation.set_verticalalignment('top' if y_fraction > 0.5 else 'bottom')
+        self._set_visible(True)
+        self._blit()
+
+    def hide(self):
+        '''Take the readout off the plot'''
+        if self.crosshair.get_visible():
+            self._set_visible(False)
+            self._blit()
+
+    def _set_visible(self, visible):
+        for artist in self.artists:
+            artist.set_visible(visible)
+
+    def _draw_overlay(self):
+        if self.crosshair.get_visible():
+            for artist in self.artists:
+                self.axes.draw_artist(artist)
+
+    def _blit(self):
+        if self.background is None:
+            return
+        self.canvas.restore_region(self.background)
+        self._draw_overlay()
+        self.canvas.blit(self.axes.figure.bbox)
+
+    def _on_draw(self, _event):
+        self.background = self.canvas.copy_from_bbox(self.axes.figure.bbox)
+        self._draw_overlay()
+
+    def _on_move(self, event):
+        # The toolbar holds the lock while zooming or panning and draws its own rubber band
+        if event.inaxes is not self.axes or self.canvas.widgetlock.locked():
+            self.hide()
+            return
+        self.update(event.xdata, event.ydata)
+
+    def _on_leave(self, _event):
+        self.hide()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+'''The OpenOTDR project file.
+
+A project file starts with a fixed header holding the magic, the offset and
+the length of a JSON index. The index holds the project meta data and, for
+every trace, its header blocks, the content hash of the SOR file, the analysis
+parameters and where its packed arrays live in the file:
+
+    MAGIC | index offset (u8) | index length (u8) | arrays ... | index
+
+Saving a changed trace appends its arrays and a new index, then points the
+header at the new index, so the rest of the file is never rewritten and a
+crash mid save leaves the previous index intact. The space left behind is
+reclaimed by compact(). Older projects were a single JSON document, those are
+read by read_legacy().'''
+
+import os
+import json
+import struct
+
+import numpy as np
+
+from analysis import extract_meta, extract_trace, get_block, resolve_params, smooth_trace, detect_edges
+
+
+MAGIC = b"OPROBIN1"
+HEADER = struct.Struct("<8sQQ")
+ALIGNMENT = 8
+ARRAY_NAMES = ('trace', 'indexes', 'distances', 'levels')
+
+
+def is_binary(url):
+    '''Whether url is a binary project rather than a legacy JSON one'''
+    with open(url, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def read_legacy(url):
+    '''The meta data of a JSON project and the parsed blocks it holds of each SOR file, {url: d_meta}'''
+    with open(url, "r") as file:
+        content = json.load(file)
+    return content.get("meta", {}), {url: d_file.get("meta", []) for url, d_file in content.get("files", {}).items()}
+
+
+def load_legacy_trace(d_meta, params):
+    '''The record workers.load_trace builds, from the blocks a JSON project holds, DataPts
+    included, for SOR files that have since moved or been deleted'''
+    params = resolve_params(params, get_block(d_meta, 'FxdParams'))
+    a_trace = smooth_trace(extract_trace(d_meta), params)
+    d_header = [block for block in d_meta if block.get('name', None) != 'DataPts']
+    return {"sor_file": None,
+            "meta": d_header,
+            "meta_rows": extract_meta(d_header),
+            "params": params,
+            "trace": a_trace,
+            "features": detect_edges(a_trace, params)}
+
+
+class ProjectFile():
+    '''A binary project, only the index is read when it is opened'''
+    def __init__(self, url):
+        self.url = url
+        with open(url, 'rb') as fp:
+            magic, index_offset, index_length = HEADER.unpack(fp.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("{} is not a binary OpenOTDR project".format(url))
+            fp.seek(index_offset)
+            index = json.loads(fp.read(index_length).decode())
+        self.meta = index.get("meta", {})
+        self.traces = index.get("traces", {})
+
+    @classmethod
+    def create(cls, url, meta=None):
+        '''Start a new, empty project file'''
+        index = json.dumps({"version": 1, "meta": meta or {}, "traces": {}}).encode()
+        with open(url, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, HEADER.size, len(index)))
+            fp.write(index)
+        return cls(url)
+
+    @classmethod
+    def write(cls, url, meta, d_traces):
+        '''A new project of the traces in d_traces, as save() takes them. It is written beside
+        url and only then moved over it, the traces may still be mapped from the file it replaces'''
+        temporary = url + '.tmp'
+        fresh = cls.create(temporary, meta)
+        fresh.save(meta, d_traces)
+        os.replace(temporary, url)
+        fresh.url = url
+        return fresh
+
+    def read_arrays(self, url):
+        '''The packed arrays of one trace'''
+        d_arrays = {}
+        with open(self.url, 'rb') as fp:
+            for name, (offset, dtype, shape) in self.traces[url]["arrays"].items():
+                count = int(np.prod(shape))
+                d_arrays[name] = np.fromfile(fp, dtype=dtype, count=count, offset=offset - fp.tell()).reshape(shape)
+        return d_arrays
+
+    def map_arrays(self, url):
+        '''The packed arrays of one trace, memory mapped read only so nothing is read until they are used'''
+        d_arrays = {}
+        for name, (offset, dtype, shape) in self.traces[url]["arrays"].items():
+            if int(np.prod(shape)):
+                d_arrays[name] = np.memmap(self.url, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+            else:
+                # mmap cannot map an empty range
+                d_arrays[name] = np.empty(shape, dtype=dtype)
+        return d_arrays
+
+    def load_trace(self, url):
+        '''The same record workers.load_trace builds, from the project instead of the SOR file.
+        The arrays are only mapped, their pages are read when the trace is first plotted or analysed'''
+        d_record = self.traces[url]
+        d_arrays = self.map_arrays(url)
+        return {"sor_file": None,
+                "saved": True,
+                "sha256": d_record["sha256"],
+                "meta": d_record["meta"],
+                "meta_rows": extract_meta(d_record["meta"]),
+                "params": d_record["params"],
+                "trace": d_arrays["trace"],
+                "features": [d_arrays["indexes"], d_arrays["distances"], d_arrays["levels"]]}
+
+    def save(self, meta, d_changed, removed=()):
+        '''Append the traces in d_changed, {url: {"meta", "sha256", "params", "trace", "features"}},
+        forget the removed urls and write a new index'''
+        with open(self.url, 'r+b') as fp:
+            fp.seek(0, os.SEEK_END)
+            for url, d_trace in d_changed.items():
+                a_indexes, a_distances, a_levels = d_trace["features"]
+                d_arrays = {}
+                for name, array in zip(ARRAY_NAMES, (d_trace["trace"], a_indexes, a_distances, a_levels)):
+                    array = np.ascontiguousarray(array)
+                    fp.write(b"\0" * (-fp.tell() % ALIGNMENT))
+                    d_arrays[name] = [fp.tell(), array.dtype.str, list(array.shape)]
+                    fp.write(array.tobytes())
+                self.traces[url] = {"meta": d_trace["meta"],
+                                    "sha256": d_trace["sha256"],
+                                    "params": d_trace["params"],
+                                    "arrays": d_arrays}
+            for url in removed:
+                self.traces.pop(url, None)
+            self.meta = meta
+            index = json.dumps({"version": 1, "meta": self.meta, "traces": self.traces}).encode()
+            index_offset = fp.tell()
+            fp.write(index)
+            fp.flush()
+            os.fsync(fp.fileno())
+            # Only now move the header over to the new index
+            fp.seek(0)
+            fp.write(HEADER.pack(MAGIC, index_offset, len(index)))
+
+    def compact(self):
+        '''Rewrite the file without the arrays left behind by earlier saves'''
+        d_traces = {}
+        for url, d_record in self.traces.items():
+            d_arrays = self.read_arrays(url)
+            d_traces[url] = dict(d_record, trace=d_arrays["trace"],
+                                 features=[d_arrays["indexes"], d_arrays["distances"], d_arrays["levels"]])
+        self.traces = ProjectFile.write(self.url, self.meta, d_traces).traces
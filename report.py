@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+'''Per fibre acceptance reports as PDF, rendered without a display.
+
+Every process prepares one A4 figure template, with its axes, titles and
+tables, and each report only changes the data of those artists before the
+pages are saved. Tables are one monospaced text artist each instead of a
+matplotlib Table of cell artists, and text is set in the standard PDF fonts
+so no glyphs are laid out or embedded. Neither Qt nor pyplot is imported,
+so whole directories can be rendered in a process pool:
+
+    python report.py /path/to/campaign -o reports -j 8
+'''
+
+import os
+import re
+import sys
+import time
+import argparse
+
+import numpy as np
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.ticker import FuncFormatter
+from matplotlib.backends.backend_pdf import FigureCanvasPdf, PdfPages
+
+import analysis
+import batch
+from plotting import TracePlot, wavelength_to_rgb
+
+
+# Inches, portrait
+A4 = (8.27, 11.69)
+# Helvetica and Courier from the 14 fonts every PDF reader has, medium is their only weight.
+# The template is built before the weight is set, new axes look it up among the TrueType fonts.
+CORE_FONTS_RC = {'pdf.use14corefonts': True}
+REPORT_RC = dict(CORE_FONTS_RC, **{'font.weight': 'medium'})
+# Rows of each of the two name/value column pairs of the meta data table
+META_ROWS = 25
+# (header, characters, alignment), longer values are cut
+META_COLUMNS = (('field', 28, '<'), ('value', 35, '<'), ('field', 28, '<'), ('value', 35, '<'))
+# Events listed per page
+EVENT_ROWS = 80
+EVENT_COLUMNS = (('#', 4, '>'), ('dist (km)', 10, '>'), ('dist (ft)', 12, '>'), ('type', 15, '<'),
+                 ('splice loss', 11, '>'), ('refl loss', 9, '>'), ('slope', 7, '>'), ('loss', 7, '>'),
+                 ('dispersion', 10, '>'), ('comment', 23, '<'))
+
+_template = None
+
+
+def trace_wavelength(d_meta):
+    '''The wavelength of a trace in nm'''
+    fxd_params = analysis.get_block(d_meta, 'FxdParams') or {}
+    return int(float(fxd_params.get('wavelength') or 1310))
+
+
+def fibre_title(d_meta):
+    '''Cable and fibre of a trace as a report title'''
+    gen_params = analysis.get_block(d_meta, 'GenParams') or {}
+    return "Cable {} fibre {}".format(gen_params.get('cable_id') or '-', gen_params.get('fiber_id') or '-')
+
+
+def _number(value, text_format):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ""
+    return text_format.format(value)
+
+
+def _cut(text, width):
+    text = str(text)
+    return text if len(text) <= width else text[:width - 1] + "~"
+
+
+def format_table(columns, rows):
+    '''Rows of strings as fixed width text under a ruled header'''
+    def line(values):
+        return "  ".join("{:{}{}}".format(_cut(value, width), align, width)
+                         for value, (_, width, align) in zip(values, columns))
+    lines = [line([header for header, _, _ in columns]),
+             "  ".join("-" * width for _, width, _ in columns)]
+    return "\n".join(lines + [line(values) for values in rows])
+
+
+def build_report(title, l_traces, d_meta, window=analysis.LOSS_WINDOW):
+    '''What a report shows: l_traces are (trace, wavelength) pairs, d_meta the
+    parsed blocks whose meta data and KeyEvents are listed'''
+    key_events = analysis.get_block(d_meta, 'KeyEvents') or {}
+    events = key_events.get('events', [])
+    a_positions = [float(event.get('distance_of_travel') or 0) for event in events]
+    a_grid, a_levels = analysis.resample_traces([a_trace for a_trace, _ in l_traces],
+                                                analysis.common_grid([a_trace for a_trace, _ in l_traces],
+                                                                     extent='union'))
+    d_measured = analysis.loss_and_dispersion(a_grid, a_levels, a_positions, window)
+    event_rows = []
+    for number, (event, position) in enumerate(zip(events, a_positions), 1):
+        event_rows.append((str(event.get('event_number', number)),
+                           _number(position / analysis.METRES_PER_KM, "{:.4f}"),
+                           _number(position * analysis.FEET_PER_METRE, "{:.1f}"),
+                           event.get('event_type_details', {}).get('event', ''),
+                           _number(event.get('splice_loss'), "{:.3f}"),
+                           _number(event.get('reflection_loss'), "{:.3f}"),
+                           _number(event.get('slope'), "{:.3f}"),
+                           _number(d_measured["loss"][number - 1], "{:.3f}"),
+                           _number(d_measured["dispersion"][number - 1], "{:.4g}"),
+                           event.get('comment') or ''))
+    return {"title": title,
+            "traces": l_traces,
+            "meta": analysis.extract_meta(d_meta),
+            "events": event_rows,
+            "start": d_measured["start"],
+            "end": d_measured["end"]}
+
+
+class ReportTemplate():
+    '''The prepared pages of a report: the trace plot with the meta data, and
+    the events table, which continues over as many pages as needed'''
+    def __init__(self):
+        self.plot_page = Figure(figsize=A4)
+        FigureCanvasPdf(self.plot_page)
+        self.title = self.plot_page.suptitle("", fontsize=14, weight='medium')
+        axes = self.plot_page.add_axes((0.1, 0.56, 0.85, 0.38))
+        axes.set_xlabel("Distance (km)", weight='medium')
+        # The traces are in metres
+        axes.xaxis.set_major_formatter(FuncFormatter(lambda x, _: "{:g}".format(x / analysis.METRES_PER_KM)))
+        axes.set_ylabel("Level (dB)", weight='medium')
+        axes.grid(True)
+        # Later ticks copy the first one's font
+        for label in axes.get_xticklabels() + axes.get_yticklabels():
+            label.set_weight('medium')
+        self.trace_plot = TracePlot(axes)
+        self.meta_table = self.plot_page.text(0.04, 0.48, "", family='monospace', fontsize=6.5, va='top',
+                                              weight='medium')
+        self.events_page = Figure(figsize=A4)
+        FigureCanvasPdf(self.events_page)
+        self.events_title = self.events_page.suptitle("", fontsize=12, weight='medium')
+        self.events_table = self.events_page.text(0.04, 0.94, "", family='monospace', fontsize=7, va='top',
+                                                  weight='medium')
+
+    def render(self, d_report, url):
+        '''Write d_report, from build_report, to the PDF file url'''
+        self.title.set_text(d_report["title"])
+        self.trace_plot.sync({index: (a_trace, {"label": "{} nm".format(wavelength),
+                                                "color": wavelength_to_rgb("{} nm".format(wavelength))})
+                              for index, (a_trace, wavelength) in enumerate(d_report["traces"])})
+        self.trace_plot.set_spans(d_report["start"], d_report["end"])
+        meta = d_report["meta"]
+        self.meta_table.set_text(format_table(META_COLUMNS, [
+            meta[row] + (meta[row + META_ROWS] if row + META_ROWS < len(meta) else ())
+            for row in range(min(len(meta), META_ROWS))]))
+        events = d_report["events"]
+        with PdfPages(url) as pdf:
+            pdf.savefig(self.plot_page)
+            for first in range(0, len(events), EVENT_ROWS):
+                page = events[first:first + EVENT_ROWS]
+                self.events_title.set_text("{}: events {}-{} of {}".format(
+                    d_report["title"], first + 1, first + len(page), len(events)))
+                self.events_table.set_text(format_table(EVENT_COLUMNS, page))
+                pdf.savefig(self.events_page)
+
+
+def render_report(d_report, url):
+    '''Render with this process's template, prepared on first use'''
+    global _template # pylint: disable=global-statement
+    if _template is None:
+        with matplotlib.rc_context(CORE_FONTS_RC):
+            _template = ReportTemplate()
+    with matplotlib.rc_context(REPORT_RC):
+        _template.render(d_report, url)
+
+
+def render_fibre(job, window=None):
+    '''Worker entry point rendering the (url, files) job, never raises so one bad fibre cannot stop a run'''
+    url, files = job
+    try:
+        l_blocks = [analysis.load_blocks(path) for path in files]
+        l_traces = [(analysis.extract_trace(d_meta), trace_wavelength(d_meta)) for d_meta in l_blocks]
+        render_report(build_report(fibre_title(l_blocks[0]), l_traces, l_blocks[0],
+                                   window or analysis.LOSS_WINDOW), url)
+        return {"file": url, "traces": len(files)}
+    except Exception as error: # pylint: disable=broad-except
+        return {"file": url, "error": "{}: {}".format(type(error).__name__, error)}
+
+
+def plan_reports(files, directory, jobs=None):
+    '''One (report url, files) job per fibre, grouping the files by the cable and
+    fibre in their headers, and the header scans that failed'''
+    d_groups = {}
+    failures = []
+    for summary in batch.run_batch(files, jobs, worker=batch.scan_one):
+        if 'error' in summary:
+            failures.append(summary)
+            continue
+        if summary["cable_id"] or summary["fiber_id"]:
+            name = "{}_{}".format(summary["cable_id"] or '', summary["fiber_id"] or '')
+        else:
+            name = os.path.splitext(os.path.basename(summary["file"]))[0]
+        d_groups.setdefault(re.sub(r'[^\w.-]+', '_', name), []).append((summary["wavelength"] or 0, summary["file"]))
+    report_jobs = [(os.path.join(directory, name + ".pdf"), [path for _, path in sorted(members)])
+                   for name, members in sorted(d_groups.items())]
+    return report_jobs, failures
+
+
+def main(argv=None):
+    '''Command line entry point'''
+    parser = argparse.ArgumentParser(description='Render a PDF acceptance report per fibre')
+    parser.add_argument('paths', nargs='+', help='SOR files, directories or glob patterns')
+    parser.add_argument('-o', '--output', default='.', help='directory for the reports (default: current)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--window', type=int, default=analysis.LOSS_WINDOW,
+                        help='grid samples either side of an event its loss is measured across')
+    args = parser.parse_args(argv)
+
+    files = batch.collect_files(args.paths)
+    if not files:
+        print("no .sor files found", file=sys.stderr)
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    start = time.perf_counter()
+    report_jobs, failures = plan_reports(files, args.output, args.jobs)
+    for result in failures:
+        print("{}: {}".format(result["file"], result["error"]), file=sys.stderr)
+    rendered = 0
+    for result in batch.run_batch(report_jobs, args.jobs, args.window, worker=render_fibre):
+        if 'error' in result:
+            failures.append(result)
+            print("{}: {}".format(result["file"], result["error"]), file=sys.stderr)
+        else:
+            rendered += 1
+            print(result["file"])
+    elapsed = time.perf_counter() - start
+    print("rendered {} reports from {} files ({} failed) in {:.2f}s: {:.1f} reports/sec".format(
+        rendered, len(files), len(failures), elapsed, rendered / elapsed if elapsed else float('inf')),
+          file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
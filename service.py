@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+'''A local HTTP service analysing uploaded SOR files, for network management
+systems that want the events without running the desktop application.
+
+    python service.py --port 8650 --jobs 4
+    curl --data-binary @trace.sor "http://127.0.0.1:8650/analyse?window_len=11"
+
+POST /analyse takes one SOR file as the request body, or several as
+multipart/form-data. The files of one request are correlated into one set
+of events, as the window does for the traces of a fibre. The analysis
+parameters height, width, distance, window_len and filter can be given in
+the query string. GET /metrics reports the latency percentiles of the
+analysed uploads, queue depth and batching, and GET /health just answers.
+
+Uploads wait in a bounded queue and get a 503 at once when it is full.
+Whenever a worker is free, the uploads that queued up meanwhile are handed
+to the process pool as one batch, so batches grow with the load and no more
+than one per worker is ever in flight. Only asyncio, the standard library
+and the analysis modules are imported, never Qt.'''
+
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import multiprocessing
+import email.parser
+import email.policy
+import urllib.parse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import analysis
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8650
+# Uploads waiting for a worker before new ones are turned away
+QUEUE_SIZE = 64
+# Uploads handed to a worker in one go
+BATCH_SIZE = 8
+# Seconds a batch waits for more uploads when a worker is free and the queue ran dry
+BATCH_WAIT = 0.005
+MAX_CONNECTIONS = 128
+MAX_BODY = 64 << 20
+# Latest analysed uploads the latency percentiles are taken over
+LATENCY_WINDOW = 1024
+PERCENTILES = (50, 90, 99)
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 422: "Unprocessable Entity", 431: "Request Header Fields Too Large",
+           500: "Internal Server Error", 501: "Not Implemented", 503: "Service Unavailable"}
+
+
+class HttpError(Exception):
+    '''A request answered with an error status, the connection is closed after it'''
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+
+
+def parse_params(query):
+    '''Analysis parameters from a parsed query string, typed as DEFAULT_PARAMS are'''
+    params = {}
+    for key, values in query.items():
+        if key == 'name':
+            continue
+        if key not in analysis.DEFAULT_PARAMS:
+            raise HttpError(400, "unknown parameter {!r}".format(key))
+        try:
+            if isinstance(analysis.DEFAULT_PARAMS[key], str):
+                params[key] = values[-1]
+            else:
+                params[key] = int(values[-1]) if key == 'window_len' else float(values[-1])
+        except ValueError:
+            raise HttpError(400, "{} must be a number".format(key)) from None
+    if params.get('filter', analysis.DEFAULT_PARAMS['filter']) not in analysis.FILTERS:
+        raise HttpError(400, "filter must be one of {}".format(', '.join(analysis.FILTERS)))
+    return params
+
+
+def parse_uploads(content_type, body, name="upload.sor"):
+    '''[(name, SOR bytes)] of a request body, either one raw file or the parts
+    of a multipart/form-data upload'''
+    if not content_type.lower().startswith('multipart/'):
+        return [(name, body)]
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode('latin-1') + b"\r\n\r\n" + body)
+    if not message.is_multipart():
+        raise HttpError(400, "malformed multipart body")
+    uploads = []
+    for number, part in enumerate(message.iter_parts(), 1):
+        part_name = part.get_filename() or part.get_param('name', header='content-disposition')
+        uploads.append((part_name or "file{}".format(number), part.get_payload(decode=True) or b""))
+    if not uploads:
+        raise HttpError(400, "no files in the upload")
+    return uploads
+
+
+class UploadReader(io.BytesIO):
+    '''An uploaded file for analysis.parse_blocks. otdrparser reads strings a
+    byte at a time until a NUL, so reading past the end of a truncated or
+    bogus upload raises instead of spinning forever.'''
+    def read(self, size=-1):
+        data = super(UploadReader, self).read(size)
+        if not data and size is not None and size > 0:
+            raise EOFError("the upload ends before its SOR blocks do")
+        return data
+
+
+def analyse_upload(job):
+    '''Worker entry point: the summaries and correlated events of one upload,
+    job being (uploads, params, tolerance). Never raises so one bad upload
+    cannot fail the rest of its batch.'''
+    uploads, params, tolerance = job
+    try:
+        summaries = []
+        d_features = {}
+        for name, data in uploads:
+            while name in d_features:
+                name += "'"
+            d_meta = analysis.parse_blocks(UploadReader(data))
+            d_features[name] = analysis.analyse_blocks(d_meta, params)["features"]
+            summaries.append(analysis.summarise(name, d_meta, d_features[name]))
+        event_set = analysis.EventSet(tolerance)
+        event_set.add_many(d_features)
+        return {"files": summaries,
+                "events": [{"distance": position, "traces": d_event["traces"]}
+                           for position, d_event in sorted(event_set.events.items())]}
+    except Exception as error: # pylint: disable=broad-except
+        return {"error": "{}: {}".format(type(error).__name__, error)}
+
+
+def analyse_uploads(jobs):
+    '''Worker entry point for a batch of uploads'''
+    return [analyse_upload(job) for job in jobs]
+
+
+class Metrics():
+    '''Request counters and the latencies of the latest uploads the workers analysed'''
+    def __init__(self, window=LATENCY_WINDOW):
+        self.started = time.monotonic()
+        self.counts = {"requests": 0, "analysed": 0, "failed": 0, "rejected": 0, "batches": 0, "batched": 0}
+        self.latencies = deque(maxlen=window)
+
+    def request(self, status, seconds=None):
+        '''Count an answered upload, and how long it took when it went through
+        the pool. Turned away and malformed ones are answered in microseconds
+        and would hide the analysis latency.'''
+        self.counts["requests"] += 1
+        if status == 200:
+            self.counts["analysed"] += 1
+        elif status == 503:
+            self.counts["rejected"] += 1
+        else:
+            self.counts["failed"] += 1
+        if seconds is not None:
+            self.latencies.append(seconds)
+
+    def batch(self, size):
+        '''Count a batch handed to the pool'''
+        self.counts["batches"] += 1
+        self.counts["batched"] += size
+
+    def snapshot(self, **gauges):
+        '''The metrics as JSON friendly values, with the current gauges'''
+        a_latencies = np.array(self.latencies) * 1000
+        latency = {"p{}".format(percentile): None for percentile in PERCENTILES}
+        latency["max"] = None
+        if len(a_latencies):
+            latency.update(zip(latency, np.percentile(a_latencies, PERCENTILES).tolist() + [a_latencies.max()]))
+        counts = dict(self.counts)
+        batched = counts.pop("batched")
+        return dict(counts, uptime_s=time.monotonic() - self.started, latency_ms=latency,
+                    latency_window=len(a_latencies),
+                    mean_batch=batched / counts["batches"] if counts["batches"] else None, **gauges)
+
+
+class AnalysisService():
+    '''The HTTP front end, the bounded upload queue and the batcher feeding the process pool'''
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, jobs=None, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT,
+                 max_connections=MAX_CONNECTIONS, max_body=MAX_BODY, tolerance=None):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_connections = max_connections
+        self.max_body = max_body
+        self.tolerance = tolerance
+        self.metrics = Metrics()
+        self.connections = 0
+        self.in_flight = 0
+        self.queue = None
+        self.executor = None
+        self.server = None
+        self._slots = None
+        self._tasks = set()
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        '''Start the pool, the batcher and the listening socket'''
+        self.queue = asyncio.Queue(self.queue_size)
+        self._slots = asyncio.Semaphore(self.jobs)
+        # Forked workers would inherit the listening socket and every open connection, and a
+        # client reading a Connection: close answer to its end would wait on them forever
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.executor = ProcessPoolExecutor(max_workers=self.jobs, mp_context=multiprocessing.get_context(method))
+        self._spawn(self._batch_loop())
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    async def close(self):
+        '''Stop listening and shut the pool down, dropping the queued uploads'''
+        self.server.close()
+        await self.server.wait_closed()
+        for task in list(self._tasks):
+            task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _batch_loop(self):
+        '''Hand the queued uploads to the pool a batch at a time, whenever a worker is free'''
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            l_batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(l_batch) < self.batch_size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        l_batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    l_batch.append(self.queue.get_nowait())
+            self._spawn(self._run_batch(l_batch))
+
+    async def _run_batch(self, l_batch):
+        self.metrics.batch(len(l_batch))
+        self.in_flight += len(l_batch)
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, analyse_uploads, [job for job, _ in l_batch])
+        except Exception as error: # pylint: disable=broad-except
+            results = [{"error": "{}: {}".format(type(error).__name__, error)}] * len(l_batch)
+        finally:
+            self.in_flight -= len(l_batch)
+            self._slots.release()
+        for (_, future), result in zip(l_batch, results):
+            # Cancelled when its handler was
+            if not future.done():
+                future.set_result(result)
+
+    async def _read_request(self, reader):
+        '''(method, path, query, headers, body) of the next request, None once the client is done'''
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as error:
+            if error.partial.strip():
+                raise HttpError(400, "incomplete request") from None
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpError(431, "request head too long") from None
+        lines = head.decode('latin-1').split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise HttpError(400, "malformed request line") from None
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            if name:
+                headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', 'identity').lower() != 'identity':
+            raise HttpError(501, "send the upload with a Content-Length")
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HttpError(400, "bad Content-Length") from None
+        if length > self.max_body:
+            raise HttpError(413, "uploads are limited to {} bytes".format(self.max_body))
+        body = await reader.readexactly(length) if length > 0 else b""
+        url = urllib.parse.urlsplit(target)
+        return method, url.path, urllib.parse.parse_qs(url.query), headers, body
+
+    async def _route(self, method, path, query, headers, body):
+        '''(status, JSON payload) of one request'''
+        if path == '/health':
+            return 200, {"status": "ok"}
+        if path == '/metrics':
+            return 200, self.metrics.snapshot(queue_depth=self.queue.qsize(), queue_size=self.queue_size,
+                                              in_flight=self.in_flight, workers=self.jobs,
+                                              connections=self.connections)
+        if path != '/analyse':
+            raise HttpError(404, "no such endpoint")
+        if method != 'POST':
+            raise HttpError(405, "POST the SOR files")
+        start = time.monotonic()
+        try:
+            job = (parse_uploads(headers.get('content-type', ''), body, query.get('name', ["upload.sor"])[-1]),
+                   parse_params(query), self.tolerance)
+            future = asyncio.get_running_loop().create_future()
+            try:
+                self.queue.put_nowait((job, future))
+            except asyncio.QueueFull:
+                raise HttpError(503, "the queue is full, try again shortly") from None
+        except HttpError as error:
+            self.metrics.request(error.status)
+            raise
+        result = await future
+        status = 422 if "error" in result else 200
+        self.metrics.request(status, time.monotonic() - start)
+        return status, result
+
+    async def _handle(self, reader, writer):
+        '''Serve one connection, keeping it open between requests'''
+        self.connections += 1
+        try:
+            if self.connections > self.max_connections:
+                raise HttpError(503, "too many connections")
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                status, payload = await self._route(*request)
+                keep_alive = request[3].get('connection', '').lower() != 'close'
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except HttpError as error:
+            await self._respond(writer, error.status, {"error": str(error)}, False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode()
+        head = ["HTTP/1.1 {} {}".format(status, REASONS.get(status, "")),
+                "Content-Type: application/json",
+                "Content-Length: {}".format(len(body)),
+                "Connection: {}".format("keep-alive" if keep_alive else "close")]
+        if status == 503:
+            head.append("Retry-After: 1")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+async def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    '''Run service until cancelled'''
+    server = await service.start(host, port)
+    print("listening on {}".format(", ".join("http://{}:{}".format(*sock.getsockname()[:2])
+                                             for sock in server.sockets)), file=sys.stderr)
+    try:
+        await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main(argv=None):
+    '''Command line entry point'''
+    parser = argparse.ArgumentParser(description='Analyse uploaded SOR files over HTTP')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on (default: %(default)s)')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help='port to listen on (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help='uploads waiting for a worker before new ones are turned away')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='uploads handed to a worker at once')
+    parser.add_argument('--batch-wait-ms', type=float, default=BATCH_WAIT * 1000,
+                        help='how long a free worker waits for more uploads to batch')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS, help='open connections served at once')
+    parser.add_argument('--max-body-mb', type=float, default=MAX_BODY / (1 << 20), help='largest upload accepted')
+    parser.add_argument('--tolerance', type=float, default=analysis.DEFAULT_TOLERANCE,
+                        help='features of different files closer than this are one event')
+    args = parser.parse_args(argv)
+    service = AnalysisService(args.jobs, args.queue_size, args.batch_size, args.batch_wait_ms / 1000,
+                              args.max_connections, int(args.max_body_mb * (1 << 20)), args.tolerance)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
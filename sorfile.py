@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+'''Lazy, memory mapped access to the blocks of a SOR file'''
+
+import io
+import mmap
+
+import otdrparser
+
+import analysis
+from instrument import span
+
+
+HEADER_BLOCKS = ('GenParams', 'SupParams', 'FxdParams', 'KeyEvents', 'Cksum')
+
+
+class LazySorFile():
+    '''A SOR file that reads its block directory up front and decodes blocks on demand.
+
+    The file is only memory mapped while a block is being decoded, so thousands
+    of these can be held without keeping file handles open.'''
+    def __init__(self, url):
+        self.url = url
+        self.directory = []
+        self._mmap = None
+        self._depth = 0
+        self._blocks = {}
+        with self:
+            self._blocks['Map'] = otdrparser.parse_map_block(self._mmap)
+            offset = self._blocks['Map']['numbytes']
+            for entry in self._blocks['Map']['maps']:
+                self.directory.append((entry['name'], offset, entry['numbytes']))
+                offset += entry['numbytes']
+
+    def __enter__(self):
+        if self._mmap is None:
+            with open(self.url, 'rb') as fp:
+                self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *_exc):
+        self._depth -= 1
+        if not self._depth:
+            self._mmap.close()
+            self._mmap = None
+
+    def _entry(self, name):
+        '''The (name, offset, numbytes) directory entry of a block'''
+        for entry in self.directory:
+            if entry[0] == name:
+                return entry
+        return None
+
+    def _decode(self, name, offset, numbytes):
+        '''Decode one block from the mapped file'''
+        fp = io.BytesIO(self._mmap[offset:offset + numbytes])
+        if name == 'GenParams':
+            return otdrparser.parse_genparams_block(fp, numbytes)
+        if name == 'SupParams':
+            return otdrparser.parse_supparams_block(fp, numbytes)
+        if name == 'FxdParams':
+            return otdrparser.parse_fxdparams_block(fp, numbytes)
+        if name == 'KeyEvents':
+            return otdrparser.parse_keyevents_block(fp, numbytes,
+                                                    self.block('FxdParams')['index_of_refraction'])
+        if name == 'Cksum':
+            return otdrparser.parse_chksum_block(fp, numbytes)
+        if name == 'DataPts':
+            fxd_params = self.block('FxdParams')
+            with memoryview(self._mmap) as view:
+                return analysis.decode_data_pts(view[offset:offset + numbytes],
+                                                fxd_params['sample_spacing'],
+                                                fxd_params['index_of_refraction'])
+        return otdrparser.parse_unknown_block(fp, numbytes)
+
+    def block(self, name):
+        '''A single decoded block, or None if the file does not have it'''
+        if name not in self._blocks:
+            entry = self._entry(name)
+            if entry is None:
+                return None
+            with self, span("parse", block=name):
+                self._blocks[name] = self._decode(*entry)
+        return self._blocks[name]
+
+    def metadata(self):
+        '''The Map and header blocks, everything but the samples'''
+        with self:
+            return [self._blocks['Map']] + [self.block(name) for name, _, _ in self.directory
+                                            if name in HEADER_BLOCKS]
+
+    def blocks(self):
+        '''Every block, in the same form as analysis.parse_blocks'''
+        with self:
+            return [self._blocks['Map']] + [self.block(name) for name, _, _ in self.directory]
+
+    @property
+    def trace(self):
+        '''The 2xN [distances, levels] array, decoded on first use'''
+        return analysis.extract_trace([self.block('DataPts') or {}])
+
+    def release_trace(self):
+        '''Forget the decoded samples, they are decoded again when next needed'''
+        self._blocks.pop('DataPts', None)
+
+
+def scan_metadata(url):
+    '''Summarise a SOR file from its header blocks without touching the samples'''
+    return analysis.summarise(url, LazySorFile(url).metadata(), None)
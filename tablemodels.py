@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+'''Read only Qt table models backed by one array per column'''
+
+import re
+
+import numpy as np
+from PyQt6 import QtCore
+
+from analysis import METRES_PER_KM, FEET_PER_METRE
+
+
+_DIGITS = re.compile(r'(\d+)')
+
+
+def natural_key(text):
+    '''Order cells as a human would: empty cells first, then numbers by value,
+    then text with any runs of digits compared as numbers'''
+    text = "" if text is None else str(text).strip()
+    if not text:
+        return (0, float('-inf'))
+    try:
+        return (0, float(text))
+    except ValueError:
+        pass
+    return (1, tuple((0, int(chunk)) if chunk.isdigit() else (1, chunk.casefold())
+                     for chunk in _DIGITS.split(text) if chunk))
+
+
+def sort_ranks(a_column):
+    '''The rank of every cell of a column, equal cells share a rank'''
+    a_column = np.asarray(a_column)
+    if a_column.dtype.kind in 'biuf':
+        a_values = a_column.astype(np.float64)
+        a_values[np.isnan(a_values)] = -np.inf
+        return np.unique(a_values, return_inverse=True)[1].ravel()
+    keys = [natural_key(value) for value in a_column]
+    d_rank = {key: rank for rank, key in enumerate(sorted(set(keys)))}
+    return np.fromiter((d_rank[key] for key in keys), dtype=np.int64, count=len(keys))
+
+
+def _text(value):
+    '''The cell text of one array element'''
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return ""
+    return str(value)
+
+
+def _object_column(values):
+    '''A 1-D object array, even when the values are sequences themselves'''
+    values = list(values)
+    a_column = np.empty(len(values), dtype=object)
+    a_column[:] = values
+    return a_column
+
+
+class ColumnarTableModel(QtCore.QAbstractTableModel):
+    '''A table held as one NumPy array per column.
+
+    Nothing is formatted up front, data() turns a cell into text only when a
+    view asks for it, so replacing the contents is a single model reset.'''
+    def __init__(self, headers, parent=None):
+        super(ColumnarTableModel, self).__init__(parent)
+        self.headers = list(headers)
+        self.columns = [np.empty(0) for _ in self.headers]
+        self._ranks = {}
+
+    def set_columns(self, columns):
+        '''Replace the contents, one equally long array per header'''
+        self.beginResetModel()
+        self.columns = [np.asarray(column) for column in columns]
+        self._ranks = {}
+        self.endResetModel()
+
+    def clear(self):
+        '''Drop every row'''
+        self.set_columns([np.empty(0) for _ in self.headers])
+
+    def value(self, row, column):
+        '''The raw value behind a cell'''
+        return self.columns[column][row]
+
+    def sort_keys(self, column):
+        '''Sort rank per row of a column, worked out once per contents'''
+        if column not in self._ranks:
+            self._ranks[column] = sort_ranks(self.columns[column])
+        return self._ranks[column]
+
+    def sort(self, column, order=QtCore.Qt.SortOrder.AscendingOrder):
+        '''Reorder the rows by one column, equal cells keep their order'''
+        a_ranks = self.sort_keys(column)
+        if order == QtCore.Qt.SortOrder.DescendingOrder:
+            a_ranks = -a_ranks
+        a_order = np.argsort(a_ranks, kind='stable')
+        a_new_rows = np.empty_like(a_order)
+        a_new_rows[a_order] = np.arange(len(a_order))
+        self.layoutAboutToBeChanged.emit()
+        self.columns = [a_column[a_order] for a_column in self.columns]
+        self._ranks = {key: a_key[a_order] for key, a_key in self._ranks.items()}
+        old = self.persistentIndexList()
+        self.changePersistentIndexList(old, [self.index(int(a_new_rows[index.row()]), index.column())
+                                             for index in old])
+        self.layoutChanged.emit()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        '''Qt row count, the table has no children'''
+        if parent.isValid() or not self.columns:
+            return 0
+        return len(self.columns[0])
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        '''Qt column count'''
+        if parent.isValid():
+            return 0
+        return len(self.headers)
+
+    def data(self, index, role=QtCore.Qt.ItemDataRole.DisplayRole):
+        '''The cell text, formatted on demand'''
+        if not index.isValid():
+            return None
+        if role != QtCore.Qt.ItemDataRole.DisplayRole:
+            return None
+        return _text(self.columns[index.column()][index.row()])
+
+    def headerData(self, section, orientation, role=QtCore.Qt.ItemDataRole.DisplayRole):
+        '''Column names across the top, row numbers down the side'''
+        if orientation == QtCore.Qt.Orientation.Horizontal and role == QtCore.Qt.ItemDataRole.DisplayRole:
+            return self.headers[section]
+        return super(ColumnarTableModel, self).headerData(section, orientation, role)
+
+    def flags(self, index):
+        '''Cells can be selected but not edited'''
+        if not index.isValid():
+            return QtCore.Qt.ItemFlag.NoItemFlags
+        return QtCore.Qt.ItemFlag.ItemIsSelectable | QtCore.Qt.ItemFlag.ItemIsEnabled
+
+
+class MetaTableModel(ColumnarTableModel):
+    '''The (name, value) meta data rows of a file'''
+    def __init__(self, parent=None):
+        super(MetaTableModel, self).__init__(['Name', 'Value'], parent)
+
+    def set_rows(self, meta_rows):
+        '''Show the (name, value) rows from extract_meta'''
+        meta_rows = list(meta_rows)
+        self.set_columns([_object_column(name for name, _ in meta_rows),
+                          _object_column(value for _, value in meta_rows)])
+
+
+class EventsTableModel(ColumnarTableModel):
+    '''The KeyEvents of a file'''
+    def __init__(self, parent=None):
+        super(EventsTableModel, self).__init__(['comment', 'dist(km)', 'dist(ft)', 'peak', 'refl loss',
+                                                'slope', 'splice_loss', 'type', 'loss', 'dispersion'], parent)
+
+    def set_events(self, events, a_loss=None, a_dispersion=None):
+        '''Show the events list of a KeyEvents block, with the loss and dispersion
+        measured on the traces at each event when given'''
+        events = list(events)
+        count = len(events)
+        a_unknown = np.full(count, np.nan)
+
+        def numeric(name, dtype=np.float64, default=np.nan):
+            return np.fromiter((default if event.get(name) is None else event[name] for event in events),
+                               dtype=dtype, count=count)
+
+        # otdrparser gives the distances in metres
+        a_metres = numeric('distance_of_travel', default=0.0)
+        self.set_columns([_object_column(event.get('comment') for event in events),
+                          a_metres / METRES_PER_KM,
+                          a_metres * FEET_PER_METRE,
+                          numeric('peak_point', np.int64, 0),
+                          numeric('reflection_loss'),
+                          numeric('slope'),
+                          numeric('splice_loss'),
+                          _object_column(event.get('event_type_details', {}).get('event') for event in events),
+                          a_unknown if a_loss is None else a_loss,
+                          a_unknown if a_dispersion is None else a_dispersion])
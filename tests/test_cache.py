@@ -0,0 +1,115 @@
+'''Cached analyses are reused until the file, the parameters or the analysis code change'''
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import analysis
+import cache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import synthetic_sor # pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def sor_url(tmp_path):
+    url = tmp_path / "trace.sor"
+    url.write_bytes(synthetic_sor.build_sor(samples=8192, events=4))
+    return str(url)
+
+
+@pytest.fixture
+def trace_cache(tmp_path):
+    return cache.TraceCache(str(tmp_path / "cache"))
+
+
+@pytest.fixture
+def smoothings(monkeypatch):
+    '''How often a trace was actually analysed rather than read from the cache'''
+    calls = []
+    smooth_trace = analysis.smooth_trace
+
+    def counted(*args, **kwargs):
+        calls.append(1)
+        return smooth_trace(*args, **kwargs)
+    monkeypatch.setattr(analysis, "smooth_trace", counted)
+    return calls
+
+
+def resolved(url, params=None):
+    '''params with the default window worked out for the file, as the cache keys them'''
+    return analysis.resolve_params(params, analysis.get_block(analysis.load_blocks(url), 'FxdParams'))
+
+
+def entries(trace_cache):
+    return len(trace_cache._entries()) # pylint: disable=protected-access
+
+
+def assert_same(d_result, d_expected):
+    np.testing.assert_array_equal(d_result["trace"], d_expected["trace"])
+    for a_result, a_expected in zip(d_result["features"], d_expected["features"]):
+        np.testing.assert_array_equal(a_result, a_expected)
+
+
+def test_hit(sor_url, trace_cache, smoothings): # pylint: disable=redefined-outer-name
+    first = trace_cache.analyse(sor_url)
+    second = trace_cache.analyse(sor_url)
+    assert len(smoothings) == 1
+    assert entries(trace_cache) == 1
+    assert_same(second, first)
+    # A fresh cache over the same directory reads the same entry
+    assert_same(cache.TraceCache(trace_cache.directory).analyse(sor_url), first)
+    assert len(smoothings) == 1
+
+
+def test_default_window_shares_the_resolved_key(sor_url, trace_cache, smoothings): # pylint: disable=redefined-outer-name
+    trace_cache.analyse(sor_url, {"window_len": None})
+    trace_cache.analyse(sor_url, {"window_len": resolved(sor_url)["window_len"]})
+    assert len(smoothings) == 1
+
+
+def test_params_change_the_key(sor_url, trace_cache, smoothings): # pylint: disable=redefined-outer-name
+    trace_cache.analyse(sor_url)
+    trace_cache.analyse(sor_url, {"height": 0.01})
+    trace_cache.analyse(sor_url, {"window_len": 0})
+    assert len(smoothings) == 3
+    assert entries(trace_cache) == 3
+
+
+def test_analysis_version_invalidates(sor_url, trace_cache, smoothings, monkeypatch): # pylint: disable=redefined-outer-name
+    trace_cache.analyse(sor_url)
+    monkeypatch.setattr(analysis, "ANALYSIS_VERSION", analysis.ANALYSIS_VERSION + 1)
+    trace_cache.analyse(sor_url)
+    assert len(smoothings) == 2
+
+
+def test_changed_file_invalidates(sor_url, trace_cache, smoothings): # pylint: disable=redefined-outer-name
+    first = trace_cache.analyse(sor_url)
+    with open(sor_url, 'wb') as fp:
+        fp.write(synthetic_sor.build_sor(samples=8192, events=4, seed=1))
+    os.utime(sor_url, ns=(0, os.stat(sor_url).st_mtime_ns + 1))
+    second = trace_cache.analyse(sor_url)
+    assert len(smoothings) == 2
+    assert not np.array_equal(first["trace"], second["trace"])
+
+
+def test_corrupt_entry_is_recomputed(sor_url, trace_cache, smoothings): # pylint: disable=redefined-outer-name
+    first = trace_cache.analyse(sor_url)
+    path = trace_cache._path(trace_cache.key(sor_url, resolved(sor_url))) # pylint: disable=protected-access
+    with open(path, 'wb') as fp:
+        fp.write(b"not an npz")
+    assert_same(trace_cache.analyse(sor_url), first)
+    assert len(smoothings) == 2
+
+
+def test_eviction(sor_url, trace_cache): # pylint: disable=redefined-outer-name
+    trace_cache.analyse(sor_url, {"height": 0.01})
+    size = trace_cache.size
+    trace_cache.max_bytes = int(size * 1.5)
+    trace_cache.analyse(sor_url, {"height": 0.02})
+    assert entries(trace_cache) == 1
+    assert trace_cache.size <= trace_cache.max_bytes
+    trace_cache.clear()
+    assert entries(trace_cache) == 0 and trace_cache.size == 0
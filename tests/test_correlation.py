@@ -0,0 +1,65 @@
+'''Features of many traces cluster into events on the gaps between them'''
+
+import numpy as np
+import pytest
+
+import analysis
+
+
+def features(a_positions):
+    '''[indexes, distances, levels] of features at a_positions'''
+    a_positions = np.asarray(a_positions, dtype=np.float64)
+    return [np.arange(len(a_positions)), a_positions, np.zeros(len(a_positions))]
+
+
+def test_outlier_on_the_left():
+    # The first feature is 40 before the rest, the event still spans less than two tolerances
+    a_positions = np.array([1000.0, 1040, 1045, 1050, 1080, 5000, 5010])
+    np.testing.assert_array_equal(analysis.correlate_positions(a_positions, 50), [0, 0, 0, 0, 0, 1, 1])
+
+
+def test_input_order():
+    a_positions = np.array([5010.0, 1040, 5000, 1000, 9000])
+    np.testing.assert_array_equal(analysis.correlate_positions(a_positions, 50), [1, 0, 1, 0, 2])
+
+
+def test_split_on_gaps_only():
+    a_positions = np.array([0.0, 50, 100.5, 150.5])
+    np.testing.assert_array_equal(analysis.correlate_positions(a_positions, 50), [0, 0, 1, 1])
+    assert len(analysis.correlate_positions(np.empty(0))) == 0
+
+
+def test_many_reshoots_stay_one_event():
+    rng = np.random.default_rng(0)
+    a_events = np.array([1000.0, 8000, 20000])
+    a_positions = (a_events[None, :] + rng.normal(0, 8, (2000, 3))).ravel()
+    a_labels = analysis.correlate_positions(a_positions, 50)
+    assert a_labels.max() == 2
+    np.testing.assert_array_equal(a_labels.reshape(2000, 3), np.broadcast_to([0, 1, 2], (2000, 3)))
+
+
+def test_event_set_tracks_traces():
+    event_set = analysis.EventSet(50)
+    event_set.add("a", features([100, 1000]))
+    event_set.add("b", features([110, 5000]))
+    assert sorted(event_set.events) == [105.0, 1000.0, 5000.0]
+    assert event_set.events[105.0]["traces"] == {"a": [0], "b": [0]}
+    event_set.add("a", features([2000]))
+    assert sorted(event_set.events) == [110.0, 2000.0, 5000.0]
+    event_set.remove("b")
+    assert sorted(event_set.events) == [2000.0]
+    assert event_set.clusters()["trace"].tolist() == [2]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_add_matches_add_many(seed):
+    rng = np.random.default_rng(seed)
+    d_features = {key: features(rng.uniform(0, 20000, rng.integers(0, 30))) for key in range(40)}
+    one_at_a_time = analysis.EventSet()
+    for key, trace_features in d_features.items():
+        one_at_a_time.add(key, trace_features)
+    at_once = analysis.EventSet()
+    at_once.add_many(d_features)
+    for name in ("cluster", "position", "index", "trace"):
+        np.testing.assert_array_equal(one_at_a_time.clusters()[name], at_once.clusters()[name])
+    assert one_at_a_time.events == analysis.filter_events(list(d_features.values()))
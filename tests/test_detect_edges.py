@@ -0,0 +1,87 @@
+'''The chunked detect_edges finds exactly what find_edges finds over the whole trace'''
+
+import numpy as np
+import pytest
+
+import analysis
+
+
+def random_trace(samples, seed, steps=8, noise=0.0003):
+    '''A [distances, levels] trace with random drops and spikes on a sloping backscatter'''
+    rng = np.random.default_rng(seed)
+    a_distances = np.arange(samples) * 2.0
+    a_levels = -np.linspace(0, samples * 0.0002, samples)
+    for start in rng.integers(1, samples - 1, steps):
+        a_levels[start:] -= rng.uniform(0.05, 1.0) * np.clip(np.arange(samples - start) / rng.uniform(1, 30), 0, 1)
+    a_levels += rng.normal(0, noise, samples)
+    return np.array([a_distances, a_levels])
+
+
+def assert_same(a_trace, params=None, chunk=256):
+    expected = analysis.find_edges(analysis.differentiate_data(a_trace), params)
+    found = analysis.detect_edges(a_trace, params, chunk=chunk, threshold=0)
+    for a_expected, a_found in zip(expected, found):
+        np.testing.assert_array_equal(a_found, a_expected)
+
+
+@pytest.mark.parametrize("seed", range(12))
+@pytest.mark.parametrize("chunk", [64, 100, 257, 4096])
+def test_random_traces(seed, chunk):
+    assert_same(random_trace(20000 + seed * 997, seed, steps=4 + seed), chunk=chunk)
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_dense_peaks(seed):
+    # Far more peaks than the distance parameter lets through, mostly across chunk edges
+    a_trace = random_trace(12000, seed, steps=300, noise=0.002)
+    assert_same(a_trace, {"height": 0.001, "width": 1, "distance": 7}, chunk=64)
+
+
+@pytest.mark.parametrize("chunk", [50, 64, 128])
+def test_plateaus(chunk):
+    # Quantised levels give runs of equal differentials, flat topped peaks included
+    a_trace = random_trace(15000, 3, steps=20, noise=0.001)
+    a_trace[1] = np.round(a_trace[1], 2)
+    assert_same(a_trace, {"width": 1, "distance": 3}, chunk=chunk)
+
+
+@pytest.mark.parametrize("chunk", [64, 128])
+def test_edges_on_chunk_boundaries(chunk):
+    a_trace = random_trace(chunk * 40, 0, steps=0, noise=0.0001)
+    for start in range(chunk - 2, chunk * 40, chunk * 3):
+        a_trace[1][start:] -= 0.3
+    assert_same(a_trace, {"distance": 10}, chunk=chunk)
+
+
+@pytest.mark.parametrize("params", [
+    {"height": None},
+    {"width": None},
+    {"distance": None},
+    {"height": None, "width": None},
+    {"height": None, "distance": None},
+    {"width": None, "distance": None},
+    {"height": None, "width": None, "distance": None},
+    {"height": 0.01, "width": 12, "distance": 400},
+    None,
+])
+def test_params(params):
+    assert_same(random_trace(9000, 7, steps=30, noise=0.001), params, chunk=100)
+
+
+def test_no_features():
+    a_trace = np.array([np.arange(5000) * 2.0, np.zeros(5000)])
+    assert_same(a_trace, chunk=64)
+    assert len(analysis.detect_edges(a_trace, chunk=64, threshold=0)[0]) == 0
+
+
+def test_short_traces_are_searched_whole():
+    a_trace = random_trace(3000, 1)
+    found = analysis.detect_edges(a_trace, chunk=64)
+    expected = analysis.find_edges(analysis.differentiate_data(a_trace))
+    for a_expected, a_found in zip(expected, found):
+        np.testing.assert_array_equal(a_found, a_expected)
+
+
+def test_distance_below_one():
+    with pytest.raises(ValueError):
+        analysis.detect_edges(random_trace(3000, 1), {"distance": 0.5}, chunk=64, threshold=0)
@@ -0,0 +1,46 @@
+'''Spans recorded in batch workers end up in the trace of the main process'''
+
+import os
+import sys
+import functools
+
+import pytest
+
+import batch
+import instrument
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import synthetic_sor # pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def recording():
+    instrument.clear()
+    instrument.enable()
+    yield
+    instrument.enable(False)
+    instrument.clear()
+
+
+def test_take_and_merge_keep_the_times(recording): # pylint: disable=redefined-outer-name,unused-argument
+    with instrument.span("outer"):
+        pass
+    l_events = instrument.events()
+    taken = instrument.take()
+    assert not instrument.events()
+    instrument.merge(taken)
+    merged = instrument.events()
+    assert [dict(event, ts=0) for event in merged] == [dict(event, ts=0) for event in l_events]
+    assert merged[0]["ts"] == pytest.approx(l_events[0]["ts"])
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_worker_spans_are_merged(tmp_path, recording, jobs): # pylint: disable=redefined-outer-name,unused-argument
+    files = synthetic_sor.write_set(str(tmp_path), count=2, samples=4096, events=4, wavelengths=(1310, 1550))
+    worker = functools.partial(batch.traced, batch.analyse_one)
+    results = list(batch.merge_spans(batch.run_batch(files, jobs, {"window_len": 0}, worker=worker)))
+    assert [result["file"] for result in results] == files
+    names = [event["name"] for event in instrument.events()]
+    assert names.count("detect") == len(files)
+    if jobs > 1:
+        assert os.getpid() not in {event["pid"] for event in instrument.events()}
@@ -0,0 +1,100 @@
+'''Binary projects round trip their traces, saving over the file they are mapped from included'''
+
+import io
+import os
+import sys
+import json
+
+import numpy as np
+import otdrparser
+import pytest
+
+import analysis
+from project import ProjectFile, is_binary, read_legacy, load_legacy_trace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import synthetic_sor # pylint: disable=wrong-import-position
+
+
+def record(seed, samples=4000):
+    '''A trace as the window hands it to ProjectFile.save'''
+    rng = np.random.default_rng(seed)
+    a_trace = np.array([np.arange(samples) * 2.0, np.cumsum(rng.normal(0, 0.01, samples))])
+    return {"meta": [{"name": "GenParams", "fiber_id": str(seed)}],
+            "sha256": "{:064x}".format(seed),
+            "params": dict(analysis.DEFAULT_PARAMS),
+            "trace": a_trace,
+            "features": analysis.detect_edges(a_trace, {"height": 0.01})}
+
+
+def assert_trace(d_loaded, d_record):
+    np.testing.assert_array_equal(d_loaded["trace"], d_record["trace"])
+    for a_loaded, a_expected in zip(d_loaded["features"], d_record["features"]):
+        np.testing.assert_array_equal(a_loaded, a_expected)
+    assert d_loaded["sha256"] == d_record["sha256"]
+    assert d_loaded["meta"] == d_record["meta"]
+
+
+def test_round_trip(tmp_path):
+    url = str(tmp_path / "a.opro")
+    d_traces = {"one.sor": record(1), "two.sor": record(2)}
+    ProjectFile.write(url, {"site": "x"}, d_traces)
+    assert is_binary(url)
+    project = ProjectFile(url)
+    assert project.meta == {"site": "x"}
+    for name, d_record in d_traces.items():
+        assert_trace(project.load_trace(name), d_record)
+
+
+def test_save_appends_and_forgets(tmp_path):
+    url = str(tmp_path / "a.opro")
+    project = ProjectFile.write(url, {}, {"one.sor": record(1), "two.sor": record(2)})
+    project.save({"saved": 2}, {"three.sor": record(3)}, removed=["one.sor"])
+    reopened = ProjectFile(url)
+    assert sorted(reopened.traces) == ["three.sor", "two.sor"]
+    assert reopened.meta == {"saved": 2}
+    assert_trace(reopened.load_trace("three.sor"), record(3))
+    size = os.path.getsize(url)
+    reopened.compact()
+    assert os.path.getsize(url) < size
+    assert_trace(ProjectFile(url).load_trace("two.sor"), record(2))
+
+
+def test_write_over_the_mapped_file(tmp_path):
+    url = str(tmp_path / "a.opro")
+    ProjectFile.write(url, {}, {"one.sor": record(1), "two.sor": record(2)})
+    project = ProjectFile(url)
+    d_mapped = {name: dict(project.load_trace(name), meta=project.traces[name]["meta"]) for name in project.traces}
+    assert isinstance(d_mapped["one.sor"]["trace"], np.memmap)
+    # Saving the open traces as a new project over the file they are mapped from
+    ProjectFile.write(url, {}, dict(d_mapped, **{"three.sor": record(3)}))
+    reopened = ProjectFile(url)
+    for seed, name in enumerate(("one.sor", "two.sor", "three.sor"), 1):
+        assert_trace(reopened.load_trace(name), record(seed))
+    assert not os.path.exists(url + '.tmp')
+
+
+def test_legacy_project_without_its_sor_files(tmp_path):
+    sor_bytes = synthetic_sor.build_sor(samples=8192, events=4)
+    d_meta = otdrparser.parse(io.BytesIO(sor_bytes))
+    url = str(tmp_path / "old.opro")
+    missing = str(tmp_path / "moved" / "a.sor")
+    with open(url, "w") as file:
+        json.dump({"meta": {"site": "x"}, "files": {missing: {"meta": d_meta}}}, file)
+    assert not is_binary(url)
+    meta, d_files = read_legacy(url)
+    assert meta == {"site": "x"}
+    d_loaded = load_legacy_trace(d_files[missing], analysis.DEFAULT_PARAMS)
+    params = analysis.resolve_params(analysis.DEFAULT_PARAMS, analysis.get_block(d_meta, 'FxdParams'))
+    a_expected = analysis.smooth_trace(analysis.extract_trace(d_meta), params)
+    np.testing.assert_array_equal(d_loaded["trace"], a_expected)
+    assert d_loaded["trace"].shape == (2, 8192)
+    assert all(block["name"] != 'DataPts' for block in d_loaded["meta"])
+    assert len(d_loaded["features"][0]) > 0
+
+
+def test_not_a_project(tmp_path):
+    url = tmp_path / "x.opro"
+    url.write_bytes(b"OPROBIN0" + bytes(16))
+    with pytest.raises(ValueError):
+        ProjectFile(str(url))
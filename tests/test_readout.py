@@ -0,0 +1,25 @@
+'''The cursor readout reports the metre distances of the traces in km and ft'''
+
+import os
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np # pylint: disable=wrong-import-position
+from matplotlib.figure import Figure # pylint: disable=wrong-import-position
+
+from plotting import TracePlot, CursorReadout # pylint: disable=wrong-import-position
+
+
+def test_format_km_and_ft():
+    text = CursorReadout.format(5000.0, [])
+    assert text == "5.0000 km  16404.2 ft"
+
+
+def test_format_lists_the_samples():
+    axes = Figure().add_subplot(1, 1, 1)
+    trace_plot = TracePlot(axes)
+    a_distances = np.arange(0, 10000, 2.0)
+    trace_plot.sync({"a": (np.array([a_distances, -a_distances / 1000]), {"label": "1550nm"})})
+    rows = CursorReadout.format(5000.4, trace_plot.samples_at(5000.4)).split("\n")
+    assert rows[0] == "5.0004 km  16405.5 ft"
+    assert rows[1] == "1550nm  -5.000 dB"
@@ -0,0 +1,15 @@
+'''Acceptance report contents, distances in km and ft of the metre traces'''
+
+import numpy as np
+
+import report
+
+
+def test_event_distances():
+    a_distances = np.arange(0, 10000, 2.0)
+    a_trace = np.array([a_distances, -a_distances / 5000])
+    d_meta = [{"name": "KeyEvents", "events": [{"event_number": 1, "distance_of_travel": 5000.0}]}]
+    d_report = report.build_report("test", [(a_trace, 1550)], d_meta)
+    row = d_report["events"][0]
+    assert row[1] == "5.0000"
+    assert row[2] == "16404.2"
@@ -0,0 +1,50 @@
+'''resample_traces gives what np.interp gives trace by trace'''
+
+import numpy as np
+import pytest
+
+import analysis
+
+
+def expected(l_traces, a_grid, fill=np.nan):
+    a_levels = np.full((len(l_traces), len(a_grid)), fill)
+    for row, a_trace in enumerate(l_traces):
+        if len(a_trace[0]):
+            a_levels[row] = np.interp(a_grid, a_trace[0], a_trace[1], left=fill, right=fill)
+    return a_levels
+
+
+def random_traces(seed, count=6):
+    rng = np.random.default_rng(seed)
+    l_traces = []
+    for _ in range(count):
+        samples = int(rng.integers(2, 3000))
+        a_distances = rng.uniform(-100, 500) + np.arange(samples) * rng.uniform(0.5, 8)
+        l_traces.append(np.array([a_distances, rng.normal(0, 1, samples).cumsum()]))
+    return l_traces
+
+
+@pytest.mark.parametrize("seed", range(8))
+@pytest.mark.parametrize("extent", ['overlap', 'union'])
+def test_matches_interp(seed, extent):
+    l_traces = random_traces(seed)
+    a_grid, a_levels = analysis.resample_traces(l_traces, analysis.common_grid(l_traces, extent=extent))
+    np.testing.assert_allclose(a_levels, expected(l_traces, a_grid), rtol=1e-12, atol=1e-12)
+
+
+def test_grid_on_the_samples():
+    # Grid points on the first and last sample of a trace are inside it
+    a_trace = np.array([np.arange(10) * 2.0, np.arange(10) ** 2.0])
+    a_grid = np.arange(-2, 21, 1.0)
+    _, a_levels = analysis.resample_traces([a_trace], a_grid, fill=-1.0)
+    np.testing.assert_array_equal(a_levels, expected([a_trace], a_grid, fill=-1.0))
+    assert a_levels[0, 2] == 0 and a_levels[0, 20] == 81
+
+
+def test_empty_traces():
+    l_traces = [np.empty((2, 0)), random_traces(0, 1)[0], np.empty((2, 0))]
+    a_grid = analysis.common_grid(l_traces)
+    _, a_levels = analysis.resample_traces(l_traces, a_grid)
+    np.testing.assert_array_equal(a_levels, expected(l_traces, a_grid))
+    assert analysis.resample_traces([np.empty((2, 0))], np.arange(3.0))[1].shape == (1, 3)
+    assert analysis.resample_traces([], np.arange(3.0))[1].shape == (0, 3)
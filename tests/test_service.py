@@ -0,0 +1,80 @@
+'''The analysis service over a real socket, against a one worker pool'''
+
+import os
+import sys
+import json
+import asyncio
+
+import pytest
+
+import service
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import synthetic_sor # pylint: disable=wrong-import-position
+
+
+async def request(port, head, body=b""):
+    '''The status, headers and JSON payload of one request, read until the server closes the connection'''
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+    # Times out if anything, a pool worker included, still holds the connection open
+    response = await asyncio.wait_for(reader.read(), 60)
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    lines = head.decode('latin-1').split("\r\n")
+    headers = dict(line.lower().split(": ", 1) for line in lines[1:])
+    assert int(headers["content-length"]) == len(payload)
+    return int(lines[0].split()[1]), headers, json.loads(payload)
+
+
+def post(port, path, body):
+    return request(port, "POST {} HTTP/1.1\r\nHost: test\r\nConnection: close\r\nContent-Length: {}\r\n\r\n".format(
+        path, len(body)), body)
+
+
+def get(port, path):
+    return request(port, "GET {} HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n".format(path))
+
+
+def run_service(exchange):
+    '''Run exchange(port) against a fresh service on a free port'''
+    async def main():
+        analysis_service = service.AnalysisService(jobs=1, queue_size=4)
+        server = await analysis_service.start("127.0.0.1", 0)
+        try:
+            return await exchange(server.sockets[0].getsockname()[1])
+        finally:
+            await analysis_service.close()
+    return asyncio.run(main())
+
+
+@pytest.fixture(scope="module")
+def sor_bytes():
+    return synthetic_sor.build_sor(samples=8192, events=4)
+
+
+def test_connection_close_reaches_eof(sor_bytes):
+    async def exchange(port):
+        # The first upload starts the pool, its workers must not keep the connection open
+        first = await post(port, "/analyse", sor_bytes)
+        second = await post(port, "/analyse?window_len=0", sor_bytes)
+        return first, second
+    for status, headers, payload in run_service(exchange):
+        assert status == 200
+        assert headers["connection"] == "close"
+        assert len(payload["files"]) == 1
+
+
+def test_latency_only_counts_analysed_uploads(sor_bytes):
+    async def exchange(port):
+        assert (await get(port, "/nowhere"))[0] == 404
+        assert (await post(port, "/analyse?height=x", sor_bytes))[0] == 400
+        assert (await post(port, "/analyse", sor_bytes))[0] == 200
+        assert (await post(port, "/analyse", b"not a SOR file"))[0] == 422
+        return (await get(port, "/metrics"))[2]
+    metrics = run_service(exchange)
+    assert metrics["requests"] == 3
+    assert metrics["analysed"] == 1
+    assert metrics["failed"] == 2
+    assert metrics["latency_window"] == 2
@@ -0,0 +1,14 @@
+'''The events table shows the metre distances of KeyEvents in km and ft'''
+
+import pytest
+
+from tablemodels import EventsTableModel
+
+
+def test_event_distances():
+    model = EventsTableModel()
+    model.set_events([{"distance_of_travel": 5000.0, "comment": "splice"}, {"comment": "no distance"}])
+    assert model.value(0, 1) == pytest.approx(5.0)
+    assert model.value(0, 2) == pytest.approx(16404.1995)
+    assert model.value(1, 1) == 0
+    assert model.rowCount() == 2
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+'''A local SQLite index of SOR files for fleet wide queries.
+
+Every trace is recorded once under the SHA-256 of its contents with its
+GenParams/FxdParams header fields, its KeyEvents and the features detected in
+it. Ingest is incremental, files whose size and modification time have not
+changed since the last run are skipped, and new files are parsed in a process
+pool while this process does all the writing. The rows of contents no indexed
+file holds any more, because the file changed or was deleted, are dropped.
+
+KeyEvents of the same fibre and wavelength within SITE_TOLERANCE of each other
+are the same site, worked out as each trace is stored, so trend queries only
+group rows by site instead of matching events between traces.'''
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import calendar
+
+import analysis
+import batch
+from cache import content_hash, params_hash
+from sorfile import LazySorFile
+
+
+DEFAULT_DATABASE = "openotdr.sqlite"
+# Records written per transaction during ingest
+COMMIT_EVERY = 500
+# KeyEvents of one fibre this close together, in trace distance units, are one site
+SITE_TOLERANCE = analysis.DEFAULT_TOLERANCE
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS traces (
+    sha256 TEXT PRIMARY KEY,
+    file TEXT,
+    cable_id TEXT,
+    fiber_id TEXT,
+    wavelength REAL,
+    date_time INTEGER,
+    pulse_width INTEGER,
+    sample_spacing REAL,
+    index_of_refraction REAL,
+    number_of_points INTEGER,
+    otdr_name TEXT,
+    otdr_serial_number TEXT,
+    params TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sites (
+    site INTEGER PRIMARY KEY,
+    cable_id TEXT,
+    fiber_id TEXT,
+    wavelength REAL,
+    distance REAL
+);
+CREATE TABLE IF NOT EXISTS key_events (
+    sha256 TEXT,
+    number INTEGER,
+    site INTEGER,
+    date_time INTEGER,
+    distance REAL,
+    splice_loss REAL,
+    reflection_loss REAL,
+    slope REAL,
+    event_type TEXT,
+    comment TEXT,
+    PRIMARY KEY (sha256, number)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS features (
+    sha256 TEXT,
+    number INTEGER,
+    sample INTEGER,
+    distance REAL,
+    level REAL,
+    PRIMARY KEY (sha256, number)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS traces_fibre ON traces (cable_id, fiber_id, wavelength, date_time);
+CREATE INDEX IF NOT EXISTS traces_wavelength ON traces (wavelength);
+CREATE INDEX IF NOT EXISTS traces_date ON traces (date_time);
+CREATE INDEX IF NOT EXISTS sites_fibre ON sites (cable_id, fiber_id, wavelength, distance);
+CREATE INDEX IF NOT EXISTS key_events_site ON key_events (site, date_time, splice_loss, sha256);
+CREATE INDEX IF NOT EXISTS key_events_distance ON key_events (distance);
+CREATE INDEX IF NOT EXISTS features_distance ON features (distance);
+'''
+
+TRACE_FIELDS = ('sha256', 'file', 'cable_id', 'fiber_id', 'wavelength', 'date_time', 'pulse_width',
+                'sample_spacing', 'index_of_refraction', 'number_of_points', 'otdr_name',
+                'otdr_serial_number', 'params')
+
+
+def connect(url=DEFAULT_DATABASE):
+    '''Open the index, creating its tables and indexes when they are missing'''
+    connection = sqlite3.connect(url)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def read_record(url, params=None):
+    '''Worker entry point: everything the index stores about one file, never raises'''
+    try:
+        stat = os.stat(url)
+        sor_file = LazySorFile(url)
+        d_meta = sor_file.metadata()
+        gen_params = analysis.get_block(d_meta, 'GenParams') or {}
+        sup_params = analysis.get_block(d_meta, 'SupParams') or {}
+        fxd_params = analysis.get_block(d_meta, 'FxdParams') or {}
+        key_events = analysis.get_block(d_meta, 'KeyEvents') or {}
+        params = analysis.resolve_params(params, fxd_params)
+        a_indexes, a_distances, a_levels = analysis.detect_edges(analysis.smooth_trace(sor_file.trace, params), params)
+        return {"file": url,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "trace": {"sha256": content_hash(url),
+                          "file": url,
+                          "cable_id": gen_params.get('cable_id'),
+                          "fiber_id": gen_params.get('fiber_id'),
+                          "wavelength": fxd_params.get('wavelength'),
+                          "date_time": fxd_params.get('date_time'),
+                          "pulse_width": fxd_params.get('pulse_width'),
+                          "sample_spacing": fxd_params.get('sample_spacing'),
+                          "index_of_refraction": fxd_params.get('index_of_refraction'),
+                          "number_of_points": fxd_params.get('number_of_data_points'),
+                          "otdr_name": sup_params.get('otdr_name'),
+                          "otdr_serial_number": sup_params.get('otdr_serial_number'),
+                          "params": params_hash(params)},
+                "key_events": [(event.get('event_number', number), event.get('distance_of_travel'),
+                                event.get('splice_loss'), event.get('reflection_loss'), event.get('slope'),
+                                (event.get('event_type_details') or {}).get('event'), event.get('comment'))
+                               for number, event in enumerate(key_events.get('events', []), 1)],
+                "features": list(zip(range(1, len(a_indexes) + 1), a_indexes.tolist(),
+                                     a_distances.tolist(), a_levels.tolist()))}
+    except Exception as error: # pylint: disable=broad-except
+        return {"file": url, "error": "{}: {}".format(type(error).__name__, error)}
+
+
+def _site(connection, d_trace, distance):
+    '''The site of a KeyEvent, the nearest known one of its fibre or a new one'''
+    fibre = (d_trace["cable_id"], d_trace["fiber_id"], d_trace["wavelength"])
+    row = connection.execute('''SELECT site FROM sites
+                                WHERE cable_id IS ? AND fiber_id IS ? AND wavelength IS ?
+                                  AND distance BETWEEN ? AND ?
+                                ORDER BY ABS(distance - ?) LIMIT 1''',
+                             fibre + (distance - SITE_TOLERANCE, distance + SITE_TOLERANCE, distance)).fetchone()
+    if row is not None:
+        return row[0]
+    return connection.execute("INSERT INTO sites (cable_id, fiber_id, wavelength, distance) VALUES (?, ?, ?, ?)",
+                              fibre + (distance,)).lastrowid
+
+
+def _forget(connection, sha256):
+    '''Drop a trace's rows once no indexed file has those contents any more, or
+    point them at a file that still has them'''
+    row = connection.execute("SELECT path FROM files WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone()
+    if row is not None:
+        connection.execute("UPDATE traces SET file = ? WHERE sha256 = ?", (row[0], sha256))
+        return
+    for table in ('traces', 'key_events', 'features'):
+        connection.execute("DELETE FROM {} WHERE sha256 = ?".format(table), (sha256,))
+
+
+def _store(connection, d_record):
+    '''Write one record, replacing what the index held for the same contents and
+    for what the same file held before'''
+    d_trace = d_record["trace"]
+    sha256 = d_trace["sha256"]
+    previous = connection.execute("SELECT sha256 FROM files WHERE path = ?", (d_record["file"],)).fetchone()
+    connection.execute("INSERT OR REPLACE INTO traces VALUES ({})".format(", ".join("?" * len(TRACE_FIELDS))),
+                       [d_trace[field] for field in TRACE_FIELDS])
+    connection.execute("DELETE FROM key_events WHERE sha256 = ?", (sha256,))
+    connection.executemany("INSERT INTO key_events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(sha256, number, _site(connection, d_trace, distance or 0.0), d_trace["date_time"],
+                             distance) + tuple(event)
+                            for number, distance, *event in d_record["key_events"]])
+    connection.execute("DELETE FROM features WHERE sha256 = ?", (sha256,))
+    connection.executemany("INSERT INTO features VALUES (?, ?, ?, ?, ?)",
+                           [(sha256,) + feature for feature in d_record["features"]])
+    connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                       (d_record["file"], d_record["size"], d_record["mtime_ns"], sha256))
+    if previous is not None and previous[0] != sha256:
+        _forget(connection, previous[0])
+
+
+def prune(connection):
+    '''Forget the indexed files that are no longer on disk, returning how many'''
+    missing = [(path, sha256) for path, sha256 in connection.execute("SELECT path, sha256 FROM files")
+               if not os.path.exists(path)]
+    for path, sha256 in missing:
+        connection.execute("DELETE FROM files WHERE path = ?", (path,))
+        _forget(connection, sha256)
+    return len(missing)
+
+
+def changed_files(connection, files):
+    '''The files that are new or differ in size or modification time from the last ingest'''
+    d_known = {path: (size, mtime_ns) for path, size, mtime_ns in
+               connection.execute("SELECT path, size, mtime_ns FROM files")}
+    changed = []
+    for url in files:
+        stat = os.stat(url)
+        if d_known.get(url) != (stat.st_size, stat.st_mtime_ns):
+            changed.append(url)
+    return changed
+
+
+def ingest(connection, paths, jobs=None, params=None, errors=None):
+    '''Index the SOR files under paths and prune the files that are gone, returning
+    (indexed, unchanged, failed, pruned) counts. Failures are appended to errors as
+    (file, message) when a list is given.'''
+    files = batch.collect_files(paths)
+    changed = changed_files(connection, files)
+    indexed = failed = 0
+    try:
+        pruned = prune(connection)
+        for d_record in batch.run_batch(changed, jobs, params, worker=read_record):
+            if "error" in d_record:
+                failed += 1
+                if errors is not None:
+                    errors.append((d_record["file"], d_record["error"]))
+                continue
+            _store(connection, d_record)
+            indexed += 1
+            if not indexed % COMMIT_EVERY:
+                connection.commit()
+    finally:
+        connection.commit()
+    # Keeps the query planner statistics current as the index grows
+    connection.execute("PRAGMA optimize")
+    return indexed, len(files) - len(changed), failed, pruned
+
+
+def loss_growth(connection, min_db=0.3, since=None):
+    '''Sites whose splice loss in the latest trace taken since the since timestamp is
+    more than min_db above the earliest one. Each row is (cable_id, fiber_id,
+    wavelength, distance, first loss, last loss, growth, first date_time,
+    last date_time, last file), largest growth first.'''
+    since = since or 0
+    # Both scans run on the covering key_events_site index, no trace is joined until the end
+    rows = connection.execute('''
+        WITH first AS (
+            SELECT site, splice_loss AS loss, MIN(date_time) AS date_time
+            FROM key_events WHERE date_time >= ? GROUP BY site),
+        last AS (
+            SELECT site, splice_loss AS loss, MAX(date_time) AS date_time, sha256
+            FROM key_events WHERE date_time >= ? GROUP BY site)
+        SELECT s.cable_id, s.fiber_id, s.wavelength, s.distance, first.loss, last.loss,
+               last.loss - first.loss AS growth, first.date_time, last.date_time, t.file
+        FROM first JOIN last ON last.site = first.site
+        JOIN sites AS s ON s.site = first.site
+        JOIN traces AS t ON t.sha256 = last.sha256
+        WHERE last.loss - first.loss > ?
+        ORDER BY growth DESC''', (since, since, min_db))
+    return rows.fetchall()
+
+
+def fibre_history(connection, cable_id, fiber_id, wavelength=None):
+    '''(date_time, site, distance, splice_loss, file) of every KeyEvent of one fibre, oldest first'''
+    query = '''SELECT k.date_time, k.site, k.distance, k.splice_loss, t.file
+               FROM sites AS s
+               JOIN key_events AS k ON k.site = s.site
+               JOIN traces AS t ON t.sha256 = k.sha256
+               WHERE s.cable_id = ? AND s.fiber_id = ?'''
+    arguments = [cable_id, fiber_id]
+    if wavelength is not None:
+        query += " AND s.wavelength = ?"
+        arguments.append(wavelength)
+    return connection.execute(query + " ORDER BY k.date_time, k.distance", arguments).fetchall()
+
+
+def _timestamp(text):
+    '''A YYYY-MM-DD date, in UTC, as seconds since the epoch like FxdParams date_time'''
+    return calendar.timegm(time.strptime(text, "%Y-%m-%d"))
+
+
+def main(argv=None):
+    '''Command line entry point'''
+    parser = argparse.ArgumentParser(description='Index SOR files in SQLite and query them')
+    parser.add_argument('-d', '--database', default=DEFAULT_DATABASE, help='the index file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = commands.add_parser('ingest', help='add new and changed SOR files to the index')
+    ingest_parser.add_argument('paths', nargs='+', help='SOR files, directories or glob patterns')
+    ingest_parser.add_argument('-j', '--jobs', type=int, default=None,
+                               help='worker processes (default: one per core)')
+    growth_parser = commands.add_parser('growth', help='sites whose splice loss grew')
+    growth_parser.add_argument('--min-db', type=float, default=0.3, help='smallest growth to report')
+    growth_parser.add_argument('--since', type=_timestamp, default=None, help='only traces from this date, YYYY-MM-DD')
+    sql_parser = commands.add_parser('sql', help='run a query, printing JSON lines')
+    sql_parser.add_argument('query')
+    args = parser.parse_args(argv)
+
+    connection = connect(args.database)
+    try:
+        if args.command == 'ingest':
+            errors = []
+            start = time.perf_counter()
+            indexed, unchanged, failed, pruned = ingest(connection, args.paths, args.jobs, errors=errors)
+            for url, error in errors:
+                print("{}: {}".format(url, error), file=sys.stderr)
+            print("indexed {} files, {} unchanged, {} failed, {} removed files pruned in {:.2f}s".format(
+                indexed, unchanged, failed, pruned, time.perf_counter() - start), file=sys.stderr)
+            return 1 if failed else 0
+        if args.command == 'growth':
+            rows = loss_growth(connection, args.min_db, args.since)
+        else:
+            rows = connection.execute(args.query).fetchall()
+        for row in rows:
+            print(json.dumps(row))
+    finally:
+        connection.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+'''Tune the detection parameters against the instruments' own KeyEvents.
+
+Detection runs over every combination of a grid of height, width and
+distance values across a corpus of SOR files, in a process pool. The
+features found are matched to the KeyEvents the instrument recorded and
+every combination is scored by precision and recall, per instrument model
+and pulse width:
+
+    python tune.py /path/to/archive --heights 0.001 0.00125 0.002 -o tuning.json
+
+Each worker parses a file once and reuses its differential for the whole
+grid. find_peaks runs once per height and distance, the widths of the peaks
+any of those runs kept are measured once, and each width of the grid then
+only filters them, which finds exactly what find_edges would.'''
+
+import sys
+import json
+import time
+import argparse
+from itertools import product
+
+import numpy as np
+from scipy.signal import find_peaks, peak_widths
+
+import analysis
+import batch
+from sorfile import LazySorFile
+
+
+HEIGHTS = (0.0005, 0.00075, 0.001, 0.00125, 0.0015, 0.002, 0.003)
+WIDTHS = (1, 2, 3, 5, 8, 12)
+DISTANCES = (25, 50, 100, 150, 250, 400)
+
+
+def parameter_grid(heights=HEIGHTS, widths=WIDTHS, distances=DISTANCES):
+    '''Every (height, width, distance) combination, in the order scores are kept'''
+    return list(product(heights, widths, distances))
+
+
+def match_count(a_found, a_expected, tolerance):
+    '''How many expected positions have a found position of their own within
+    tolerance, both sorted. Matching in order pairs up as many as possible.'''
+    found = expected = matched = 0
+    while found < len(a_found) and expected < len(a_expected):
+        if a_found[found] < a_expected[expected] - tolerance:
+            found += 1
+        elif a_found[found] > a_expected[expected] + tolerance:
+            expected += 1
+        else:
+            matched += 1
+            found += 1
+            expected += 1
+    return matched
+
+
+def score_trace(a_trace, a_expected, grid, tolerance=analysis.DEFAULT_TOLERANCE):
+    '''(found, matched) per grid combination for one smoothed trace, a_expected
+    being the sorted KeyEvent distances'''
+    a_abs_trace = np.abs(analysis.differentiate_levels(a_trace[1]))
+    heights = sorted({height for height, _, _ in grid})
+    distances = sorted({distance for _, _, distance in grid})
+    d_peaks = {(height, distance): find_peaks(a_abs_trace, height, distance=distance)[0]
+               for height in heights for distance in distances}
+    # A peak's width does not depend on the other peaks, measure each only once
+    a_measured = np.unique(np.concatenate([np.empty(0, dtype=np.intp)] + list(d_peaks.values())))
+    a_widths = peak_widths(a_abs_trace, a_measured, rel_height=0.5)[0] if len(a_measured) else np.empty(0)
+    a_counts = np.zeros((len(grid), 2), dtype=np.int64)
+    for row, (height, width, distance) in enumerate(grid):
+        a_peaks = d_peaks[(height, distance)]
+        a_peaks = a_peaks[width <= a_widths[np.searchsorted(a_measured, a_peaks)]]
+        a_counts[row] = len(a_peaks), match_count(a_trace[0][a_peaks], a_expected, tolerance)
+    return a_counts
+
+
+def score_file(url, settings):
+    '''Worker entry point scoring one file against settings, (grid, params,
+    tolerance), never raises so one bad file cannot stop a run'''
+    grid, params, tolerance = settings
+    try:
+        sor_file = LazySorFile(url)
+        d_meta = sor_file.metadata()
+        sup_params = analysis.get_block(d_meta, 'SupParams') or {}
+        fxd_params = analysis.get_block(d_meta, 'FxdParams') or {}
+        key_events = analysis.get_block(d_meta, 'KeyEvents') or {}
+        a_expected = np.sort([float(event.get('distance_of_travel') or 0) for event in key_events.get('events', [])])
+        a_trace = analysis.smooth_trace(sor_file.trace, analysis.resolve_params(params, fxd_params))
+        return {"file": url,
+                "model": "{} {}".format(sup_params.get('supplier_name') or '',
+                                        sup_params.get('otdr_name') or '').strip() or None,
+                "pulse_width": fxd_params.get('pulse_width'),
+                "key_events": len(a_expected),
+                "counts": score_trace(a_trace, a_expected, grid, tolerance)}
+    except Exception as error: # pylint: disable=broad-except
+        return {"file": url, "error": "{}: {}".format(type(error).__name__, error)}
+
+
+def _scores(a_counts, expected):
+    '''Precision, recall and F1 of (found, matched) counts'''
+    a_found, a_matched = a_counts[:, 0], a_counts[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a_precision = np.where(a_found > 0, a_matched / a_found, 0.0)
+        a_recall = a_matched / expected if expected else np.zeros(len(a_counts))
+        a_f1 = np.where(a_precision + a_recall > 0, 2 * a_precision * a_recall / (a_precision + a_recall), 0.0)
+    return a_precision, a_recall, a_f1
+
+
+def summarise(d_group, grid, top=1):
+    '''The best combinations of one group by F1, then recall, and how the
+    default parameters did when they are on the grid'''
+    a_counts = d_group["counts"]
+    a_precision, a_recall, a_f1 = _scores(a_counts, d_group["key_events"])
+
+    def entry(row):
+        height, width, distance = grid[row]
+        return {"height": height, "width": width, "distance": distance,
+                "precision": float(a_precision[row]), "recall": float(a_recall[row]), "f1": float(a_f1[row]),
+                "found": int(a_counts[row, 0]), "matched": int(a_counts[row, 1])}
+    # lexsort sorts by its last key first, stable so ties keep the grid order
+    a_order = np.lexsort((-a_recall, -a_f1))
+    default = tuple(analysis.DEFAULT_PARAMS[key] for key in ("height", "width", "distance"))
+    return {"model": d_group["model"],
+            "pulse_width": d_group["pulse_width"],
+            "files": d_group["files"],
+            "key_events": d_group["key_events"],
+            "best": [entry(row) for row in a_order[:top]],
+            "default": entry(grid.index(default)) if default in grid else None}
+
+
+def tune(files, grid, jobs=None, params=None, tolerance=analysis.DEFAULT_TOLERANCE, failures=None):
+    '''Score grid over files, returning the (found, matched) counts summed per
+    (model, pulse width) group'''
+    d_groups = {}
+    for result in batch.run_batch(files, jobs, (grid, params, tolerance), worker=score_file):
+        if 'error' in result:
+            if failures is not None:
+                failures.append(result)
+            continue
+        d_group = d_groups.setdefault((result["model"], result["pulse_width"]), {
+            "model": result["model"], "pulse_width": result["pulse_width"], "files": 0, "key_events": 0,
+            "counts": np.zeros((len(grid), 2), dtype=np.int64)})
+        d_group["files"] += 1
+        d_group["key_events"] += result["key_events"]
+        d_group["counts"] += result["counts"]
+    return [d_groups[key] for key in sorted(d_groups, key=str)]
+
+
+def main(argv=None):
+    '''Command line entry point'''
+    parser = argparse.ArgumentParser(description='Tune the detection parameters against the recorded KeyEvents')
+    parser.add_argument('paths', nargs='+', help='SOR files, directories or glob patterns')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('-o', '--output', default='-', help='output file (default: stdout)')
+    parser.add_argument('--heights', type=float, nargs='+', default=HEIGHTS, help='peak heights to try')
+    parser.add_argument('--widths', type=float, nargs='+', default=WIDTHS, help='peak widths to try')
+    parser.add_argument('--distances', type=float, nargs='+', default=DISTANCES, help='peak distances to try')
+    parser.add_argument('--tolerance', type=float, default=analysis.DEFAULT_TOLERANCE,
+                        help='how far a feature may be from a KeyEvent to match it, in trace distance units')
+    parser.add_argument('--top', type=int, default=1, help='combinations listed per model and pulse width')
+    parser.add_argument('--window-len', type=int, default=analysis.DEFAULT_PARAMS["window_len"],
+                        help='samples to smooth the levels over before detection, 0 for none '
+                             '(default: {} us worth at each file\'s sample spacing)'.format(analysis.SMOOTHING_US))
+    parser.add_argument('--filter', choices=analysis.FILTERS, default=analysis.DEFAULT_PARAMS["filter"],
+                        help='smoothing filter')
+    args = parser.parse_args(argv)
+
+    files = batch.collect_files(args.paths)
+    if not files:
+        print("no .sor files found", file=sys.stderr)
+        return 1
+    grid = parameter_grid(args.heights, args.widths, args.distances)
+    start = time.perf_counter()
+    failures = []
+    groups = tune(files, grid, args.jobs, {"window_len": args.window_len, "filter": args.filter},
+                  args.tolerance, failures)
+    for result in failures:
+        print("{}: {}".format(result["file"], result["error"]), file=sys.stderr)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        for d_group in groups:
+            output.write(json.dumps(summarise(d_group, grid, args.top)) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    print("scored {} combinations over {} files ({} failed) in {:.2f}s: {:.1f} files/sec".format(
+        len(grid), len(files), len(failures), elapsed, len(files) / elapsed if elapsed else float('inf')),
+          file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
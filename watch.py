@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+'''Watch directory trees for SOR files as test heads drop them in'''
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import batch
+
+
+DEFAULT_INTERVAL = 2.0
+DEFAULT_SETTLE = 2.0
+
+
+class DirectoryWatcher():
+    '''Polls directory trees for new or changed .sor files.
+
+    A file only becomes ready once its size and modification time have not
+    changed for settle seconds, so files that are still being copied in are
+    left alone until the writer is done. Every version of a file is reported
+    once. Ready files queue up as paths, take() hands them out as the caller
+    has room for them.'''
+    def __init__(self, paths, settle=DEFAULT_SETTLE, skip_existing=False):
+        self.paths = list(paths)
+        self.settle = settle
+        self.ready = deque()
+        self._candidates = {}
+        self._reported = {}
+        if skip_existing:
+            self._reported = dict(self._stamps())
+
+    def _stamps(self):
+        '''(path, (size, mtime)) of every SOR file under the watched paths'''
+        for url in batch.collect_files(self.paths):
+            try:
+                stat = os.stat(url)
+            except OSError:
+                # Removed between listing and stat
+                continue
+            yield url, (stat.st_size, stat.st_mtime_ns)
+
+    def scan(self, now=None):
+        '''Look at the watched paths once, returning how many files became ready'''
+        now = time.monotonic() if now is None else now
+        became_ready = 0
+        present = set()
+        for url, stamp in self._stamps():
+            present.add(url)
+            if self._reported.get(url) == stamp:
+                continue
+            candidate = self._candidates.get(url)
+            if candidate is None or candidate[0] != stamp:
+                self._candidates[url] = (stamp, now)
+            elif now - candidate[1] >= self.settle:
+                del self._candidates[url]
+                self._reported[url] = stamp
+                self.ready.append(url)
+                became_ready += 1
+        for url in [url for url in self._candidates if url not in present]:
+            del self._candidates[url]
+        for url in [url for url in self._reported if url not in present]:
+            del self._reported[url]
+        return became_ready
+
+    def take(self, limit=None):
+        '''Up to limit ready files, oldest first'''
+        count = len(self.ready) if limit is None else max(0, min(limit, len(self.ready)))
+        return [self.ready.popleft() for _ in range(count)]
+
+
+def watch(paths, worker=batch.analyse_one, jobs=None, params=None, interval=DEFAULT_INTERVAL,
+          settle=DEFAULT_SETTLE, in_flight=None, skip_existing=False, stop=None):
+    '''Yield worker(url, params) for every new or changed file, each as soon as it is done.
+
+    At most in_flight files, by default two per worker, are handed to the
+    pool at a time. The rest wait as paths, so a burst of thousands of files
+    costs no more memory than a few results. Runs until stop, a
+    threading.Event, is set.'''
+    jobs = jobs or os.cpu_count() or 1
+    in_flight = in_flight or jobs * 2
+    watcher = DirectoryWatcher(paths, settle, skip_existing)
+    next_scan = time.monotonic()
+    running = set()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while stop is None or not stop.is_set():
+            if time.monotonic() >= next_scan:
+                watcher.scan()
+                next_scan = time.monotonic() + interval
+            for url in watcher.take(in_flight - len(running)):
+                running.add(executor.submit(worker, url, params))
+            timeout = max(0.0, next_scan - time.monotonic())
+            if not running:
+                if stop is not None:
+                    stop.wait(timeout)
+                else:
+                    time.sleep(timeout)
+                continue
+            done, running = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        for future in running:
+            future.cancel()
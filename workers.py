@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+'''Background loading and analysis of traces for the OpenOTDR window'''
+
+from threading import Event
+
+from PyQt6 import QtCore
+
+from analysis import extract_meta
+from instrument import span
+from sorfile import LazySorFile
+
+
+def load_trace(url, params, cache):
+    '''Everything the window needs about one file, safe to run off the GUI thread'''
+    with span("load", url=url):
+        sor_file = LazySorFile(url)
+        d_meta = sor_file.metadata()
+        d_result = cache.analyse(url, params, sor_file)
+        return {"sor_file": sor_file,
+                "meta": d_meta,
+                "meta_rows": extract_meta(d_meta),
+                "params": dict(params),
+                "trace": d_result["trace"],
+                "features": d_result["features"]}
+
+
+class _TaskSignals(QtCore.QObject):
+    '''QRunnable is not a QObject, so its signals live here'''
+    done = QtCore.pyqtSignal(str, object, str)
+
+
+class _LoadTask(QtCore.QRunnable):
+    '''Load one file unless the batch was cancelled before it started'''
+    def __init__(self, url, load, cancelled, signals):
+        super(_LoadTask, self).__init__()
+        self.url = url
+        self.load = load
+        self.cancelled = cancelled
+        self.signals = signals
+
+    def run(self):
+        if self.cancelled.is_set():
+            self.signals.done.emit(self.url, None, "")
+            return
+        try:
+            d_loaded = self.load(self.url)
+        except Exception as error: # pylint: disable=broad-except
+            self.signals.done.emit(self.url, None, "{}: {}".format(type(error).__name__, error))
+            return
+        self.signals.done.emit(self.url, d_loaded, "")
+
+
+class LoadBatch(QtCore.QObject):
+    '''Files loaded on a QThreadPool, each result delivered to the GUI thread as it lands.
+
+    loaded(url, d_loaded) and failed(url, message) fire per file, progress(done, total)
+    after every file and finished() once all files are done or cancelled.'''
+    loaded = QtCore.pyqtSignal(str, object)
+    failed = QtCore.pyqtSignal(str, str)
+    progress = QtCore.pyqtSignal(int, int)
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, params, cache, pool=None, parent=None):
+        super(LoadBatch, self).__init__(parent)
+        self.params = dict(params)
+        self.cache = cache
+        self.pool = pool or QtCore.QThreadPool.globalInstance()
+        self.total = 0
+        self.done = 0
+        self._cancelled = Event()
+        self._signals = _TaskSignals()
+        self._signals.done.connect(self._on_done)
+
+    def extend(self, urls, load=None):
+        '''Queue more files on this batch, load(url) defaults to reading the SOR file'''
+        load = load or self._load_sor
+        for url in urls:
+            self.total += 1
+            self.pool.start(_LoadTask(url, load, self._cancelled, self._signals))
+        self.progress.emit(self.done, self.total)
+
+    def _load_sor(self, url):
+        return load_trace(url, self.params, self.cache)
+
+    def cancel(self):
+        '''Skip every file that has not started loading yet'''
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        '''Whether cancel was called, files added after that would be skipped too'''
+        return self._cancelled.is_set()
+
+    def is_running(self):
+        '''Whether some files are still outstanding'''
+        return self.done < self.total
+
+    def _on_done(self, url, d_loaded, error):
+        self.done += 1
+        if d_loaded is not None:
+            self.loaded.emit(url, d_loaded)
+        elif error:
+            self.failed.emit(url, error)
+        self.progress.emit(self.done, self.total)
+        if not self.is_running():
+            self.finished.emit()
+
+
+class _ScanSignals(QtCore.QObject):
+    done = QtCore.pyqtSignal(object)
+
+
+class _ScanTask(QtCore.QRunnable):
+    '''Scan once and hand over the files that settled'''
+    def __init__(self, watcher, signals):
+        super(_ScanTask, self).__init__()
+        self.watcher = watcher
+        self.signals = signals
+
+    def run(self):
+        try:
+            self.watcher.scan()
+            urls = self.watcher.take()
+        except OSError:
+            # A share that went away is scanned again on the next poll
+            urls = []
+        self.signals.done.emit(urls)
+
+
+class DirectoryScan(QtCore.QObject):
+    '''The scans of a watch.DirectoryWatcher on a QThreadPool, listing a large
+    tree or a network share never blocks the GUI thread.
+
+    scanned(urls) fires on the GUI thread with the files that settled. Only
+    one scan runs at a time, so the watcher is never touched from two threads.'''
+    scanned = QtCore.pyqtSignal(object)
+
+    def __init__(self, watcher, pool=None, parent=None):
+        super(DirectoryScan, self).__init__(parent)
+        self.watcher = watcher
+        self.pool = pool or QtCore.QThreadPool.globalInstance()
+        self.running = False
+        self._signals = _ScanSignals()
+        self._signals.done.connect(self._on_done)
+
+    def start(self):
+        '''Scan in the background, unless the previous scan is still going'''
+        if self.running:
+            return False
+        self.running = True
+        self.pool.start(_ScanTask(self.watcher, self._signals))
+        return True
+
+    def _on_done(self, urls):
+        self.running = False
+        self.scanned.emit(urls)